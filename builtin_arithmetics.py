@@ -1,16 +1,44 @@
 from cmath import exp, phase
 from math import cos, sin, acos
 
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
-from builtin_gates import BuiltinGate, X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE
-from quasar_cmd import GateCmd
+from builtin_gates import BuiltinGate, X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate
+from quasar_cmd import BroadcastCmd, GateCmd, ICommand, OpaqueGateCmd
 
+Gate = Union[BuiltinGate, OpaqueGate]
 
-def invert_gate(gate: BuiltinGate, params: List[float]) -> Tuple[BuiltinGate, List[float]]:
-    if gate in {X_GATE, Y_GATE, Z_GATE, H_GATE}:
+_INVERSE_GATES = {
+    S_GATE: SDG_GATE,
+    SDG_GATE: S_GATE,
+    T_GATE: TDG_GATE,
+    TDG_GATE: T_GATE,
+}
+
+_SELF_INVERSE_GATES = frozenset({X_GATE, Y_GATE, Z_GATE, H_GATE})
+
+_ROTATION_GATES = frozenset({RX_GATE, RY_GATE, RZ_GATE, P_GATE})
+
+_DIAGONAL_GATES = frozenset({Z_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE})
+
+_X_GATES = frozenset({X_GATE, RX_GATE})
+
+
+def invert_gate(gate: Gate, params: List[float]) -> Tuple[Gate, List[float]]:
+    if isinstance(gate, OpaqueGate):
+        if gate.inverse is None:
+            raise NotImplementedError(f'Opaque gate {gate.name} has no inverse rule')
+        return gate.inverse(gate, params)
+    if gate in _SELF_INVERSE_GATES:
         assert not params
         return gate, params
+    if gate in _INVERSE_GATES:
+        assert not params
+        return _INVERSE_GATES[gate], params
+    if gate in _ROTATION_GATES:
+        return gate, [-params[0]]
     if gate == U3_GATE:
         return U3_GATE, [
             -params[0],  # theta   ->  -theta
@@ -20,19 +48,38 @@ def invert_gate(gate: BuiltinGate, params: List[float]) -> Tuple[BuiltinGate, Li
     raise NotImplementedError(f'Dont know how to invert {gate} {params}')
 
 
-def check_commutation(cmd1: GateCmd, cmd2: GateCmd) -> bool:
+def is_diagonal_gate(gate: Gate, params: List[float]) -> bool:
+    """ Returns True if the (uncontrolled) gate is diagonal in the computational basis. """
+    if gate in _DIAGONAL_GATES:
+        return True
+    return gate == U3_GATE and params[0] == 0
+
+
+def _check_opaque_commutation(cmd1: ICommand, cmd2: ICommand) -> bool:
+    """ Uses the commutation hints of the opaque gates (see `OpaqueGate.commutes_with`). """
+    if not isinstance(cmd1, (GateCmd, OpaqueGateCmd, BroadcastCmd)) \
+            or not isinstance(cmd2, (GateCmd, OpaqueGateCmd, BroadcastCmd)):
+        return False
+    if isinstance(cmd1, OpaqueGateCmd) and cmd2.gate.name in cmd1.gate.commutes_with:
+        return True
+    return isinstance(cmd2, OpaqueGateCmd) and cmd1.gate.name in cmd2.gate.commutes_with
+
+
+def check_commutation(cmd1: ICommand, cmd2: ICommand) -> bool:
     """ Returns True if two gates can be swapped with no change to the outcome. """
     # TODO(adsz): In future, it might be also beneficial to check commutation
     #  that alters the gates (with similar gate complexity).
 
     if cmd1 == cmd2:
         return True
+    if not isinstance(cmd1, GateCmd) or not isinstance(cmd2, GateCmd):
+        return not (cmd1.get_qubit_ids() & cmd2.get_qubit_ids()) or _check_opaque_commutation(cmd1, cmd2)
     if not ((cmd1.get_control_qubit_ids() | {cmd1.get_target_qubit_id()}) &
             (cmd2.get_control_qubit_ids() | {cmd2.get_target_qubit_id()})):
         return True
-    if cmd1.gate == Z_GATE and cmd2.gate == Z_GATE:
+    if is_diagonal_gate(cmd1.gate, cmd1._params) and is_diagonal_gate(cmd2.gate, cmd2._params):
         return True
-    if cmd1.gate == X_GATE and cmd2.gate == X_GATE:
+    if cmd1.gate in _X_GATES and cmd2.gate in _X_GATES:
         if cmd1.get_target_qubit_id() in cmd2.get_control_qubit_ids():
             return False
         elif cmd2.get_target_qubit_id() in cmd1.get_control_qubit_ids():
@@ -6,8 +6,10 @@ import numpy as np
 from numpy.testing import assert_allclose
 from random import random, seed
 
-from builtin_arithmetics import invert_gate, reduce_consecutive_u3
-from builtin_gates import X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE
+from builtin_arithmetics import check_commutation, invert_gate, reduce_consecutive_u3
+from builtin_gates import X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, RX_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, \
+    T_GATE, TDG_GATE
+from quasar_cmd import GateCmd
 
 
 def _u3(a: float, b: float, c: float) -> np.array:
@@ -51,6 +53,24 @@ class BuiltinArithmeticsTest(unittest.TestCase):
             invert_gate(U3_GATE, [2.2, 3.3, 4.4]),
             (U3_GATE, [-2.2, -4.4, -3.3]))
 
+    def test_inverse_rotations(self) -> None:
+        self.assertEqual(invert_gate(RX_GATE, [0.5]), (RX_GATE, [-0.5]))
+        self.assertEqual(invert_gate(RZ_GATE, [0.5]), (RZ_GATE, [-0.5]))
+        self.assertEqual(invert_gate(P_GATE, [-1.5]), (P_GATE, [1.5]))
+        self.assertEqual(invert_gate(S_GATE, []), (SDG_GATE, []))
+        self.assertEqual(invert_gate(TDG_GATE, []), (T_GATE, []))
+
+    def test_commutation(self) -> None:
+        # Diagonal gates commute with each other, whichever their controls are
+        crz = GateCmd(RZ_GATE, 0, control_qubit_ids={1}, params=[0.3])
+        self.assertTrue(check_commutation(crz, GateCmd(T_GATE, 1)))
+        self.assertTrue(check_commutation(crz, GateCmd(Z_GATE, 1, control_qubit_ids={0})))
+        self.assertTrue(check_commutation(crz, GateCmd(U3_GATE, 0, params=[0, 0.1, 0.2])))
+        self.assertFalse(check_commutation(crz, GateCmd(U3_GATE, 0, params=[0.1, 0.1, 0.2])))
+        # So do rotations around X on the same target
+        self.assertTrue(check_commutation(GateCmd(RX_GATE, 0, params=[0.3]), GateCmd(X_GATE, 0, control_qubit_ids={1})))
+        self.assertFalse(check_commutation(GateCmd(RX_GATE, 1, params=[0.3]), GateCmd(X_GATE, 0, control_qubit_ids={1})))
+
     def test_conversion_random_angles(self) -> None:
         seed(7777)
         for test_id in range(20):
@@ -20,6 +20,14 @@ Y_GATE = BuiltinGate('Y', 0)
 Z_GATE = BuiltinGate('Z', 0)
 H_GATE = BuiltinGate('H', 0)
 U3_GATE = BuiltinGate('U3', 3)
+RX_GATE = BuiltinGate('RX', 1)
+RY_GATE = BuiltinGate('RY', 1)
+RZ_GATE = BuiltinGate('RZ', 1)
+P_GATE = BuiltinGate('P', 1)
+S_GATE = BuiltinGate('S', 0)
+SDG_GATE = BuiltinGate('SDG', 0)
+T_GATE = BuiltinGate('T', 0)
+TDG_GATE = BuiltinGate('TDG', 0)
 
 def builtin_repr(gate: BuiltinGate) -> str:
     return f'{gate.name}_GATE'
@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines user-defined gates which are kept opaque by the compiler.
+Unlike the builtin gates, such a gate acts on a fixed number of qubits and is passed
+as a single command through the compilation, the optimizations and the inversion,
+up to the formatter which declares it for the backend.
+It is expanded with its `definition` only when the backend really needs it:
+under controls, for a target which does not support it natively,
+or for an inversion without a declared inverse rule."""
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+
+InverseRule = Callable[['OpaqueGate', List[float]], Tuple['OpaqueGate', List[float]]]
+
+
+@dataclass(frozen=True)
+class OpaqueGate:
+    """ `inverse` maps the gate and its params onto the inverse gate and its params.
+    `commutes_with` are the names of the (builtin or opaque) gates it commutes with,
+    whichever qubits they share (also with any controls on them).
+    `matrix` maps the params onto the unitary, the first qubit being the least significant one.
+    `definition` maps the qubits and the params onto a program of the gate
+    (e.g. `lambda qubits, params: CX(qubits[0], qubits[1])`).
+    `cost` is the relative cost of the gate (for `Target.get_cost`). """
+    name: str
+    num_qubits: int
+    num_params: int = 0
+    inverse: Optional[InverseRule] = field(default=None, compare=False)
+    commutes_with: FrozenSet[str] = field(default=frozenset(), compare=False)
+    matrix: Optional[Callable[[List[float]], List[List[complex]]]] = field(default=None, compare=False)
+    definition: Optional[Callable[[List[Any], List[float]], Any]] = field(default=None, compare=False)
+    cost: float = field(default=1.0, compare=False)
+
+
+def self_inverse(gate: OpaqueGate, params: List[float]) -> Tuple[OpaqueGate, List[float]]:
+    """ The inverse rule of gates like SWAP. """
+    return gate, params
+
+
+def negated_params(gate: OpaqueGate, params: List[float]) -> Tuple[OpaqueGate, List[float]]:
+    """ The inverse rule of rotations like exp(-i * theta * P). """
+    return gate, [-param for param in params]
+
+
+# Names which cannot be declared again, as OpenQASM 2.0 and qelib1.inc define them
+_RESERVED_NAMES = {
+    'U', 'CX', 'barrier', 'creg', 'gate', 'if', 'measure', 'opaque', 'qreg', 'reset',
+    'u3', 'u2', 'u1', 'cx', 'id', 'u0', 'u', 'p', 'x', 'y', 'z', 'h', 's', 'sdg', 't', 'tdg',
+    'rx', 'ry', 'rz', 'sx', 'sxdg', 'cz', 'cy', 'swap', 'ch', 'ccx', 'cswap', 'crx', 'cry', 'crz',
+    'cu1', 'cp', 'cu3', 'csx', 'cu', 'rxx', 'rzz', 'rccx', 'rc3x', 'c3x', 'c3sqrtx', 'c4x',
+}
+
+_REGISTRY: Dict[str, OpaqueGate] = {}
+
+
+def is_qelib1_gate(gate: OpaqueGate) -> bool:
+    """ Returns True for the predefined opaque gates (like `SWAP_GATE`) which qelib1.inc declares. """
+    return gate.name in _RESERVED_NAMES
+
+
+def register_opaque_gate(
+    name: str,
+    num_qubits: int,
+    num_params: int = 0,
+    inverse: Optional[InverseRule] = None,
+    commutes_with: Iterable[str] = (),
+    matrix: Optional[Callable[[List[float]], List[List[complex]]]] = None,
+    definition: Optional[Callable[[List[Any], List[float]], Any]] = None,
+    cost: float = 1.0
+) -> OpaqueGate:
+    """ Creates an opaque gate (see `OpaqueGate`), its name has to be unique
+    and a valid OpenQASM identifier (starting with a lowercase letter). """
+    if not (name[:1].islower() and name.replace('_', 'a').isalnum() and name.isascii()):
+        raise ValueError(f'Opaque gate name {name!r} is not a valid OpenQASM identifier')
+    if name in _RESERVED_NAMES or name in _REGISTRY:
+        raise ValueError(f'Opaque gate {name!r} is already defined')
+    if num_qubits < 1:
+        raise ValueError(f'Opaque gate {name!r} has to act on at least one qubit')
+
+    gate = OpaqueGate(
+        name,
+        num_qubits,
+        num_params,
+        inverse,
+        frozenset(commutes_with),
+        matrix,
+        definition,
+        cost
+    )
+    _REGISTRY[name] = gate
+    return gate
+
+
+def get_opaque_gate(name: str) -> OpaqueGate:
+    if name not in _REGISTRY:
+        raise ValueError(f'Opaque gate {name!r} is not registered')
+    return _REGISTRY[name]
+
+
+def unregister_opaque_gate(name: str) -> None:
+    _REGISTRY.pop(name, None)
@@ -0,0 +1,112 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+from opaque_gates import register_opaque_gate, get_opaque_gate, unregister_opaque_gate, self_inverse, negated_params
+from quasar import All, CX, H, If, Inv, Opaque, Phase, Program, Quasar, Z
+from quasar_qasm import QASMFormatter
+from quasar_target import CX_U3_TARGET
+
+#
+##
+#
+
+class OpaqueGatesTest(unittest.TestCase):
+
+    def _register(self, name: str, *args, **kwargs):
+        self.addCleanup(unregister_opaque_gate, name)
+        return register_opaque_gate(name, *args, **kwargs)
+
+    def test_register(self) -> None:
+        gate = self._register('block', 3, 1)
+        self.assertIs(get_opaque_gate('block'), gate)
+
+        for name in ('block', 'cx', 'Block', 'my-gate'):
+            with self.assertRaises(ValueError):
+                register_opaque_gate(name, 2)
+
+    def test_compile(self) -> None:
+        swap = self._register(
+            'myswap', 2,
+            inverse=self_inverse,
+            definition=lambda qubits, params: CX(qubits[0], qubits[1]) + CX(qubits[1], qubits[0]) + CX(qubits[0], qubits[1])
+        )
+        rzz = self._register(
+            'myrzz', 2, 1,
+            inverse=negated_params,
+            commutes_with={'Z'},
+            definition=lambda qubits, params: CX(qubits[0], qubits[1]) + Phase(qubits[1], params[0]) + CX(qubits[0], qubits[1])
+        )
+        block = self._register('block', 3)
+
+        prgm = Program()
+        qubits = prgm.Qubits(4 * [0])
+        prgm += H(qubits[0]) + Opaque(swap, qubits[:2])
+        # Cancels out through the Z gate
+        prgm += Opaque(rzz, qubits[1:3], [0.5]) + Z(qubits[2]) + Inv(Opaque(rzz, qubits[1:3], [0.5]))
+        prgm += Opaque(block, qubits[:3])
+        prgm += If(All(qubits[3])).Then(Opaque(swap, qubits[:2]))
+
+        actual = Quasar().compile(prgm, QASMFormatter())
+        expected = [
+            'OPENQASM 2.0;',
+            'include "qelib1.inc";',
+            'gate myswap a0, a1 {',
+            '    cx a0, a1;',
+            '    cx a1, a0;',
+            '    cx a0, a1;',
+            '}',
+            'opaque myrzz(p0) a0, a1;',
+            'opaque block a0, a1, a2;',
+            ' ',
+            'qreg q[4];',
+            'creg c[0];',
+            ' ',
+            'h q[0];',
+            'myswap q[0], q[1];',
+            'z q[2];',
+            'block q[0], q[1], q[2];',
+            'ccx q[0], q[3], q[1];',
+            'ccx q[1], q[3], q[0];',
+            'ccx q[0], q[3], q[1];',
+        ]
+        self.assertListEqual(actual, expected)
+
+        # The gate without a definition cannot be expanded for the target
+        with self.assertRaises(ValueError):
+            Quasar().compile(prgm, QASMFormatter(), target=CX_U3_TARGET)
+
+    def test_inverse_without_rule(self) -> None:
+        gate = self._register('shift', 2, definition=lambda qubits, params: CX(qubits[0], qubits[1]) + H(qubits[0]))
+
+        prgm = Program()
+        qubits = prgm.Qubits(2 * [0])
+        prgm += Inv(Opaque(gate, qubits))
+
+        actual = Quasar().compile(prgm, QASMFormatter())
+        self.assertListEqual(actual[-2:], ['h q[0];', 'cx q[0], q[1];'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -47,21 +47,17 @@ class FourierTest(unittest.TestCase):
             'creg c[0];' + '\n' +
             ' ' + '\n' +
             'h q[0];' + '\n' +
-            'cu3(0, 0, 1.5707963267948966) q[1], q[0];' + '\n' +
-            'cu3(0, 0, 0.7853981633974483) q[2], q[0];' + '\n' +
-            'cu3(0, 0, 0.39269908169872414) q[3], q[0];' + '\n' +
+            'cu1(1.5707963267948966) q[1], q[0];' + '\n' +
+            'cu1(0.7853981633974483) q[2], q[0];' + '\n' +
+            'cu1(0.39269908169872414) q[3], q[0];' + '\n' +
             'h q[1];' + '\n' +
-            'cu3(0, 0, 1.5707963267948966) q[2], q[1];' + '\n' +
-            'cu3(0, 0, 0.7853981633974483) q[3], q[1];' + '\n' +
+            'cu1(1.5707963267948966) q[2], q[1];' + '\n' +
+            'cu1(0.7853981633974483) q[3], q[1];' + '\n' +
             'h q[2];' + '\n' +
-            'cu3(0, 0, 1.5707963267948966) q[3], q[2];' + '\n' +
+            'cu1(1.5707963267948966) q[3], q[2];' + '\n' +
             'h q[3];' + '\n' +
-            'cx q[0], q[3];' + '\n' +
-            'cx q[3], q[0];' + '\n' +
-            'cx q[0], q[3];' + '\n' +
-            'cx q[1], q[2];' + '\n' +
-            'cx q[2], q[1];' + '\n' +
-            'cx q[1], q[2];'
+            'swap q[0], q[3];' + '\n' +
+            'swap q[1], q[2];'
         )
 
         self.assertEqual(actual, expected)
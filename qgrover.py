@@ -23,7 +23,7 @@
 from math import asin, pi, sqrt
 from typing import Callable, List
 
-from quasar import ASTNode, H, Flip, If, Program, Qubit, Zero
+from quasar import ASTNode, H, Flip, If, Program, Qubit, Repeat, Zero
 
 #
 ##
@@ -35,8 +35,7 @@ def Grover(
 ) -> Program:
     prgm = Program()
 
-    for qubit in qubits:
-        prgm += H(qubit)
+    prgm += H(qubits)
 
     # IBM QisKit http://tiny.cc/wn7uaz
     #number_of_iters : Callable[[int], int] = \
@@ -46,17 +45,19 @@ def Grover(
     number_of_iters : Callable[[int], int] = \
         lambda size: int(pi / 4 / asin(sqrt(1 / (2 ** size))))
 
-    for _ in range(number_of_iters(len(qubits))):
-        prgm += If(predicate).Flip()
+    iteration = Program()
 
-        for qubit in qubits:
-            prgm += H(qubit)
+    iteration += If(predicate).Flip()
 
-        prgm += If(Zero(qubits)).Flip()
+    iteration += H(qubits)
 
-        for qubit in qubits:
-            prgm += H(qubit)
+    iteration += If(Zero(qubits)).Flip()
 
-        prgm += Flip(qubits)
+    iteration += H(qubits)
+
+    iteration += Flip(qubits)
+
+    # The iteration is compiled once, regardless of the number of iterations
+    prgm += Repeat(number_of_iters(len(qubits)), iteration)
 
     return prgm
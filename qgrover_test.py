@@ -60,13 +60,13 @@ class GroverTest(unittest.TestCase):
             'h q[2];' + '\n'
             'x q[0];' + '\n'
             'x q[1];' + '\n'
-            'x q[2];' + '\n'
             'ccx q[0], q[1], q[3];' + '\n'
+            'x q[2];' + '\n'
             'cz q[2], q[3];' + '\n'
             'ccx q[0], q[1], q[3];' + '\n'
-            'x q[2];' + '\n'
-            'x q[1];' + '\n'
             'x q[0];' + '\n'
+            'x q[1];' + '\n'
+            'x q[2];' + '\n'
             'h q[0];' + '\n'
             'h q[1];' + '\n'
             'h q[2];' + '\n'
@@ -84,13 +84,13 @@ class GroverTest(unittest.TestCase):
             'h q[2];' + '\n'
             'x q[0];' + '\n'
             'x q[1];' + '\n'
-            'x q[2];' + '\n'
             'ccx q[0], q[1], q[3];' + '\n'
+            'x q[2];' + '\n'
             'cz q[2], q[3];' + '\n'
             'ccx q[0], q[1], q[3];' + '\n'
-            'x q[2];' + '\n'
-            'x q[1];' + '\n'
             'x q[0];' + '\n'
+            'x q[1];' + '\n'
+            'x q[2];' + '\n'
             'h q[0];' + '\n'
             'h q[1];' + '\n'
             'h q[2];' + '\n'
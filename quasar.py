@@ -21,15 +21,23 @@
 #
 
 from math import pi
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
-from builtin_gates import U3_GATE, X_GATE, Y_GATE, Z_GATE, H_GATE
-from quasar_ast import Program, ProgramLike, GateNode, IASTNode, IfNode, MatchNode, NotNode, MeasurementNode, ResetNode, QubitNode, InvNode
-from quasar_cmd import ICommand
+from builtin_gates import BuiltinGate, U3_GATE, X_GATE, Y_GATE, Z_GATE, H_GATE, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate, is_qelib1_gate, register_opaque_gate, self_inverse, negated_params
+from quasar_ast import Program, ProgramLike, GateNode, IASTNode, IfNode, MatchNode, NotNode, MeasurementNode, ResetNode, QubitNode, InvNode, OpaqueGateNode, BroadcastNode, RepeatNode
+from quasar_cmd import BroadcastCmd, GateCmd, ICommand, OpaqueGateCmd, RepeatCmd, flatten_repeats
 from quasar_comp import CompileVisitor, ResourceAllocator, to_list
+from quasar_constprop import stream_constants
 from quasar_formatter import IQAsmFormatter
+from quasar_mcx import AncillaReport
+from quasar_lightcone import Compaction, compact_registers, prune_light_cone
 from quasar_opt import QuasarOpt
 from quasar_qasm import QASMFormatter
+from quasar_routing import CouplingGraph, QuasarRouter, RoutingReport
+from quasar_subcircuit import extract_subcircuits
+from quasar_target import DEFAULT_TARGET, Target, expand_negative_controls, stream_negative_controls
 
 #
 ##
@@ -38,47 +46,227 @@ from quasar_qasm import QASMFormatter
 class Quasar:
     def _commands_to_code(
         self,
-        commands: List[ICommand],
+        commands: Iterable[ICommand],
         qasm_formatter: IQAsmFormatter
     ) -> List[str]:
         code : List[str] = []
+        self._num_gates = 0
 
         for command in commands:
+            self._num_gates += self._get_num_gates(command)
             for line in command.get_lines(qasm_formatter):
                 code.append(line)
 
         return code
 
+    def _get_num_gates(self, command: ICommand) -> int:
+        if isinstance(command, RepeatCmd):
+            return command.count * sum(map(self._get_num_gates, command.body))
+        if isinstance(command, OpaqueGateCmd) and command.gate in self._subcircuits:
+            return sum(map(self._get_num_gates, self._subcircuits[command.gate]))
+        if isinstance(command, BroadcastCmd):
+            return len(command.get_qubit_ids())
+        return int(isinstance(command, (GateCmd, OpaqueGateCmd)))
+
+    @staticmethod
+    def _get_opaque_gate_declarations(
+        commands: List[ICommand],
+        target: Target,
+        qasm_formatter: IQAsmFormatter
+    ) -> Dict[OpaqueGate, Optional[List[ICommand]]]:
+        """ Maps the opaque gates used by `commands` (and their bodies) onto their bodies,
+        except the ones qelib1.inc already declares. A gate has a body if it has a definition and no params, the body is compiled
+        into the gate qubits only (with no ancillas) and the target gate set. """
+        declarations: Dict[OpaqueGate, Optional[List[ICommand]]] = {}
+
+        def declare(gate: OpaqueGate) -> None:
+            if gate in declarations or is_qelib1_gate(gate):
+                return
+            body: Optional[List[ICommand]] = None
+
+            if gate.definition is not None and gate.num_params == 0:
+                prgm = Program()
+                qubits = prgm.Qubits(gate.num_qubits * [0])
+                prgm += gate.definition(qubits, [])
+                compile_visitor = CompileVisitor(ResourceAllocator(gate.num_qubits), target=target)
+                prgm.accept(compile_visitor)
+                body = QuasarOpt.run(target.lower(compile_visitor.commands), gate.num_qubits)
+                if not qasm_formatter.supports_control_state():
+                    body = expand_negative_controls(body)
+
+                for command in flatten_repeats(body):
+                    if isinstance(command, OpaqueGateCmd):
+                        declare(command.gate)
+                    elif not isinstance(command, (GateCmd, BroadcastCmd)):
+                        raise ValueError(f'The definition of opaque gate {gate.name} is not unitary: {command}')
+
+            declarations[gate] = body
+
+        for command in flatten_repeats(commands):
+            if isinstance(command, OpaqueGateCmd):
+                declare(command.gate)
+
+        return declarations
+
+    @staticmethod
+    def _drained(commands: List[ICommand]) -> Iterator[ICommand]:
+        """ Yields the commands removing them from the list, so they can be freed once processed. """
+        commands.reverse()
+        while commands:
+            yield commands.pop()
+
+    @staticmethod
+    def _optimized(
+        commands: Iterable[ICommand],
+        max_used_qubit_id: int,
+        optimize_window: Optional[int]
+    ) -> Iterable[ICommand]:
+        if optimize_window is None:
+            return QuasarOpt.run(list(commands), max_used_qubit_id)
+        return QuasarOpt.stream(commands, optimize_window)
+
     def to_qasm_str(
         self,
         root: ProgramLike,
         optimize: bool = True
     ) -> str:
-        return '\n'.join(Quasar().compile(root, QASMFormatter(), optimize))
+        return '\n'.join(self.compile(root, QASMFormatter(), optimize))
 
     def compile(
         self,
         root: ProgramLike,
         qasm_formatter,
-        optimize: bool = True
+        optimize: bool = True,
+        condition_ancillas_budget: int = 0,
+        target: Target = DEFAULT_TARGET,
+        coupling: Optional[CouplingGraph] = None,
+        optimize_window: Optional[int] = None,
+        prune: bool = False,
+        measured_qubits: Optional[List[QubitNode]] = None,
+        fold_constants: bool = False,
+        dirty_ancillas: bool = False,
+        measure_uncompute: bool = False,
+        max_qubits: Optional[int] = None,
+        recycle_qubits: bool = False,
+        define_subcircuits: bool = False
     ) -> List[str]:
+        """ With `optimize_window` set, the optimization is streamed
+        with at most that many pending commands (see `QuasarOpt.stream`).
+        The compiled commands are then optimized, lowered and emitted on the fly, unless a pass needs
+        the whole circuit (pairing the relative phase commands, `prune`, `coupling`
+        or `define_subcircuits`).
+        The compiled commands themselves are always built in full, as the number of qubits
+        has to be known before anything is emitted.
+        With `prune` set, the commands which cannot affect the measurements (and `measured_qubits`
+        measured after the circuit) are removed and the qubits and bits are renumbered densely,
+        the new numbering is available in `Quasar.compaction`.
+        With `fold_constants` set, the gates acting on qubits in known basis states are simplified.
+        With `dirty_ancillas` set, gates with too many controls borrow idle qubits instead of
+        allocating ancillas, the resulting width and gates count are available in `Quasar.ancilla_report`.
+        With `measure_uncompute` set, the condition ancillas are uncomputed by a measurement
+        and a classically controlled CZ instead of CCX gates.
+        With `max_qubits` set, the controls are reduced with the cheapest scheme that fits into
+        that many qubits (a tree of ancillas, borrowed ancillas or no ancillas at all),
+        a `ValueError` explaining the overflow is raised if the program cannot fit.
+        With `recycle_qubits` set, a qubit which is not used after its measurement is reset
+        and its id is reused by the later declarations and ancillas.
+        With `define_subcircuits` set, the repeated sequences of gates are defined once as subcircuits
+        (e.g. OpenQASM `gate` definitions) and called with their qubits as arguments,
+        a `ValueError` is raised if the formatter does not support the gate definitions. """
         root = Program(root)
-        rsrc = ResourceAllocator()
-        compile_visitor = CompileVisitor(rsrc)
+        self.routing_report: Optional[RoutingReport] = None
+        self.compaction: Optional[Compaction] = None
+        if max_qubits is not None and coupling is not None and coupling.get_num_qubits() > max_qubits:
+            raise ValueError(
+                f'The coupling graph has {coupling.get_num_qubits()} qubits, '
+                f'more than the budget of {max_qubits} qubits.'
+            )
+
+        rsrc = ResourceAllocator(max_qubits)
+        compile_visitor = CompileVisitor(
+            rsrc,
+            condition_ancillas_budget,
+            target,
+            dirty_ancillas,
+            measure_uncompute,
+            recycle_qubits
+        )
         root.accept(compile_visitor)
 
         max_used_qubit_id = compile_visitor.get_max_used_qubit_id()
         max_used_bit_id = compile_visitor.get_max_used_bit_id()
 
-        commands: List[ICommand] = compile_visitor.commands
+        commands: Iterable[ICommand] = compile_visitor.commands
+        # Collected before the streamed passes, the optimizations can only remove opaque gates
+        opaque_gates = self._get_opaque_gate_declarations(compile_visitor.commands, target, qasm_formatter)
+
+        # The relative phase commands are paired with their twins in the whole circuit by the lowering
+        streamed = (not optimize or optimize_window is not None) and not any(
+            isinstance(command, GateCmd) and command.is_relative_phase()
+            for command in flatten_repeats(compile_visitor.commands)
+        )
+        if streamed:
+            commands = self._drained(compile_visitor.commands)
+
+        if fold_constants:
+            commands = stream_constants(commands)
 
         if optimize:
-            commands = QuasarOpt.run(commands, max_used_qubit_id)
+            # The mirrored high-level commands (e.g. a pair of CCX) cancel out before they are decomposed
+            commands = self._optimized(commands, max_used_qubit_id, optimize_window)
+
+        if streamed:
+            commands = target.stream(commands)
+            if optimize:
+                # The decompositions are optimized with the gates around them
+                commands = self._optimized(commands, max_used_qubit_id, optimize_window)
+        else:
+            commands = list(commands)
+            lowered = target.lower(commands)
+            if optimize and (len(lowered) != len(commands) or any(a is not b for a, b in zip(lowered, commands))):
+                # The decompositions are optimized with the gates around them
+                commands = self._optimized(lowered, max_used_qubit_id, optimize_window)
+            else:
+                commands = lowered
+
+        if prune:
+            measured_qubit_ids = [qubit.get_id() for qubit in measured_qubits or []]
+            commands = prune_light_cone(list(commands), measured_qubit_ids)
+            commands, self.compaction = compact_registers(commands, measured_qubit_ids)
+            max_used_qubit_id = self.compaction.num_qubits
+            max_used_bit_id = self.compaction.num_bits
+
+        if coupling is not None:
+            commands, self.routing_report = QuasarRouter.run(list(commands), max_used_qubit_id, coupling)
+            max_used_qubit_id = coupling.get_num_qubits()
+
+            if optimize:
+                commands = self._optimized(commands, max_used_qubit_id, optimize_window)
 
         qasm_formatter.set_qubits_counter(max_used_qubit_id)
         qasm_formatter.set_bits_counter(max_used_bit_id)
         qasm_formatter.set_groups([max_used_qubit_id])
 
+        conditional_bit_ids = set() if rsrc.scratch_bit is None else {rsrc.scratch_bit}
+        if self.compaction is not None:
+            conditional_bit_ids = {
+                self.compaction.bit_mapping[bit_id]
+                for bit_id in conditional_bit_ids
+                if bit_id in self.compaction.bit_mapping
+            }
+        qasm_formatter.set_conditional_bits(conditional_bit_ids)
+
+        if not qasm_formatter.supports_control_state():
+            commands = stream_negative_controls(commands)
+
+        self._subcircuits: Dict[OpaqueGate, List[ICommand]] = {}
+        if define_subcircuits:
+            if not qasm_formatter.supports_gate_definitions():
+                raise ValueError(f'{type(qasm_formatter).__name__} does not support the gate definitions.')
+            commands, self._subcircuits = extract_subcircuits(list(commands), [gate.name for gate in opaque_gates])
+        # The subcircuits may use the opaque gates, so they are declared after them
+        qasm_formatter.set_opaque_gates({**opaque_gates, **self._subcircuits})
+
         headers = qasm_formatter.get_headers()
 
         code = self._commands_to_code(
@@ -88,6 +276,12 @@ class Quasar:
 
         footers = qasm_formatter.get_footers()
 
+        self.ancilla_report = AncillaReport(
+            num_qubits=max_used_qubit_id,
+            num_gates=self._num_gates,
+            max_borrowed_ancillas=rsrc.max_borrowed_qubits
+        )
+
         return headers + code + footers
 
 #
@@ -98,6 +292,14 @@ ASTNode = IASTNode
 
 Not = NotNode
 
+Qubits = Union[QubitNode, List[QubitNode]]
+
+def _gate_node(gate: BuiltinGate, qubits: Qubits, params: List[float] = None) -> IASTNode:
+    """ A gate on a list of qubits (e.g. a register) is a single broadcast node. """
+    if isinstance(qubits, list):
+        return BroadcastNode(gate, qubits, params)
+    return GateNode(gate, qubits, params)
+
 def All(qubits: Union[QubitNode, List[QubitNode]]) -> MatchNode:
     qubits = to_list(qubits)
     return MatchNode(qubits, [1]*len(qubits))
@@ -154,35 +356,35 @@ Match = MatchNode
 
 Measurement = MeasurementNode
 
+def Opaque(gate: OpaqueGate, qubits: List[QubitNode], params: List[float] = None) -> IASTNode:
+    return OpaqueGateNode(gate, qubits, params)
+
+Repeat = RepeatNode
+
 Reset = ResetNode
 
-def Phase(target_qubit: QubitNode, arg1: float) -> IASTNode:
-    return U1(target_qubit, arg1)
+def Phase(target_qubit: Qubits, arg1: float) -> IASTNode:
+    return _gate_node(P_GATE, target_qubit, [arg1])
 
 def Id(target_qubit: QubitNode) -> IASTNode:
     return U1(target_qubit, 0)
 
 Qubit = QubitNode
 
-def RX(target_qubit: QubitNode, arg1: float) -> IASTNode:
-    return U3(target_qubit, arg1, -pi/2, pi/2)
+def RX(target_qubit: Qubits, arg1: float) -> IASTNode:
+    return _gate_node(RX_GATE, target_qubit, [arg1])
 
 def CRX(control_qubit: QubitNode, target_qubit: QubitNode, arg1: float) -> IASTNode:
     return IfNode(All(control_qubit)).Then(RX(target_qubit, arg1))
 
-def RY(target_qubit: QubitNode, arg1: float) -> IASTNode:
-    return U3(target_qubit, arg1, 0, 0)
+def RY(target_qubit: Qubits, arg1: float) -> IASTNode:
+    return _gate_node(RY_GATE, target_qubit, [arg1])
 
 def CRY(control_qubit: QubitNode, target_qubit: QubitNode, arg1: float) -> IASTNode:
     return IfNode(All(control_qubit)).Then(RY(target_qubit, arg1))
 
-def RZ(target_qubit: QubitNode, arg1: float) -> Program:
-    return Program([
-        Phase(target_qubit, arg1/2),
-        X(target_qubit),
-        Phase(target_qubit, -arg1/2),
-        X(target_qubit)
-    ])
+def RZ(target_qubit: Qubits, arg1: float) -> IASTNode:
+    return _gate_node(RZ_GATE, target_qubit, [arg1])
 
 def CRZ(control_qubit: QubitNode, target_qubit: QubitNode, arg1: float) -> IASTNode:
     return IfNode(All(control_qubit)).Then(RZ(target_qubit, arg1))
@@ -198,36 +400,47 @@ def CCZ(control_qubit_1: QubitNode, control_qubit_2: QubitNode, target_qubit: Qu
         H(target_qubit)
     ])
 
-def S(target_qubit: QubitNode) -> IASTNode:
-    return Phase(target_qubit, pi/2)
+def S(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(S_GATE, target_qubit)
 
-def Sdg(target_qubit: QubitNode) -> IASTNode:
-    return Phase(target_qubit, -pi/2)
+def Sdg(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(SDG_GATE, target_qubit)
 
-def T(target_qubit: QubitNode) -> IASTNode:
-    return Phase(target_qubit, pi/4)
+def T(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(T_GATE, target_qubit)
 
-def Tdg(target_qubit: QubitNode) -> IASTNode:
-    return Phase(target_qubit, -pi/4)
+def Tdg(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(TDG_GATE, target_qubit)
 
 def Seq(*nodes) -> Program:
     return Program(list(nodes))
 
-def Swap(q1: QubitNode, q2: QubitNode) -> Program:
-    return Seq(
-        CX(q1, q2),
-        CX(q2, q1),
-        CX(q1, q2)
-    )
-
-def X(target_qubit: QubitNode) -> GateNode:
-    return GateNode(X_GATE, target_qubit)
-
-def Y(target_qubit: QubitNode) -> GateNode:
-    return GateNode(Y_GATE, target_qubit)
-
-def Z(target_qubit: QubitNode) -> GateNode:
-    return GateNode(Z_GATE, target_qubit)
-
-def H(target_qubit: QubitNode) -> GateNode:
-    return GateNode(H_GATE, target_qubit)
+# SWAP acts on two qubits, so it is an opaque gate (declared by qelib1.inc)
+# expanded into 3 CX gates only for the targets which do not support it
+SWAP_GATE = OpaqueGate(
+    'swap',
+    2,
+    inverse=self_inverse,
+    matrix=lambda params: [[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]],
+    definition=lambda qubits, params: Seq(
+        CX(qubits[0], qubits[1]),
+        CX(qubits[1], qubits[0]),
+        CX(qubits[0], qubits[1])
+    ),
+    cost=3.0
+)
+
+def Swap(q1: QubitNode, q2: QubitNode) -> IASTNode:
+    return OpaqueGateNode(SWAP_GATE, [q1, q2])
+
+def X(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(X_GATE, target_qubit)
+
+def Y(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(Y_GATE, target_qubit)
+
+def Z(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(Z_GATE, target_qubit)
+
+def H(target_qubit: Qubits) -> IASTNode:
+    return _gate_node(H_GATE, target_qubit)
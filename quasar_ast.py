@@ -24,6 +24,7 @@ from abc import abstractmethod, ABC
 from typing import Iterable, List, Optional, TypeVar, Union
 
 from builtin_gates import BuiltinGate, X_GATE
+from opaque_gates import OpaqueGate
 
 #
 ##
@@ -324,6 +325,83 @@ class GateNode(IASTNode):
         visitor.on_gate(self)
 
 
+class OpaqueGateNode(IASTNode):
+    """ This node represents an application of a user-defined opaque gate on the specified qubits. """
+
+    def __init__(self, gate: OpaqueGate, qubits: List[QubitNode], params: List[float] = None) -> None:
+        super().__init__()
+        self._gate = gate
+        self._params = params or []
+        self._qubits = qubits
+        if len(self._qubits) != gate.num_qubits or len(self._params) != gate.num_params:
+            raise ValueError(
+                f'Opaque gate {gate.name} takes {gate.num_qubits} qubits and {gate.num_params} params, '
+                f'got {len(self._qubits)} qubits and {len(self._params)} params'
+            )
+
+    @property
+    def gate(self) -> OpaqueGate:
+        return self._gate
+
+    @property
+    def params(self) -> List[float]:
+        return self._params
+
+    def get_qubits(self) -> List[QubitNode]:
+        return self._qubits
+
+    def accept(self, visitor: 'IASTVisitor') -> None:
+        visitor.on_opaque_gate(self)
+
+
+class BroadcastNode(IASTNode):
+    """ This node represents an application of a builtin gate on each of the specified qubits (e.g. a register). """
+
+    def __init__(self, gate: BuiltinGate, qubits: List[QubitNode], params: List[float] = None) -> None:
+        super().__init__()
+        self._gate = gate
+        self._params = params or []
+        self._qubits = qubits
+        assert len(self.params) == gate.num_params
+        if len({id(qubit) for qubit in self._qubits}) != len(self._qubits):
+            raise ValueError(f'Gate {gate.name} cannot be applied twice to the same qubit at once')
+
+    @property
+    def gate(self) -> BuiltinGate:
+        return self._gate
+
+    @property
+    def params(self) -> List[float]:
+        return self._params
+
+    def get_qubits(self) -> List[QubitNode]:
+        return self._qubits
+
+    def accept(self, visitor: 'IASTVisitor') -> None:
+        visitor.on_broadcast(self)
+
+
+class RepeatNode(IASTNode):
+    """ This node represents `count` consecutive applications of its body. """
+
+    def __init__(self, count: int, body: ProgramLike) -> None:
+        super().__init__()
+        if count < 0:
+            raise ValueError(f'The body cannot be repeated a negative number of times, got {count}')
+        self._count = count
+        self._body : Program = Program(body)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def get_body(self) -> Program:
+        return self._body
+
+    def accept(self, visitor: 'IASTVisitor') -> None:
+        visitor.on_repeat(self)
+
+
 class MatchNode(ConditionNode):
     def __init__(self, control_qubits: Union[QubitNode, List[QubitNode]], mask: List[int]) -> None:
         super().__init__()
@@ -416,6 +494,9 @@ class IASTVisitor:
     def on_inv(self, inv: InvNode) -> None:
         inv.get_body().accept(self)
 
+    def on_repeat(self, repeat: RepeatNode) -> None:
+        repeat.get_body().accept(self)
+
     def on_if_then_else(self, if_then_else: IfThenElseNode) -> None:
         if_then_else.get_condition().accept(self)
         if_then_else.get_then_body().accept(self)
@@ -431,6 +512,12 @@ class IASTVisitor:
     def on_gate(self, node: GateNode) -> None:
         pass
 
+    def on_opaque_gate(self, node: OpaqueGateNode) -> None:
+        pass
+
+    def on_broadcast(self, node: BroadcastNode) -> None:
+        pass
+
     def on_match(self, match: MatchNode) -> None:
         pass
 
@@ -21,9 +21,10 @@
 #
 
 from abc import abstractmethod, ABC
-from typing import List, Optional, Set
+from typing import Dict, Iterator, List, Optional, Set
 
 from builtin_gates import BuiltinGate, builtin_repr
+from opaque_gates import OpaqueGate
 from quasar_formatter import IQAsmFormatter
 
 #
@@ -48,6 +49,20 @@ class ICommand(ICmdVisitable):
     def get_target_qubit_id(self) -> int:
         pass
 
+    @abstractmethod
+    def get_qubit_ids(self) -> Set[int]:
+        """ Returns ids of all the qubits the command acts on. """
+        pass
+
+    @abstractmethod
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'ICommand':
+        """ Returns a copy of the command acting on `qubit_mapping[id]` instead of `id`. """
+        pass
+
+    def get_bit_ids(self) -> Set[int]:
+        """ Returns ids of all the classical bits the command writes or reads. """
+        return set()
+
 
 class GateCmd(ICommand):
     def __init__(
@@ -56,17 +71,27 @@ class GateCmd(ICommand):
         target_qubit_id: int,
         control_qubit_ids: Set[int] = None,
         params: List[float] = None,
+        relative_phase: bool = False,
+        negative_control_qubit_ids: Set[int] = None,
     ) -> None:
+        """ `relative_phase` marks a gate which may be replaced by its relative phase
+        variant, as it is undone later by its mirrored twin (e.g. a CCX computing an ancilla).
+        `negative_control_qubit_ids` are the control qubits which control on |0> instead of |1>. """
         self._gate = gate
         self._target_qubit_id = target_qubit_id
         self._params = params or []
         self._control_qubit_ids = control_qubit_ids or set()
+        self._relative_phase = relative_phase
+        self._negative_control_qubit_ids = negative_control_qubit_ids or set()
+        assert self._negative_control_qubit_ids <= self._control_qubit_ids
 
     def __eq__(self, other):
         if not isinstance(other, GateCmd):
             return False
-        return (self._gate, self._target_qubit_id, self._params, self._control_qubit_ids) \
-            == (other._gate, other._target_qubit_id, other._params, other._control_qubit_ids)
+        return (self._gate, self._target_qubit_id, self._params, self._control_qubit_ids,
+                self._negative_control_qubit_ids) \
+            == (other._gate, other._target_qubit_id, other._params, other._control_qubit_ids,
+                other._negative_control_qubit_ids)
 
     @property
     def gate(self) -> BuiltinGate:
@@ -78,7 +103,34 @@ class GateCmd(ICommand):
     def get_control_qubit_ids(self) -> Set[int]:
         return self._control_qubit_ids
 
+    def get_negative_control_qubit_ids(self) -> Set[int]:
+        return self._negative_control_qubit_ids
+
+    def is_relative_phase(self) -> bool:
+        return self._relative_phase
+
+    def get_qubit_ids(self) -> Set[int]:
+        return self._control_qubit_ids | {self._target_qubit_id}
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'GateCmd':
+        return GateCmd(
+            self._gate,
+            qubit_mapping[self._target_qubit_id],
+            {qubit_mapping[qubit_id] for qubit_id in self._control_qubit_ids},
+            self._params,
+            self._relative_phase,
+            {qubit_mapping[qubit_id] for qubit_id in self._negative_control_qubit_ids}
+        )
+
     def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
+        if self._negative_control_qubit_ids:
+            return qasm_formatter.gate_with_control_state(
+                self._gate,
+                self._target_qubit_id,
+                self._params,
+                self._control_qubit_ids,
+                self._negative_control_qubit_ids
+            )
         return [qasm_formatter.gate(self._gate, self._target_qubit_id, self._params, self._control_qubit_ids)]
 
     def accept(self, visitor: 'ICmdVisitor') -> None:
@@ -91,10 +143,206 @@ class GateCmd(ICommand):
         if self._params:
             if not self._control_qubit_ids:
                 s += f', set()'
+        if self._negative_control_qubit_ids:
+            s += f', negative_control_qubit_ids={repr(self._negative_control_qubit_ids)}'
         s += ')'
         return s
 
 
+class OpaqueGateCmd(ICommand):
+    """ Application of a user-defined opaque gate on the `qubit_ids` (in the order of its arguments). """
+
+    def __init__(
+        self,
+        gate: OpaqueGate,
+        qubit_ids: List[int],
+        params: List[float] = None
+    ) -> None:
+        self._gate = gate
+        self._qubit_ids = list(qubit_ids)
+        self._params = params or []
+        assert len(self._qubit_ids) == gate.num_qubits and len(set(self._qubit_ids)) == gate.num_qubits
+        assert len(self._params) == gate.num_params
+
+    def __eq__(self, other):
+        if not isinstance(other, OpaqueGateCmd):
+            return False
+        return (self._gate, self._qubit_ids, self._params) == (other._gate, other._qubit_ids, other._params)
+
+    @property
+    def gate(self) -> OpaqueGate:
+        return self._gate
+
+    @property
+    def params(self) -> List[float]:
+        return self._params
+
+    def get_target_qubit_id(self) -> int:
+        return self._qubit_ids[-1]
+
+    def get_ordered_qubit_ids(self) -> List[int]:
+        return self._qubit_ids
+
+    def get_qubit_ids(self) -> Set[int]:
+        return set(self._qubit_ids)
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'OpaqueGateCmd':
+        return OpaqueGateCmd(self._gate, [qubit_mapping[qubit_id] for qubit_id in self._qubit_ids], self._params)
+
+    def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
+        return [qasm_formatter.opaque_gate(self._gate, self._qubit_ids, self._params)]
+
+    def accept(self, visitor: 'ICmdVisitor') -> None:
+        visitor.on_opaque_gate(self)
+
+    def __repr__(self):
+        s = f'OpaqueGateCmd({self._gate.name}, {self._qubit_ids!r}'
+        if self._params:
+            s += f', {self._params!r}'
+        s += ')'
+        return s
+
+
+class BroadcastCmd(ICommand):
+    """ Application of an uncontrolled builtin gate on each of the `qubit_ids` (a register-level operation).
+    It is equal to the `expanded` gates, but it is compiled, optimized and emitted as one command. """
+
+    def __init__(
+        self,
+        gate: BuiltinGate,
+        qubit_ids: List[int],
+        params: List[float] = None
+    ) -> None:
+        self._gate = gate
+        self._qubit_ids = list(qubit_ids)
+        self._params = params or []
+        assert len(set(self._qubit_ids)) == len(self._qubit_ids)
+        assert len(self._params) == gate.num_params
+
+    def __eq__(self, other):
+        if not isinstance(other, BroadcastCmd):
+            return False
+        return (self._gate, self._qubit_ids, self._params) == (other._gate, other._qubit_ids, other._params)
+
+    @property
+    def gate(self) -> BuiltinGate:
+        return self._gate
+
+    @property
+    def params(self) -> List[float]:
+        return self._params
+
+    def get_target_qubit_id(self) -> int:
+        return self._qubit_ids[-1]
+
+    def get_ordered_qubit_ids(self) -> List[int]:
+        return self._qubit_ids
+
+    def get_qubit_ids(self) -> Set[int]:
+        return set(self._qubit_ids)
+
+    def expanded(self) -> List[GateCmd]:
+        return [GateCmd(self._gate, qubit_id, params=self._params) for qubit_id in self._qubit_ids]
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'BroadcastCmd':
+        return BroadcastCmd(self._gate, [qubit_mapping[qubit_id] for qubit_id in self._qubit_ids], self._params)
+
+    def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
+        return qasm_formatter.broadcast(self._gate, self._qubit_ids, self._params)
+
+    def accept(self, visitor: 'ICmdVisitor') -> None:
+        visitor.on_broadcast(self)
+
+    def __repr__(self):
+        s = f'BroadcastCmd({builtin_repr(self._gate)}, {self._qubit_ids!r}'
+        if self._params:
+            s += f', {self._params!r}'
+        s += ')'
+        return s
+
+
+def expand_broadcasts(commands: List[ICommand]) -> List[ICommand]:
+    """ Replaces the broadcasts with their gates, for the passes working qubit by qubit. """
+    result: List[ICommand] = []
+    for command in commands:
+        if isinstance(command, BroadcastCmd):
+            result.extend(command.expanded())
+        else:
+            result.append(command)
+    return result
+
+
+class RepeatCmd(ICommand):
+    """ `count` consecutive applications of the `body` commands. The body is compiled, lowered
+    and optimized once, it is expanded only by the passes (and formatters) which need the copies. """
+
+    def __init__(
+        self,
+        count: int,
+        body: List[ICommand]
+    ) -> None:
+        self._count = count
+        self._body = list(body)
+        assert count >= 0 and self._body
+
+    def __eq__(self, other):
+        if not isinstance(other, RepeatCmd):
+            return False
+        return (self._count, self._body) == (other._count, other._body)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def body(self) -> List[ICommand]:
+        return self._body
+
+    def get_target_qubit_id(self) -> int:
+        return self._body[-1].get_target_qubit_id()
+
+    def get_qubit_ids(self) -> Set[int]:
+        return set().union(*(command.get_qubit_ids() for command in self._body))
+
+    def get_bit_ids(self) -> Set[int]:
+        return set().union(*(command.get_bit_ids() for command in self._body))
+
+    def expanded(self) -> List[ICommand]:
+        return self._count * expand_repeats(self._body)
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'RepeatCmd':
+        return RepeatCmd(self._count, [command.remapped(qubit_mapping) for command in self._body])
+
+    def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
+        return qasm_formatter.repeat(self._count, self._body)
+
+    def accept(self, visitor: 'ICmdVisitor') -> None:
+        visitor.on_repeat(self)
+
+    def __repr__(self):
+        return f'RepeatCmd({self._count}, {self._body!r})'
+
+
+def expand_repeats(commands: List[ICommand]) -> List[ICommand]:
+    """ Replaces the repeats with the copies of their bodies, for the passes which cannot keep them folded. """
+    result: List[ICommand] = []
+    for command in commands:
+        if isinstance(command, RepeatCmd):
+            result.extend(command.expanded())
+        else:
+            result.append(command)
+    return result
+
+
+def flatten_repeats(commands: List[ICommand]) -> Iterator[ICommand]:
+    """ Yields the commands with the repeats replaced by their bodies (once, not `count` times). """
+    for command in commands:
+        if isinstance(command, RepeatCmd):
+            yield from flatten_repeats(command.body)
+        else:
+            yield command
+
+
 class MeasurementCmd(ICommand):
     def __init__(
         self,
@@ -110,6 +358,15 @@ class MeasurementCmd(ICommand):
     def get_target_bit_id(self) -> int:
         return self._bit_id
 
+    def get_qubit_ids(self) -> Set[int]:
+        return {self._qubit_id}
+
+    def get_bit_ids(self) -> Set[int]:
+        return {self._bit_id}
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'MeasurementCmd':
+        return MeasurementCmd(qubit_mapping[self._qubit_id], self._bit_id)
+
     def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
         return [
             qasm_formatter.measure(self._qubit_id, self._bit_id)
@@ -129,6 +386,12 @@ class ResetCmd(ICommand):
     def get_target_qubit_id(self) -> int:
         return self._qubit_id
 
+    def get_qubit_ids(self) -> Set[int]:
+        return {self._qubit_id}
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'ResetCmd':
+        return ResetCmd(qubit_mapping[self._qubit_id])
+
     def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
         lines = qasm_formatter.reset(self._qubit_id).split('\n')
         return [line for line in lines]
@@ -136,6 +399,51 @@ class ResetCmd(ICommand):
     def accept(self, visitor: 'ICmdVisitor') -> None:
         visitor.on_reset(self)
 
+
+class ClassicalIfCmd(ICommand):
+    """ Gate applied only if the classical bit `bit_id` (set by a measurement) is 1. """
+
+    def __init__(
+        self,
+        bit_id: int,
+        command: GateCmd
+    ) -> None:
+        self._bit_id = bit_id
+        self._command = command
+
+    def __eq__(self, other):
+        if not isinstance(other, ClassicalIfCmd):
+            return False
+        return (self._bit_id, self._command) == (other._bit_id, other._command)
+
+    @property
+    def command(self) -> GateCmd:
+        return self._command
+
+    def get_bit_id(self) -> int:
+        return self._bit_id
+
+    def get_target_qubit_id(self) -> int:
+        return self._command.get_target_qubit_id()
+
+    def get_qubit_ids(self) -> Set[int]:
+        return self._command.get_qubit_ids()
+
+    def get_bit_ids(self) -> Set[int]:
+        return {self._bit_id}
+
+    def remapped(self, qubit_mapping: Dict[int, int]) -> 'ClassicalIfCmd':
+        return ClassicalIfCmd(self._bit_id, self._command.remapped(qubit_mapping))
+
+    def get_lines(self, qasm_formatter: IQAsmFormatter) -> List[str]:
+        return [qasm_formatter.classical_if(self._bit_id, line) for line in self._command.get_lines(qasm_formatter)]
+
+    def accept(self, visitor: 'ICmdVisitor') -> None:
+        visitor.on_classical_if(self)
+
+    def __repr__(self):
+        return f'ClassicalIfCmd({self._bit_id}, {self._command!r})'
+
 #
 ##
 #
@@ -150,6 +458,20 @@ class ICmdVisitor(ABC):
     def on_gate(self, cmd: GateCmd) -> None:
         pass
 
+    @abstractmethod
+    def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+        pass
+
+    def on_broadcast(self, cmd: BroadcastCmd) -> None:
+        """ A broadcast is visited gate by gate, unless a visitor handles it as a whole. """
+        for command in cmd.expanded():
+            command.accept(self)
+
+    def on_repeat(self, cmd: RepeatCmd) -> None:
+        """ A repeat is visited copy by copy, unless a visitor handles it as a whole. """
+        for command in cmd.expanded():
+            command.accept(self)
+
     @abstractmethod
     def on_measurement(self, m: MeasurementCmd) -> None:
         pass
@@ -157,3 +479,7 @@ class ICmdVisitor(ABC):
     @abstractmethod
     def on_reset(self, reset: ResetCmd) -> None:
         pass
+
+    @abstractmethod
+    def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+        pass
@@ -21,29 +21,172 @@
 #
 
 
+from bisect import insort
+from collections import Counter
 from copy import copy
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 from builtin_arithmetics import invert_gate
-from builtin_gates import X_GATE, Z_GATE
+from builtin_gates import H_GATE, X_GATE, Z_GATE
 from quasar_ast import \
     QubitNode, QubitDeclarationNode, CBitNode, InvNode, IASTVisitor, Program, \
     IfThenNode, IfThenElseNode, IfFlipNode, \
-    MatchNode, NotNode, \
-    MeasurementNode, ResetNode, IASTVisitable, GateNode, to_list
+    MatchNode, NotNode, ConditionNode, \
+    MeasurementNode, ResetNode, IASTNode, IASTVisitable, GateNode, OpaqueGateNode, BroadcastNode, RepeatNode, to_list
 from quasar_cmd import \
-    ICommand, MeasurementCmd, ResetCmd, GateCmd
+    ICommand, MeasurementCmd, ResetCmd, GateCmd, OpaqueGateCmd, BroadcastCmd, RepeatCmd, ClassicalIfCmd
+from quasar_mcx import get_ancilla_free_mcu_commands, get_dirty_mcx_commands, get_num_dirty_ancillas
+from quasar_target import DEFAULT_TARGET, Target, get_u3_phase_and_params, to_u3_params
 
 # Mapping from control qubit id onto (0, 1)
 # where 1 means positive control and 0 -- negative.
 _ControlQubits = Dict[int, Union[int, int]]
 
+# Structural identity of a condition, built from `QubitNode` objects
+# (their ids are not known until the declarations are compiled).
+_ConditionKey = Tuple
+
+
+def _get_condition_key(condition: ConditionNode) -> Optional[_ConditionKey]:
+    if isinstance(condition, MatchNode):
+        return ('match', frozenset(zip(condition.get_control_qubits(), condition.get_mask())))
+    if isinstance(condition, NotNode):
+        key = _get_condition_key(condition.get_condition())
+        return None if key is None else ('not', key)
+    return None
+
+
+def _get_condition_qubits(key: _ConditionKey) -> List[QubitNode]:
+    if key[0] == 'not':
+        return _get_condition_qubits(key[1])
+    return [qubit for (qubit, _) in key[1]]
+
+
+def _get_written_qubit_ids(commands: List[ICommand]) -> Set[int]:
+    """ Returns ids of qubits whose basis state may be changed by `commands`.
+    A qubit that is only a target of an even number of uncontrolled X gates
+    (e.g. negated control) is restored, so it is not considered as written. """
+    written: Set[int] = set()
+    flipped: Set[int] = set()
+
+    for command in commands:
+        if isinstance(command, GateCmd) and command.gate == X_GATE and not command.get_control_qubit_ids():
+            flipped ^= {command.get_target_qubit_id()}
+        elif isinstance(command, BroadcastCmd) and command.gate == X_GATE:
+            flipped ^= command.get_qubit_ids()
+        elif isinstance(command, (OpaqueGateCmd, BroadcastCmd, RepeatCmd)):
+            written |= command.get_qubit_ids()
+        else:
+            written.add(command.get_target_qubit_id())
+
+    return written | flipped
+
+
+def _flatten(program: Program) -> Iterator[IASTNode]:
+    for node in program._nodes:
+        if isinstance(node, Program):
+            yield from _flatten(node)
+        else:
+            yield node
+
+
+def _reversed(program: Program) -> Iterator[IASTNode]:
+    """ Yields the nodes of `program` run backwards. The declarations keep their order and come first,
+    so the qubits and bits are allocated before they are used. """
+    declarations = (QubitDeclarationNode, CBitNode)
+    nodes = list(_flatten(program))
+    yield from (node for node in nodes if isinstance(node, declarations))
+    yield from (node for node in reversed(nodes) if not isinstance(node, declarations))
+
+
+class _QubitsCollector(IASTVisitor):
+    """ Collects all the qubits a node refers to (in conditions, bodies, gates and measurements). """
 
-class ResourceAllocator:
     def __init__(self) -> None:
-        self.min_unused_qubit_id = 0 # the first currently available to use qubit id
+        self.qubits: List[QubitNode] = []
+
+    def on_qubit(self, qubit: QubitNode) -> None:
+        self.qubits.append(qubit)
+
+    def on_gate(self, node: GateNode) -> None:
+        self.qubits.append(node.get_target_qubit())
+
+    def on_opaque_gate(self, node: OpaqueGateNode) -> None:
+        self.qubits.extend(node.get_qubits())
+
+    def on_broadcast(self, node: BroadcastNode) -> None:
+        self.qubits.extend(node.get_qubits())
+
+    def on_match(self, match: MatchNode) -> None:
+        self.qubits.extend(match.get_control_qubits())
+
+    def on_measure(self, measure: MeasurementNode) -> None:
+        self.qubits.append(measure.get_qubit())
+
+    def on_reset(self, reset: ResetNode) -> None:
+        self.qubits.append(reset.get_qubit())
+
+
+class _WrittenQubitsCollector(_QubitsCollector):
+    """ Collects the qubits whose basis state a node may change (the conditions are only read). """
+
+    def on_qubit(self, qubit: QubitNode) -> None:
+        pass
+
+    def on_match(self, match: MatchNode) -> None:
+        pass
+
+    def on_if_flip(self, if_flip: IfFlipNode) -> None:
+        collector = _QubitsCollector()
+        if_flip.get_condition().accept(collector)
+        self.qubits.extend(collector.qubits)
+
+
+def _get_recyclable_qubits(nodes: List[IASTNode]) -> Dict[int, QubitNode]:
+    """ Maps the index of a measurement onto the measured qubit, if the qubit is never used after it. """
+    last_uses: Dict[int, int] = {}
+
+    for (index, node) in enumerate(nodes):
+        collector = _QubitsCollector()
+        node.accept(collector)
+        for qubit in collector.qubits:
+            last_uses[id(qubit)] = index
+
+    return {
+        index: node.get_qubit()
+        for (index, node) in enumerate(nodes)
+        if isinstance(node, MeasurementNode) and last_uses[id(node.get_qubit())] == index
+    }
+
+
+class _LiveCondition:
+    """ A condition computed into ancillas which is kept alive across sibling statements. """
+
+    def __init__(
+        self,
+        key: _ConditionKey,
+        support: Set[int],
+        control_mapping: _ControlQubits,
+        commands: List[ICommand],
+        num_ancillas: int
+    ) -> None:
+        self.key = key
+        self.support = support
+        self.control_mapping = control_mapping
+        self.commands = commands
+        self.num_ancillas = num_ancillas
+
+
+class ResourceAllocator:
+    def __init__(self, max_qubits: Optional[int] = None) -> None:
+        self.max_qubits = max_qubits # the maximal number of qubits in use at once, None means no limit
+        self.min_unused_qubit_id = 0 # the first qubit id above all the qubits in use
+        self.free_qubit_ids: List[int] = [] # the recycled qubit ids below `min_unused_qubit_id`
+        self.allocated_qubit_ids: List[int] = [] # the stack of qubit ids in use
         self.qubits_counter = 0 # the first qubit id that is never used up to the current moment
         self.bits_counter = 0 # the first bit id that is never used up to the current moment
+        self.max_borrowed_qubits = 0 # the maximal number of qubits borrowed at once as dirty ancillas
+        self.scratch_bit: Optional[int] = None # the bit for mid-circuit measurements of ancillas
 
     def get_qubits_counter(self) -> int:
         return self.qubits_counter
@@ -54,28 +197,107 @@ class ResourceAllocator:
     def get_bits_counter(self) -> int:
         return self.bits_counter
 
+    def get_num_used_qubits(self) -> int:
+        return len(self.allocated_qubit_ids)
+
+    def can_allocate_qubits(self, num_qubits: int) -> bool:
+        return self.max_qubits is None or self.get_num_used_qubits() + num_qubits <= self.max_qubits
+
     def allocate_qubit(self) -> int:
-        self.min_unused_qubit_id += 1
-        self.qubits_counter = max(self.qubits_counter, self.min_unused_qubit_id)
-        return self.min_unused_qubit_id - 1
+        """ Returns the lowest recycled qubit id, if any, or a new one. """
+        if not self.can_allocate_qubits(1):
+            raise ValueError(f'Cannot allocate more than {self.max_qubits} qubits.')
+
+        if self.free_qubit_ids:
+            qubit_id = self.free_qubit_ids.pop(0)
+        else:
+            qubit_id = self.min_unused_qubit_id
+            self.min_unused_qubit_id += 1
+            self.qubits_counter = max(self.qubits_counter, self.min_unused_qubit_id)
+
+        self.allocated_qubit_ids.append(qubit_id)
+        return qubit_id
 
     def free_qubit(self) -> None:
-        self.min_unused_qubit_id -= 1
+        """ Frees the most recently allocated qubit. """
+        self._release(self.allocated_qubit_ids.pop())
+
+    def recycle_qubit(self, qubit_id: int) -> None:
+        """ Returns a qubit (in the state 0) which is not used anymore to the pool. """
+        self.allocated_qubit_ids.remove(qubit_id)
+        self._release(qubit_id)
+
+    def _release(self, qubit_id: int) -> None:
+        insort(self.free_qubit_ids, qubit_id)
+        while self.free_qubit_ids and self.free_qubit_ids[-1] == self.min_unused_qubit_id - 1:
+            self.free_qubit_ids.pop()
+            self.min_unused_qubit_id -= 1
 
     def free_qubits(self, qubits) -> None:
         for _ in range(qubits):
             self.free_qubit()
 
+    def borrow_qubits(self, num_qubits: int, busy_qubit_ids: Set[int]) -> List[int]:
+        """ Returns up to `num_qubits` allocated qubits (in any state) not in `busy_qubit_ids`.
+        They have to be restored before they are used again. """
+        qubit_ids = [qubit_id for qubit_id in range(self.min_unused_qubit_id) if qubit_id not in busy_qubit_ids]
+        qubit_ids = qubit_ids[:num_qubits]
+        self.max_borrowed_qubits = max(self.max_borrowed_qubits, len(qubit_ids))
+        return qubit_ids
+
     def allocate_bit(self) -> int:
         self.bits_counter += 1
         return self.bits_counter - 1
 
+    def get_scratch_bit(self) -> int:
+        """ Returns the bit (allocated once) for measurements which are used right away. """
+        if self.scratch_bit is None:
+            self.scratch_bit = self.allocate_bit()
+        return self.scratch_bit
+
 
 class CompileVisitor(IASTVisitor):
-    def __init__(self, rsrc) -> None:
+    def __init__(
+        self,
+        rsrc,
+        condition_ancillas_budget: int = 0,
+        target: Target = DEFAULT_TARGET,
+        dirty_ancillas: bool = False,
+        measure_uncompute: bool = False,
+        recycle_qubits: bool = False
+    ) -> None:
+        """ `condition_ancillas_budget` is the maximal number of ancillas that may be
+        kept alive to share a computed condition among sibling `If(...).Then(...)` statements.
+        The default 0 disables the sharing.
+        `target` defines how many control qubits a gate may have.
+        `dirty_ancillas` makes gates with too many controls borrow idle qubits as ancillas
+        instead of allocating new ones (at the cost of more gates).
+        `measure_uncompute` makes the AND ancillas uncomputed with a measurement in the X basis,
+        a classically controlled CZ and a reset (instead of CCX gates).
+        `recycle_qubits` makes the top-level program reset the qubits which are not used after
+        their measurement and reuse them for later declarations and ancillas. """
         self._rsrc = rsrc
+        self._condition_ancillas_budget = condition_ancillas_budget
+        self._target = target
+        self._dirty_ancillas = dirty_ancillas
+        self._measure_uncompute = measure_uncompute
+        self._recycle_qubits = recycle_qubits
         self._commands: List[ICommand] = []
         self._control_mapping: _ControlQubits = {} # The dict of currently controlling qubits
+        self._inverted = False # Inside an odd number of `Inv` nodes
+
+    def _spawn(self) -> 'CompileVisitor':
+        """ Creates a visitor with the same settings (except `recycle_qubits`,
+        the qubits are recycled by the top-level program only) and no controlling qubits. """
+        visitor = CompileVisitor(
+            self._rsrc,
+            self._condition_ancillas_budget,
+            self._target,
+            self._dirty_ancillas,
+            self._measure_uncompute
+        )
+        visitor._inverted = self._inverted
+        return visitor
 
     @staticmethod
     def _invert_control_qubits(control_qubits: _ControlQubits) -> _ControlQubits:
@@ -86,7 +308,8 @@ class CompileVisitor(IASTVisitor):
     def _get_reduced_commands(
         max_num_qubits,
         control_mapping,
-        rsrc
+        rsrc,
+        dirty_ancillas: bool = False
     ) -> List[ICommand]:
         """ Ensures that the number of control qubits is at most one.
         This is usually required when the condition is going to be negated. """
@@ -96,7 +319,8 @@ class CompileVisitor(IASTVisitor):
         control_qubit_ids, cccu_commands = CompileVisitor._get_cccu_commands(
             control_mapping,
             rsrc,
-            max_num_qubits
+            max_num_qubits,
+            dirty_ancillas
         )
 
         control_mapping.clear()
@@ -120,34 +344,58 @@ class CompileVisitor(IASTVisitor):
     def _get_cccu_commands(
         control_mapping: _ControlQubits,
         rsrc: ResourceAllocator,
-        max_num_qubits: int
+        max_num_qubits: int,
+        dirty_ancillas: bool = False
     ) -> Tuple[_ControlQubits, List[ICommand]]:
         """
         Builds a circuit that computes the AND condition on the `control_mapping`
         qubits (some possibly negated) into one qubit.
         To acheive this, when the number of control bits is greater than `max_num_qubits`,
         an `ancilla_allocator` may be used to allocate extra qubits.
-        The resulting computation consists of X gates (for negation) and CCX gates to
-        construct a computation tree. This tree has a logarithmic depth.
+        The resulting computation consists of CCX gates (with negative controls where needed)
+        to construct a computation tree. This tree has a logarithmic depth.
+        The CCX gates are marked as relative phase ones, as the tree is always uncomputed.
+        With `dirty_ancillas` (or when the tree does not fit into `rsrc.max_qubits`) the AND
+        is computed into one ancilla with a V-chain of CCX gates borrowing idle qubits instead.
         Returns a tuple consisting of a new control qubits dict and the computation commands.
         """
 
         commands: List[ICommand] = []
-
-        for (qubit_id, is_positive) in control_mapping.items():
-            if is_positive == 0:
-                commands.append(GateCmd(X_GATE, qubit_id))
-
         control_qubit_ids = list(control_mapping)
+        negative_qubit_ids = {qubit_id for (qubit_id, mask) in control_mapping.items() if mask == 0}
+        num_tree_ancillas = len(control_qubit_ids) - max_num_qubits
+
+        if num_tree_ancillas > 0 and not (dirty_ancillas or rsrc.can_allocate_qubits(num_tree_ancillas)):
+            dirty_ancillas = True
+            if not rsrc.can_allocate_qubits(1):
+                raise ValueError(
+                    f'Computing a condition on {len(control_qubit_ids)} qubits requires an ancilla, '
+                    f'but all {rsrc.max_qubits} qubits are in use.'
+                )
+
+        if dirty_ancillas and 1 <= max_num_qubits < len(control_qubit_ids):
+            # The borrowed ancillas decomposition supports only positive controls
+            commands.extend(
+                GateCmd(X_GATE, qubit_id) for qubit_id in control_qubit_ids if qubit_id in negative_qubit_ids
+            )
+            ancilla = rsrc.allocate_qubit()
+            commands.extend(CompileVisitor._get_dirty_mcx_commands(control_qubit_ids, ancilla, rsrc))
+            return {ancilla: 1}, commands
 
         while len(control_qubit_ids) > max_num_qubits:
             q1 = control_qubit_ids.pop(0)
             q2 = control_qubit_ids.pop(0)
             q3 = rsrc.allocate_qubit()
-            commands.append(GateCmd(X_GATE, q3, control_qubit_ids={q1, q2}))
+            commands.append(GateCmd(
+                X_GATE,
+                q3,
+                control_qubit_ids={q1, q2},
+                relative_phase=True,
+                negative_control_qubit_ids={q1, q2} & negative_qubit_ids
+            ))
             control_qubit_ids.append(q3)
 
-        return {q: 1 for q in control_qubit_ids}, commands
+        return {q: 0 if q in negative_qubit_ids else 1 for q in control_qubit_ids}, commands
 
     @property
     def commands(self) -> List[ICommand]:
@@ -169,14 +417,200 @@ class CompileVisitor(IASTVisitor):
         in addition to the currently set."""
 
         with_controls = with_controls or {}
-        subvisitor = CompileVisitor(self._rsrc)
+        subvisitor = self._spawn()
         subvisitor._control_mapping = copy(self._control_mapping)
         assert not (set(with_controls) & set(subvisitor._control_mapping))
         subvisitor._control_mapping.update(with_controls)
         visitable.accept(subvisitor)
         return subvisitor._commands
 
+    def _recycle(self, qubit: QubitNode, resets: List[ICommand]) -> None:
+        resets.append(ResetCmd(qubit.get_id()))
+        self._commands.append(resets[-1])
+        self._rsrc.recycle_qubit(qubit.get_id())
+
+    def _remove_unused_resets(self, resets: List[ICommand]) -> None:
+        """ Removes the recycling resets of qubits which are not reused after them. """
+        reset_ids = {id(reset) for reset in resets}
+        used: Set[int] = set()
+        commands: List[ICommand] = []
+
+        for command in self._commands[::-1]:
+            if id(command) in reset_ids and not command.get_qubit_ids() & used:
+                continue
+            used |= command.get_qubit_ids()
+            commands.append(command)
+
+        self._commands = commands[::-1]
+
+    def on_program(self, program: Program) -> None:
+        if self._inverted:
+            nodes = list(_reversed(program))
+        elif self._condition_ancillas_budget <= 0 and not self._recycle_qubits:
+            super().on_program(program)
+            return
+        else:
+            nodes = list(_flatten(program))
+
+        recyclable = _get_recyclable_qubits(nodes) if self._recycle_qubits and not self._inverted else {}
+        resets: List[ICommand] = []
+
+        if self._condition_ancillas_budget <= 0:
+            for (index, node) in enumerate(nodes):
+                node.accept(self)
+                if index in recyclable:
+                    self._recycle(recyclable[index], resets)
+            self._remove_unused_resets(resets)
+            return
+
+        keys = [
+            _get_condition_key(node.get_condition()) if isinstance(node, IfThenNode) else None
+            for node in nodes
+        ]
+        counts = Counter(key for key in keys if key is not None)
+        live: List[_LiveCondition] = []
+
+        for (index, (node, key)) in enumerate(zip(nodes, keys)):
+            if isinstance(node, QubitDeclarationNode):
+                # Declared qubits are never freed, so they cannot be placed above live ancillas
+                self._commands.extend(self._release_conditions(live, 0))
+                node.accept(self)
+
+            elif key is not None and (counts[key] > 1 or any(entry.key == key for entry in live)) \
+                    and self._on_shared_if_then(node, key, live):
+                pass
+
+            else:
+                start = len(self._commands)
+                node.accept(self)
+                invalidated_index = self._get_invalidated_index(live, self._commands[start:])
+                self._commands[start:start] = self._release_conditions(live, invalidated_index)
+
+            if key is not None:
+                # The conditions are released as soon as they are not used anymore
+                counts[key] -= 1
+                self._commands.extend(self._release_conditions(live, self._get_used_index(live, counts)))
+
+            if index in recyclable:
+                self._recycle(recyclable[index], resets)
+
+        self._commands.extend(self._release_conditions(live, 0))
+        self._remove_unused_resets(resets)
+
+    @staticmethod
+    def _get_invalidated_index(live: List[_LiveCondition], commands: List[ICommand]) -> int:
+        """ Returns the index of the first live condition that does not hold after `commands`. """
+        written = _get_written_qubit_ids(commands)
+
+        for (index, entry) in enumerate(live):
+            if entry.support & written:
+                return index
+
+        return len(live)
+
+    @staticmethod
+    def _get_used_index(live: List[_LiveCondition], counts: Dict[_ConditionKey, int]) -> int:
+        """ Returns the index past the last live condition that is used by the remaining statements. """
+        index = len(live)
+
+        while index > 0 and counts[live[index - 1].key] == 0:
+            index -= 1
+
+        return index
+
+    def _release_conditions(self, live: List[_LiveCondition], index: int) -> List[ICommand]:
+        """ Uncomputes live conditions starting from `index`, in the reversed order of allocation. """
+        commands: List[ICommand] = []
+
+        while len(live) > index:
+            entry = live.pop()
+            commands.extend(self._uncomputed(entry.commands))
+            self._rsrc.free_qubits(entry.num_ancillas)
+
+        return commands
+
+    def _compute_shared_condition(
+        self,
+        condition: ConditionNode,
+        key: _ConditionKey,
+        live: List[_LiveCondition]
+    ) -> Optional[_LiveCondition]:
+        """ Computes the condition into a single control qubit leaving the condition qubits intact.
+        Returns None if it does not need ancillas or does not fit into the budget. """
+        qubits_counter = self._rsrc.get_num_used_qubits()
+        cvis = self._spawn()
+        condition.accept(cvis)
+        commands = cvis._commands
+        control_mapping = cvis._control_mapping
+
+        if len(control_mapping) > 1 and not self._rsrc.can_allocate_qubits(1):
+            # Keeping the condition alive would leave no room for the body
+            self._rsrc.free_qubits(self._rsrc.get_num_used_qubits() - qubits_counter)
+            return None
+
+        if len(control_mapping) > 1:
+            control_mapping, cccu_commands = CompileVisitor._get_cccu_commands(
+                control_mapping,
+                self._rsrc,
+                max_num_qubits=1,
+                dirty_ancillas=self._dirty_ancillas
+            )
+            commands = commands + cccu_commands
+
+        support = {qubit.get_id() for qubit in _get_condition_qubits(key)}
+        restored: Set[int] = set()
+        for command in commands:
+            if command.gate == X_GATE and not command.get_control_qubit_ids():
+                restored ^= {command.get_target_qubit_id()}
+        commands = commands + [GateCmd(X_GATE, qubit_id) for qubit_id in sorted(restored & support)]
+
+        num_ancillas = self._rsrc.get_num_used_qubits() - qubits_counter
+        num_live_ancillas = sum(entry.num_ancillas for entry in live)
+
+        if num_ancillas == 0 or num_live_ancillas + num_ancillas > self._condition_ancillas_budget:
+            self._rsrc.free_qubits(num_ancillas)
+            return None
+
+        return _LiveCondition(key, support, control_mapping, commands, num_ancillas)
+
+    def _on_shared_if_then(
+        self,
+        if_then: IfThenNode,
+        key: _ConditionKey,
+        live: List[_LiveCondition]
+    ) -> bool:
+        """ Compiles `if_then` reusing (or computing and keeping alive) its condition.
+        Returns False if the statement has to be compiled in a regular way. """
+        collector = _WrittenQubitsCollector()
+        if_then.get_then_body().accept(collector)
+        written = {id(qubit) for qubit in collector.qubits}
+
+        if any(id(qubit) in written for entry_key in [key] + [entry.key for entry in live]
+               for qubit in _get_condition_qubits(entry_key)):
+            # The body modifies a condition qubit: fall back to compute-body-uncompute
+            return False
+
+        entry = next((entry for entry in live if entry.key == key), None)
+
+        if entry is None:
+            entry = self._compute_shared_condition(if_then.get_condition(), key, live)
+            if entry is None:
+                return False
+            live.append(entry)
+            self._commands.extend(entry.commands)
+
+        # The qubits declared in the body are freed (as in `on_if_then`) before the condition is released
+        qubits_counter = self._rsrc.get_num_used_qubits()
+        self._commands.extend(self._get_commands_recursive(if_then.get_then_body(), entry.control_mapping))
+        self._rsrc.free_qubits(self._rsrc.get_num_used_qubits() - qubits_counter)
+        return True
+
     def on_qubit_declaraion(self, declaration: QubitDeclarationNode) -> None:
+        if not self._rsrc.can_allocate_qubits(1):
+            raise ValueError(
+                f'The program declares more qubits than the budget of {self._rsrc.max_qubits} qubits '
+                f'(with {self._rsrc.get_num_used_qubits()} qubits in use).'
+            )
         declaration.get_qubit().set_target_qubit_id(self._rsrc.allocate_qubit())
 
     def on_qubit(self, qubit: QubitNode) -> None:
@@ -186,11 +620,28 @@ class CompileVisitor(IASTVisitor):
         bit.set_id(self._rsrc.allocate_bit())
 
     def on_inv(self, inv: InvNode) -> None:
-        self._commands.extend(self._inversed(self._get_commands_recursive(inv.get_body())))
+        # The inversion is pushed down to the leaves: the body is compiled once, backwards and
+        # with inverted gates (the conditions are computed and uncomputed as usual).
+        # A nested `Inv` cancels out.
+        self._inverted = not self._inverted
+        self._commands.extend(self._get_commands_recursive(inv.get_body()))
+        self._inverted = not self._inverted
+
+    def on_repeat(self, repeat: RepeatNode) -> None:
+        # The body is compiled once (under the current controls and inversion), so the size
+        # of the commands does not depend on the number of repetitions
+        if any(isinstance(node, (QubitDeclarationNode, CBitNode)) for node in _flatten(repeat.get_body())):
+            raise ValueError('The body of a repeat cannot declare qubits or bits.')
+
+        body = self._get_commands_recursive(repeat.get_body())
+        if repeat.count == 1:
+            self._commands.extend(body)
+        elif repeat.count > 1 and body:
+            self._commands.append(RepeatCmd(repeat.count, body))
 
     def on_if_then(self, if_then: IfThenNode) -> None:
-        qubits_counter = self._rsrc.get_min_unused_qubit_id()
-        cvis = CompileVisitor(self._rsrc)
+        qubits_counter = self._rsrc.get_num_used_qubits()
+        cvis = self._spawn()
         if_then.get_condition().accept(cvis)
         if_commands = cvis._commands
 
@@ -199,22 +650,23 @@ class CompileVisitor(IASTVisitor):
         self._commands.extend(
             if_commands +
             then_commands +
-            self._inversed(if_commands)
+            self._uncomputed(if_commands)
         )
 
-        num_ancillas = self._rsrc.get_min_unused_qubit_id() - qubits_counter
+        num_ancillas = self._rsrc.get_num_used_qubits() - qubits_counter
         self._rsrc.free_qubits(num_ancillas)
 
     def on_if_then_else(self, if_then_else: IfThenElseNode) -> None:
-        qubits_counter = self._rsrc.get_min_unused_qubit_id()
-        cvis = CompileVisitor(self._rsrc)
+        qubits_counter = self._rsrc.get_num_used_qubits()
+        cvis = self._spawn()
         if_then_else.get_condition().accept(cvis)
 
         cvis._commands.extend(
             CompileVisitor._get_reduced_commands(
                 1,
                 cvis._control_mapping,
-                cvis._rsrc
+                cvis._rsrc,
+                self._dirty_ancillas
             )
         )
 
@@ -229,7 +681,7 @@ class CompileVisitor(IASTVisitor):
             self._commands.extend(
                 if_commands +
                 then_commands +
-                self._inversed(if_commands)
+                self._uncomputed(if_commands)
             )
 
         elif len(cvis._control_mapping) == 1: # Only one qubit could be easily inverted
@@ -242,27 +694,32 @@ class CompileVisitor(IASTVisitor):
                 if_commands +
                 then_commands +
                 else_commands +
-                self._inversed(if_commands)
+                self._uncomputed(if_commands)
             )
 
         else:
             assert(False)
 
-        num_ancillas = self._rsrc.get_min_unused_qubit_id() - qubits_counter
+        num_ancillas = self._rsrc.get_num_used_qubits() - qubits_counter
         self._rsrc.free_qubits(num_ancillas)
 
     def on_if_flip(self, if_flip: IfFlipNode) -> None:
-        qubits_counter = self._rsrc.get_min_unused_qubit_id()
-        cvis = CompileVisitor(self._rsrc)
+        qubits_counter = self._rsrc.get_num_used_qubits()
+        cvis = self._spawn()
         if_flip.get_condition().accept(cvis)
 
-        cvis._commands.extend(
-            CompileVisitor._get_reduced_commands(
-                2,
-                cvis._control_mapping,
-                cvis._rsrc
+        # Without room for an ancilla the multi-controlled Z is decomposed in place
+        ancilla_free = len(cvis._control_mapping) > 2 and not self._rsrc.can_allocate_qubits(1)
+
+        if not ancilla_free:
+            cvis._commands.extend(
+                CompileVisitor._get_reduced_commands(
+                    2,
+                    cvis._control_mapping,
+                    cvis._rsrc,
+                    self._dirty_ancillas
+                )
             )
-        )
 
         cvis._commands.extend(
             CompileVisitor._get_qubit_negation_commands(cvis._control_mapping)
@@ -271,36 +728,64 @@ class CompileVisitor(IASTVisitor):
 
         if_commands: List[ICommand] = cvis._commands
 
-        flip_command = GateCmd(
-            Z_GATE,
-            control_qubit_ids[-1],
-            control_qubit_ids=set(control_qubit_ids[:-1])
-        )
+        flip_commands: List[ICommand]
+        if ancilla_free:
+            flip_commands = list(get_ancilla_free_mcu_commands(
+                control_qubit_ids[:-1],
+                control_qubit_ids[-1],
+                to_u3_params(Z_GATE, [])
+            ))
+        else:
+            flip_commands = [GateCmd(
+                Z_GATE,
+                control_qubit_ids[-1],
+                control_qubit_ids=set(control_qubit_ids[:-1])
+            )]
 
         self._commands.extend(
             if_commands +
-            [flip_command] +
-            self._inversed(if_commands)
+            flip_commands +
+            self._uncomputed(if_commands)
         )
 
-        num_ancillas = self._rsrc.get_min_unused_qubit_id() - qubits_counter
+        num_ancillas = self._rsrc.get_num_used_qubits() - qubits_counter
         self._rsrc.free_qubits(num_ancillas)
 
     def _get_on_gate_commands(self, node: GateNode) -> List[ICommand]:
         if not self._control_mapping:
             return [GateCmd(node.gate, node.get_target_qubit_id(), params=node.params)]
 
-        negate_negative_commands : List[ICommand] = []
+        control_qubit_ids = list(self._control_mapping)
+        negative_qubit_ids = {qubit_id for (qubit_id, mask) in self._control_mapping.items() if mask == 0}
+        max_controls = self._target.get_max_controls(node.gate)
+
+        num_tree_ancillas = len(control_qubit_ids) - max_controls
+
+        use_dirty_ancillas = self._dirty_ancillas or not self._rsrc.can_allocate_qubits(num_tree_ancillas)
+
+        if num_tree_ancillas > 0 and use_dirty_ancillas:
+            # The borrowed ancillas decomposition supports only positive controls
+            negate_negative_commands: List[ICommand] = [
+                GateCmd(X_GATE, qubit_id) for qubit_id in control_qubit_ids if qubit_id in negative_qubit_ids
+            ]
+            return (
+                negate_negative_commands +
+                self._get_dirty_controlled_commands(node, control_qubit_ids, max_controls) +
+                self._inversed(negate_negative_commands)
+            )
 
-        for qubit_id, mask in self._control_mapping.items():
-            if mask == 0:
-                negate_negative_commands.append(GateCmd(X_GATE, qubit_id))
+        return self._get_controlled_commands(node, control_qubit_ids, max_controls, negative_qubit_ids)
 
+    def _get_controlled_commands(
+        self,
+        node: GateNode,
+        control_qubit_ids: List[int],
+        max_controls: int,
+        negative_qubit_ids: Set[int]
+    ) -> List[ICommand]:
+        """ Reduces the controls with a tree of CCX gates computing the AND into clean ancillas. """
         num_ancillas = 0
-        commands: List[ICommand]
         control_commands: List[ICommand] = []
-        control_qubit_ids = list(self._control_mapping)
-        max_controls = 2 if node.gate == X_GATE else 1  # TODO(adsz): to be defined by gate / target architecture
 
         while len(control_qubit_ids) > max_controls:
             control_1 = control_qubit_ids.pop(0)
@@ -308,34 +793,179 @@ class CompileVisitor(IASTVisitor):
             ancilla = self._rsrc.allocate_qubit()
             num_ancillas += 1
             control_qubit_ids.append(ancilla)
-            control_commands.append(
-                GateCmd(X_GATE, ancilla, control_qubit_ids={control_1, control_2})
-            )
+            control_commands.append(GateCmd(
+                X_GATE,
+                ancilla,
+                control_qubit_ids={control_1, control_2},
+                relative_phase=True,
+                negative_control_qubit_ids={control_1, control_2} & negative_qubit_ids
+            ))
 
         controlled_command = GateCmd(
             node.gate,
             node.get_target_qubit_id(),
             params=node.params,
-            control_qubit_ids=set(control_qubit_ids)
+            control_qubit_ids=set(control_qubit_ids),
+            negative_control_qubit_ids=set(control_qubit_ids) & negative_qubit_ids
         )
 
         commands = (
             control_commands +
             [controlled_command] +
-            self._inversed(control_commands)
+            self._uncomputed(control_commands)
         )
 
         self._rsrc.free_qubits(num_ancillas)
 
-        return (
-            negate_negative_commands +
-            commands +
-            self._inversed(negate_negative_commands)
-        )
+        return commands
+
+    @staticmethod
+    def _get_dirty_mcx_commands(
+        control_qubit_ids: List[int],
+        target_qubit_id: int,
+        rsrc: ResourceAllocator
+    ) -> List[ICommand]:
+        """ Multi-controlled X borrowing idle qubits as ancillas,
+        one clean ancilla is allocated only if there is no idle qubit.
+        If that does not fit into `rsrc.max_qubits` the ancilla-free decomposition is used. """
+        num_needed = get_num_dirty_ancillas(len(control_qubit_ids))
+        ancilla_qubit_ids = rsrc.borrow_qubits(num_needed, set(control_qubit_ids) | {target_qubit_id})
+        num_clean_ancillas = 0
+
+        if num_needed > 0 and not ancilla_qubit_ids and not rsrc.can_allocate_qubits(1):
+            x_params = to_u3_params(X_GATE, [])
+            return list(get_ancilla_free_mcu_commands(control_qubit_ids, target_qubit_id, x_params))
+
+        if num_needed > 0 and not ancilla_qubit_ids:
+            ancilla_qubit_ids.append(rsrc.allocate_qubit())
+            num_clean_ancillas += 1
+
+        commands: List[ICommand] = list(get_dirty_mcx_commands(control_qubit_ids, target_qubit_id, ancilla_qubit_ids))
+
+        # The ancillas are restored, so the clean one may be freed right away
+        rsrc.free_qubits(num_clean_ancillas)
+        return commands
+
+    def _get_dirty_controlled_commands(
+        self,
+        node: GateNode,
+        control_qubit_ids: List[int],
+        max_controls: int
+    ) -> List[ICommand]:
+        """ Reduces the controls with CCX gates borrowing idle qubits as dirty ancillas.
+        An X gate needs no clean ancilla, other gates need one to compute the AND into
+        (or are decomposed without ancillas if it does not fit into the qubits budget). """
+        target_qubit_id = node.get_target_qubit_id()
+        num_clean_ancillas = 0
+
+        if not (node.gate == X_GATE and max_controls >= 2) and not self._rsrc.can_allocate_qubits(1):
+            alpha, params = get_u3_phase_and_params(node.gate, node.params)
+            return list(get_ancilla_free_mcu_commands(control_qubit_ids, target_qubit_id, params, alpha))
+
+        if node.gate == X_GATE and max_controls >= 2:
+            mcx_target_qubit_id = target_qubit_id
+        else:
+            mcx_target_qubit_id = self._rsrc.allocate_qubit()
+            num_clean_ancillas += 1
+
+        mcx_commands = CompileVisitor._get_dirty_mcx_commands(control_qubit_ids, mcx_target_qubit_id, self._rsrc)
+
+        if mcx_target_qubit_id == target_qubit_id:
+            commands = mcx_commands
+        else:
+            controlled_command = GateCmd(
+                node.gate,
+                target_qubit_id,
+                params=node.params,
+                control_qubit_ids={mcx_target_qubit_id}
+            )
+            commands = mcx_commands + [controlled_command] + self._inversed(mcx_commands)
+
+        self._rsrc.free_qubits(num_clean_ancillas)
+
+        return commands
 
     def on_gate(self, node: GateNode) -> None:
+        if self._inverted:
+            inverse_gate, inverse_params = invert_gate(node.gate, node.params)
+            node = GateNode(inverse_gate, node.get_target_qubit(), inverse_params)
         self._commands.extend(self._get_on_gate_commands(node))
 
+    def on_broadcast(self, node: BroadcastNode) -> None:
+        qubits = node.get_qubits()
+        if self._control_mapping or len(qubits) == 1:
+            # Every gate is controlled on its own
+            for qubit in qubits:
+                self.on_gate(GateNode(node.gate, qubit, node.params))
+            return
+
+        gate, params = node.gate, node.params
+        if self._inverted:
+            gate, params = invert_gate(gate, params)
+        self._commands.append(BroadcastCmd(gate, [qubit.get_id() for qubit in qubits], params))
+
+    def on_opaque_gate(self, node: OpaqueGateNode) -> None:
+        gate = node.gate
+        reasons: List[str] = []
+        if self._control_mapping:
+            reasons.append('controlled')
+        if self._inverted and gate.inverse is None:
+            reasons.append('inverted without an inverse rule')
+
+        params = node.params
+        if self._inverted and gate.inverse is not None:
+            gate, params = invert_gate(gate, params)
+        if not self._target.is_native(gate, 0):
+            reasons.append('used with a target which does not support it natively')
+
+        if not reasons:
+            self._commands.append(OpaqueGateCmd(gate, [qubit.get_id() for qubit in node.get_qubits()], params))
+            return
+
+        if node.gate.definition is None:
+            raise ValueError(f'Opaque gate {node.gate.name} has no definition, so it cannot be {" and ".join(reasons)}.')
+
+        # The definition is compiled under the current controls (and inversion)
+        definition = Program(node.gate.definition(node.get_qubits(), node.params))
+        self._commands.extend(self._get_commands_recursive(definition))
+
+    def _uncomputed(self, commands: Union[ICommand, List[ICommand]]) -> List[ICommand]:
+        """ Returns commands undoing `commands`, like `_inversed`, except that with `measure_uncompute`
+        the AND ancillas computed by CCX gates are measured in the X basis and reset.
+        The measured 1 means a phase of -1 on the states where the AND is true,
+        which is fixed by a classically controlled CZ on the CCX controls. """
+        if not self._measure_uncompute:
+            return self._inversed(commands)
+
+        result: List[ICommand] = []
+        for command in to_list(commands)[::-1]:
+            if isinstance(command, GateCmd) and command.is_relative_phase():
+                ancilla = command.get_target_qubit_id()
+                negative_qubit_ids = command.get_negative_control_qubit_ids()
+                # The CZ target cannot be negative, it is negated with X gates if both controls are
+                control_1, control_2 = sorted(
+                    command.get_control_qubit_ids(),
+                    key=lambda qubit_id: (qubit_id not in negative_qubit_ids, qubit_id)
+                )
+                negations = [GateCmd(X_GATE, control_2)] if control_2 in negative_qubit_ids else []
+                fix_command = GateCmd(
+                    Z_GATE,
+                    control_2,
+                    control_qubit_ids={control_1},
+                    negative_control_qubit_ids={control_1} & negative_qubit_ids
+                )
+                bit = self._rsrc.get_scratch_bit()
+                result.extend(
+                    [GateCmd(H_GATE, ancilla), MeasurementCmd(ancilla, bit)] +
+                    negations +
+                    [ClassicalIfCmd(bit, fix_command)] +
+                    negations +
+                    [ResetCmd(ancilla)]
+                )
+            else:
+                result.extend(self._inversed(command))
+        return result
+
     def _inversed(self, commands: Union[ICommand, List[ICommand]]) -> List[ICommand]:
         def inverse_command(command: ICommand):
             if not isinstance(command, GateCmd):
@@ -347,7 +977,9 @@ class CompileVisitor(IASTVisitor):
                 inv_gate,
                 command.get_target_qubit_id(),
                 command.get_control_qubit_ids(),
-                inv_params
+                inv_params,
+                command.is_relative_phase(),
+                command.get_negative_control_qubit_ids()
             )
 
         return [inverse_command(command) for command in to_list(commands)[::-1]]
@@ -357,7 +989,7 @@ class CompileVisitor(IASTVisitor):
         mask: List[int] = match.get_mask()
 
         for (control, bit) in zip(controls, mask):
-            subvisitor = CompileVisitor(self._rsrc)
+            subvisitor = self._spawn()
             control.accept(subvisitor)
             self._commands.extend(subvisitor._commands)
             assert len(subvisitor._control_mapping) == 1
@@ -373,7 +1005,7 @@ class CompileVisitor(IASTVisitor):
                 raise Exception("Syntax error")
 
     def on_not(self, not_: NotNode) -> None:
-        subvisitor = CompileVisitor(self._rsrc)
+        subvisitor = self._spawn()
         not_.get_condition().accept(subvisitor)
 
         if len(subvisitor._control_mapping) <= 1:
@@ -383,7 +1015,8 @@ class CompileVisitor(IASTVisitor):
             control_bits, cccu_commands = CompileVisitor._get_cccu_commands(
                 subvisitor._control_mapping,
                 self._rsrc,
-                max_num_qubits=1
+                max_num_qubits=1,
+                dirty_ancillas=self._dirty_ancillas
             )
             assert len(control_bits) == 1
             result_bit = list(control_bits)[0]
@@ -392,6 +1025,8 @@ class CompileVisitor(IASTVisitor):
             self._control_mapping[result_bit] = 0
 
     def on_measure(self, measure: MeasurementNode) -> None:
+        if self._inverted:
+            raise ValueError(f"Inverse of {type(measure)} is impossible.")
         self._commands.append(
             MeasurementCmd(
                 measure.get_qubit().get_id(),
@@ -400,4 +1035,6 @@ class CompileVisitor(IASTVisitor):
         )
 
     def on_reset(self, reset: ResetNode) -> None:
+        if self._inverted:
+            raise ValueError(f"Inverse of {type(reset)} is impossible.")
         self._commands.append(ResetCmd(reset.get_qubit().get_id()))
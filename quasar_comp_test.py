@@ -0,0 +1,280 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from typing import List
+import unittest
+
+from builtin_gates import H_GATE, SDG_GATE, U3_GATE, X_GATE
+from quasar import All, CX, H, If, Inv, Match, Measurement, Phase, Program, Quasar, Repeat, S, U3, X
+from quasar_cmd import BroadcastCmd, GateCmd, RepeatCmd
+from quasar_comp import CompileVisitor, ResourceAllocator
+from quasar_qasm import QASMFormatter
+
+#
+##
+#
+
+class CompileVisitorTest(unittest.TestCase):
+
+    def _compile(self, prgm: Program, **kwargs) -> List[str]:
+        return Quasar().compile(prgm, QASMFormatter(), **kwargs)
+
+    def _count(self, lines: List[str], prefix: str) -> int:
+        return len([line for line in lines if line.startswith(prefix)])
+
+    def test_shared_condition(self) -> None:
+        def build() -> Program:
+            prgm = Program()
+            qubits = prgm.Qubits(8 * [0])
+            prgm += If(Match(qubits[:3], mask=[1, 0, 1])).Then(H(qubits[3]))
+            prgm += If(All(qubits[4:7])).Then(X(qubits[7]))
+            prgm += If(Match(qubits[:3], mask=[1, 0, 1])).Then(Phase(qubits[3], 0.5))
+            return prgm
+
+        self.assertEqual(self._count(self._compile(build()), 'ccx '), 11)
+
+        actual = self._compile(build(), condition_ancillas_budget=2)
+        self.assertEqual(self._count(actual, 'ccx '), 7)
+        self.assertEqual(self._count(actual, 'x '), 2)
+
+    def test_shared_condition_invalidated(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(5 * [0])
+        prgm += If(All(qubits[:3])).Then(H(qubits[3]))
+        prgm += H(qubits[1])
+        prgm += If(All(qubits[:3])).Then(H(qubits[4]))
+
+        actual = self._compile(prgm, condition_ancillas_budget=2)
+        self.assertEqual(actual[6:], [
+            'ccx q[0], q[1], q[5];',
+            'ccx q[2], q[5], q[6];',
+            'ch q[6], q[3];',
+            'ccx q[2], q[5], q[6];',
+            'ccx q[0], q[1], q[5];',
+            'h q[1];',
+            'ccx q[0], q[1], q[5];',
+            'ccx q[2], q[5], q[6];',
+            'ch q[6], q[4];',
+            'ccx q[2], q[5], q[6];',
+            'ccx q[0], q[1], q[5];',
+        ])
+
+    def test_shared_condition_over_budget(self) -> None:
+        def build() -> Program:
+            prgm = Program()
+            qubits = prgm.Qubits(8 * [0])
+            prgm += If(All(qubits[:3])).Then(H(qubits[3]))
+            prgm += If(All(qubits[4:7])).Then(X(qubits[7]))
+            prgm += If(All(qubits[:3])).Then(H(qubits[3]))
+            return prgm
+
+        self.assertListEqual(
+            self._compile(build(), condition_ancillas_budget=1),
+            self._compile(build())
+        )
+
+    def test_shared_condition_declaring_body(self) -> None:
+        def build(modify_condition: bool) -> Program:
+            prgm = Program()
+            qubits = prgm.Qubits(5 * [0])
+            body = Program()
+            body += CX(qubits[3], body.Qubit())
+            if modify_condition:
+                body += X(qubits[0])
+            prgm += If(All(qubits[:3])).Then(body)
+            prgm += If(All(qubits[:3])).Then(H(qubits[4]))
+            prgm += If(All(qubits[1:4])).Then(H(qubits[4]))
+            return prgm
+
+        for modify_condition in (False, True):
+            self.assertIn('qreg q[8];', self._compile(build(modify_condition)))
+            # The qubit declared in the body and the unused condition are released
+            self.assertIn('qreg q[8];', self._compile(build(modify_condition), condition_ancillas_budget=2))
+
+        actual = self._compile(build(False), condition_ancillas_budget=2)
+        self.assertLess(self._count(actual, 'ccx '), self._count(self._compile(build(False)), 'ccx '))
+
+    def test_measure_uncompute(self) -> None:
+        def build() -> Program:
+            prgm = Program()
+            qubits = prgm.Qubits(5 * [0])
+            prgm += If(All(qubits[:4])).Then(X(qubits[4]))
+            return prgm
+
+        actual = self._compile(build(), measure_uncompute=True)
+        self.assertEqual(actual[4:], [
+            'creg c[1];',
+            'creg c0[1];',
+            ' ',
+            'ccx q[0], q[1], q[5];',
+            'ccx q[2], q[3], q[6];',
+            'ccx q[5], q[6], q[4];',
+            'h q[6];',
+            'measure q[6] -> c0[0];',
+            'if(c0==1) cz q[2], q[3];',
+            'reset q[6];',
+            'h q[5];',
+            'measure q[5] -> c0[0];',
+            'if(c0==1) cz q[0], q[1];',
+            'reset q[5];',
+        ])
+        self.assertLess(self._count(actual, 'ccx'), self._count(self._compile(build()), 'ccx'))
+
+    def test_max_qubits(self) -> None:
+        def build() -> Program:
+            prgm = Program()
+            qubits = prgm.Qubits(7 * [0])
+            prgm += If(All(qubits[:6])).Then(H(qubits[6]))
+            prgm += If(All(qubits[:6])).Then(X(qubits[6]))
+            return prgm
+
+        self.assertIn('qreg q[12];', self._compile(build()))
+        self.assertIn('qreg q[12];', self._compile(build(), max_qubits=12))
+        self.assertIn('qreg q[11];', self._compile(build(), max_qubits=11))
+        self.assertIn('qreg q[8];', self._compile(build(), max_qubits=8))
+        self.assertIn('qreg q[7];', self._compile(build(), max_qubits=7))
+
+        with self.assertRaisesRegex(ValueError, 'declares more qubits'):
+            self._compile(build(), max_qubits=6)
+
+    def test_max_qubits_condition(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(5 * [0])
+        prgm += If(All(qubits[:4])).Then(H(qubits[4])).Else(X(qubits[4]))
+
+        self.assertIn('qreg q[6];', self._compile(prgm, max_qubits=6))
+        with self.assertRaisesRegex(ValueError, 'requires an ancilla'):
+            self._compile(prgm, max_qubits=5)
+
+    def test_recycle_qubits(self) -> None:
+        def build() -> Program:
+            prgm = Program()
+            bits = prgm.CBits(4)
+            qubits = prgm.Qubits(2 * [0])
+            prgm += H(qubits[0])
+            prgm += If(All(qubits[:1])).Then(X(qubits[1]))
+            prgm += Measurement(qubits[0], bits[0])
+            prgm += Measurement(qubits[1], bits[1])
+            qubits = prgm.Qubits(2 * [0])
+            prgm += H(qubits[1])
+            prgm += Measurement(qubits[0], bits[2])
+            prgm += Measurement(qubits[1], bits[3])
+            return prgm
+
+        self.assertIn('qreg q[4];', self._compile(build()))
+        self.assertEqual(self._compile(build(), recycle_qubits=True)[3:], [
+            'qreg q[2];',
+            'creg c[4];',
+            ' ',
+            'h q[0];',
+            'cx q[0], q[1];',
+            'measure q[0] -> c[0];',
+            'reset q[0];',
+            'measure q[1] -> c[1];',
+            'reset q[1];',
+            'h q[1];',
+            'measure q[0] -> c[2];',
+            'measure q[1] -> c[3];',
+        ])
+
+
+    def test_inverse(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(3 * [0])
+        body = H(qubits[0]) + U3(qubits[2], 0.1, 0.2, 0.3) + If(All(qubits[:2])).Then(X(qubits[2]))
+
+        visitor = CompileVisitor(ResourceAllocator())
+        (prgm + Inv(body)).accept(visitor)
+        self.assertListEqual(visitor.commands, [
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}),
+            GateCmd(U3_GATE, 2, params=[-0.1, -0.3, -0.2]),
+            GateCmd(H_GATE, 0),
+        ])
+
+        # A double inversion cancels out
+        self.assertListEqual(self._compile(prgm + Inv(Inv(body))), self._compile(prgm + body))
+
+        with self.assertRaises(ValueError):
+            bits = prgm.CBits(1)
+            self._compile(prgm + Inv(Measurement(qubits[0], bits[0])))
+
+    def test_negative_controls(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(4 * [0])
+        prgm += If(Match(qubits[:3], mask=[1, 0, 0])).Then(X(qubits[3]))
+
+        visitor = CompileVisitor(ResourceAllocator())
+        prgm.accept(visitor)
+        self.assertEqual(len(visitor.commands), 3)
+        negative_control_qubit_ids = set()
+        for cmd in visitor.commands:
+            negative_control_qubit_ids |= cmd.get_negative_control_qubit_ids()
+        self.assertSetEqual(negative_control_qubit_ids, {1, 2})
+
+        # QASM has no control states, so they are expanded into X gates
+        actual = self._compile(prgm)
+        self.assertEqual(self._count(actual, 'ccx '), 3)
+        self.assertEqual(self._count(actual, 'x '), 4)
+
+    def test_broadcast(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(4 * [0])
+        body = H(qubits) + Inv(S(qubits[1:])) + If(All(qubits[0])).Then(X(qubits[2:]))
+
+        visitor = CompileVisitor(ResourceAllocator())
+        (prgm + body).accept(visitor)
+        self.assertListEqual(visitor.commands, [
+            BroadcastCmd(H_GATE, [0, 1, 2, 3]),
+            BroadcastCmd(SDG_GATE, [1, 2, 3]),
+            # Every gate is controlled on its own
+            GateCmd(X_GATE, 2, control_qubit_ids={0}),
+            GateCmd(X_GATE, 3, control_qubit_ids={0}),
+        ])
+
+        # The whole register uses the broadcast syntax
+        actual = self._compile(prgm + body)
+        self.assertListEqual(actual[6:], ['h q;', 'sdg q[1];', 'sdg q[2];', 'sdg q[3];', 'cx q[0], q[2];', 'cx q[0], q[3];'])
+
+    def test_repeat(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(2 * [0])
+        body = H(qubits[0]) + If(All(qubits[0])).Then(X(qubits[1]))
+
+        visitor = CompileVisitor(ResourceAllocator())
+        (prgm + Inv(Repeat(3, body))).accept(visitor)
+        self.assertListEqual(visitor.commands, [
+            RepeatCmd(3, [GateCmd(X_GATE, 1, control_qubit_ids={0}), GateCmd(H_GATE, 0)]),
+        ])
+
+        # The body is compiled once and expanded when emitted
+        actual = self._compile(prgm + Repeat(3, body), optimize=False)
+        self.assertListEqual(actual[6:], 3 * ['h q[0];', 'cx q[0], q[1];'])
+
+        # A qubit declared in the body would not be fresh in the next copies
+        declaring_body = Program()
+        declaring_body += H(declaring_body.Qubit())
+        with self.assertRaises(ValueError):
+            self._compile(prgm + Repeat(2, declaring_body))
+
+if __name__ == '__main__':
+    unittest.main()
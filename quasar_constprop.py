@@ -0,0 +1,172 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from typing import Dict, Iterable, Iterator, List, Set
+
+from builtin_arithmetics import is_diagonal_gate
+from builtin_gates import RZ_GATE, X_GATE, Y_GATE
+from quasar_cmd import ICommand, ICmdVisitor, GateCmd, OpaqueGateCmd, RepeatCmd, MeasurementCmd, ResetCmd, ClassicalIfCmd
+
+#
+##
+#
+
+class _ConstPropVisitor(ICmdVisitor):
+    """
+    Tracks qubits being in known basis states (all of them start in |0>):
+    - controls known to be in their active state (|1>, or |0> for a negative control) are dropped,
+    - gates with a control known to be in the other state are deleted,
+    - X (and Y) gates on known qubits are folded, they are emitted only when
+      the qubit is used in another way (or at the end of the circuit),
+    - diagonal gates on known qubits only change the global phase, so they are deleted
+      (or kept as a phase of their controls).
+    A qubit stops being tracked once it may be in a superposition.
+    """
+
+    def run(self, commands: List[ICommand]) -> List[ICommand]:
+        return list(self.stream(commands))
+
+    def stream(self, commands: Iterable[ICommand]) -> Iterator[ICommand]:
+        """ Simplifies the commands on the fly, the state kept depends only on the number of qubits. """
+        self._commands: List[ICommand] = []
+        self._known: Dict[int, int] = {}    # The state the qubit should be in (0 if missing)
+        self._emitted: Dict[int, int] = {}  # The state the emitted commands leave it in (0 if missing)
+        self._unknown: Set[int] = set()
+
+        for command in commands:
+            command.accept(self)
+            yield from self._commands
+            self._commands = []
+
+        for qubit_id in sorted(self._known):
+            self._materialize(qubit_id)
+
+        yield from self._commands
+
+    def _is_known(self, qubit_id: int) -> bool:
+        return qubit_id not in self._unknown
+
+    def _get_known(self, qubit_id: int) -> int:
+        return self._known.get(qubit_id, 0)
+
+    def _materialize(self, qubit_id: int) -> None:
+        """ Emits the pending X gate, if any. """
+        if self._is_known(qubit_id) and self._get_known(qubit_id) != self._emitted.get(qubit_id, 0):
+            self._commands.append(GateCmd(X_GATE, qubit_id))
+            self._emitted[qubit_id] = self._get_known(qubit_id)
+
+    def _forget(self, qubit_id: int) -> None:
+        self._materialize(qubit_id)
+        self._unknown.add(qubit_id)
+        self._known.pop(qubit_id, None)
+        self._emitted.pop(qubit_id, None)
+
+    def on_program(self, commands: List[ICommand]) -> None:
+        pass
+
+    def on_gate(self, cmd: GateCmd) -> None:
+        target = cmd.get_target_qubit_id()
+        negative_controls = cmd.get_negative_control_qubit_ids()
+        controls: Set[int] = set()
+
+        for qubit_id in cmd.get_control_qubit_ids():
+            if not self._is_known(qubit_id):
+                controls.add(qubit_id)
+            elif self._get_known(qubit_id) != (0 if qubit_id in negative_controls else 1):
+                return
+
+        is_diagonal = is_diagonal_gate(cmd.gate, cmd._params)
+
+        if self._is_known(target):
+            # The diagonal gates leave |0> untouched, except RZ which adds a phase to it
+            if is_diagonal and cmd.gate != RZ_GATE and self._get_known(target) == 0:
+                return
+            if not controls:
+                if cmd.gate in (X_GATE, Y_GATE):
+                    self._known[target] = 1 - self._get_known(target)
+                    return
+                if is_diagonal:
+                    return
+            self._materialize(target)
+
+        for qubit_id in controls:
+            self._materialize(qubit_id)
+
+        if not is_diagonal:
+            self._forget(target)
+
+        if controls != cmd.get_control_qubit_ids():
+            cmd = GateCmd(
+                cmd.gate,
+                target,
+                controls,
+                cmd._params,
+                cmd.is_relative_phase() and len(controls) > 1,
+                negative_controls & controls
+            )
+        self._commands.append(cmd)
+
+    def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+        # Nothing is known about the opaque gates
+        for qubit_id in cmd.get_ordered_qubit_ids():
+            self._forget(qubit_id)
+        self._commands.append(cmd)
+
+    def on_repeat(self, cmd: RepeatCmd) -> None:
+        # Kept folded, so the states are not tracked through its copies
+        for qubit_id in sorted(cmd.get_qubit_ids()):
+            self._forget(qubit_id)
+        self._commands.append(cmd)
+
+    def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+        # The condition is not known at compile time
+        cmd = cif.command
+        for qubit_id in cmd.get_qubit_ids():
+            self._materialize(qubit_id)
+        if not is_diagonal_gate(cmd.gate, cmd._params):
+            self._forget(cmd.get_target_qubit_id())
+        self._commands.append(cif)
+
+    def on_measurement(self, m: MeasurementCmd) -> None:
+        self._materialize(m.get_target_qubit_id())
+        self._commands.append(m)
+
+    def on_reset(self, reset: ResetCmd) -> None:
+        qubit_id = reset.get_target_qubit_id()
+        if self._is_known(qubit_id) and self._emitted.get(qubit_id, 0) == 0:
+            self._known[qubit_id] = 0
+            return
+        self._unknown.discard(qubit_id)
+        self._known[qubit_id] = 0
+        self._emitted[qubit_id] = 0
+        self._commands.append(reset)
+
+
+def propagate_constants(commands: List[ICommand]) -> List[ICommand]:
+    """ Simplifies the commands acting on qubits in known basis states. """
+    return _ConstPropVisitor().run(commands)
+
+
+def stream_constants(commands: Iterable[ICommand]) -> Iterator[ICommand]:
+    """ Lazy variant of `propagate_constants`. """
+    return _ConstPropVisitor().stream(commands)
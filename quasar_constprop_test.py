@@ -0,0 +1,100 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+from builtin_gates import H_GATE, U3_GATE, X_GATE, Z_GATE
+from quasar import All, CX, H, If, Program, Quasar, X
+from quasar_cmd import GateCmd, MeasurementCmd, ResetCmd
+from quasar_constprop import propagate_constants, stream_constants
+from quasar_qasm import QASMFormatter
+
+#
+##
+#
+
+class ConstPropTest(unittest.TestCase):
+    def test_controls(self) -> None:
+        commands = [
+            GateCmd(X_GATE, 0),
+            GateCmd(H_GATE, 1),
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}),
+            GateCmd(H_GATE, 3, control_qubit_ids={2, 4}),
+        ]
+        expected = [
+            GateCmd(H_GATE, 1),
+            GateCmd(X_GATE, 2, control_qubit_ids={1}),
+            GateCmd(X_GATE, 0),
+        ]
+        self.assertListEqual(propagate_constants(commands), expected)
+
+    def test_folding(self) -> None:
+        commands = [
+            GateCmd(X_GATE, 0),
+            GateCmd(X_GATE, 1, control_qubit_ids={0}),
+            GateCmd(Z_GATE, 1),
+            GateCmd(X_GATE, 0),
+            GateCmd(U3_GATE, 1, params=[0.1, 0.2, 0.3]),
+            MeasurementCmd(1, 0),
+        ]
+        expected = [
+            GateCmd(X_GATE, 1),
+            GateCmd(U3_GATE, 1, params=[0.1, 0.2, 0.3]),
+            MeasurementCmd(1, 0),
+        ]
+        actual = propagate_constants(commands)
+        self.assertListEqual(actual[:2], expected[:2])
+        self.assertIs(actual[2], commands[-1])
+
+    def test_reset(self) -> None:
+        commands = [GateCmd(X_GATE, 0), ResetCmd(0), GateCmd(H_GATE, 0), ResetCmd(0)]
+        actual = propagate_constants(commands)
+        self.assertListEqual(actual[:1], [GateCmd(H_GATE, 0)])
+        self.assertIs(actual[1], commands[3])
+
+    def test_stream(self) -> None:
+        consumed = []
+
+        def commands():
+            for command in [GateCmd(H_GATE, 0), GateCmd(X_GATE, 1), GateCmd(H_GATE, 1)]:
+                consumed.append(command)
+                yield command
+
+        actual = stream_constants(commands())
+        self.assertEqual(next(actual), GateCmd(H_GATE, 0))
+        self.assertEqual(len(consumed), 1)
+        self.assertListEqual(list(actual), [GateCmd(X_GATE, 1), GateCmd(H_GATE, 1)])
+
+    def test_compile(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([1, 1, 0, 0, 0])
+        prgm += H(qubits[4])
+        prgm += If(All(qubits[:4] + [qubits[4]])).Then(X(qubits[2]))
+        prgm += CX(qubits[0], qubits[3])
+
+        actual = Quasar().compile(prgm, QASMFormatter(), fold_constants=True)
+        self.assertListEqual(actual[6:], ['h q[4];', 'x q[0];', 'x q[1];', 'x q[3];'])
+
+
+if __name__ == '__main__':
+    unittest.main()
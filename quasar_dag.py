@@ -0,0 +1,202 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from typing import Dict, Iterator, List, Optional
+
+from quasar_cmd import ICommand
+
+#
+##
+#
+
+class DagNode:
+    """ A command in the circuit DAG. It belongs to the global (topologically ordered) list
+    and to the wire lists of all the qubits it acts on. """
+
+    __slots__ = ('command', 'qubit_ids', 'prev', 'next', '_global_prev', '_global_next')
+
+    def __init__(self, command: ICommand) -> None:
+        self.command = command
+        self.qubit_ids = tuple(sorted(command.get_qubit_ids()))
+        self.prev: Dict[int, Optional['DagNode']] = {}
+        self.next: Dict[int, Optional['DagNode']] = {}
+        self._global_prev: Optional['DagNode'] = None
+        self._global_next: Optional['DagNode'] = None
+
+    def __repr__(self) -> str:
+        return f'DagNode({self.command!r})'
+
+
+class CircuitDag:
+    """
+    Dependency DAG of a circuit. Each qubit wire is a doubly-linked list of the commands
+    acting on it, and all the commands are kept in one more doubly-linked list
+    in a topological order. Appending, removing and replacing a command take O(1) time
+    (for a bounded number of qubits per command).
+
+    Prog: X(0), CX(0, 1), X(1), H(0)
+
+    Q0: [X(0)]---[CX(0,1)]---[H(0)]
+    Q1:          [CX(0,1)]---[X(1)]
+    """
+
+    def __init__(self, commands: Optional[List[ICommand]] = None) -> None:
+        self._first: Optional[DagNode] = None
+        self._last: Optional[DagNode] = None
+        # Index of the wires: qubit id -> its first and last node
+        self._heads: Dict[int, DagNode] = {}
+        self._tails: Dict[int, DagNode] = {}
+        self._size = 0
+
+        for command in commands or []:
+            self.append(command)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[DagNode]:
+        """ Iterates over the nodes in a topological order.
+        The node being visited may be removed or replaced during the iteration. """
+        node = self._first
+        while node is not None:
+            next_node = node._global_next
+            yield node
+            node = next_node
+
+    def get_commands(self) -> List[ICommand]:
+        return [node.command for node in self]
+
+    def get_qubit_ids(self) -> List[int]:
+        return sorted(self._heads)
+
+    def get_first(self, qubit_id: int) -> Optional[DagNode]:
+        return self._heads.get(qubit_id)
+
+    def get_last(self, qubit_id: int) -> Optional[DagNode]:
+        return self._tails.get(qubit_id)
+
+    def get_wire(self, qubit_id: int) -> Iterator[DagNode]:
+        """ Iterates over the nodes acting on `qubit_id` in order. """
+        node = self.get_first(qubit_id)
+        while node is not None:
+            next_node = node.next[qubit_id]
+            yield node
+            node = next_node
+
+    def append(self, command: ICommand) -> DagNode:
+        node = DagNode(command)
+
+        for qubit_id in node.qubit_ids:
+            last = self._tails.get(qubit_id)
+            node.prev[qubit_id] = last
+            node.next[qubit_id] = None
+            if last is None:
+                self._heads[qubit_id] = node
+            else:
+                last.next[qubit_id] = node
+            self._tails[qubit_id] = node
+
+        self._link_global(node, self._last, None)
+        return node
+
+    def insert_before(self, node: DagNode, command: ICommand) -> DagNode:
+        """ Inserts `command` right before `node`. The command has to act on
+        a subset of qubits of `node`, so that the topological order is preserved. """
+        new_node = DagNode(command)
+
+        for qubit_id in new_node.qubit_ids:
+            if qubit_id not in node.prev:
+                raise ValueError(f'{command} acts on qubit {qubit_id} not used by {node.command}')
+            prev = node.prev[qubit_id]
+            new_node.prev[qubit_id] = prev
+            new_node.next[qubit_id] = node
+            node.prev[qubit_id] = new_node
+            if prev is None:
+                self._heads[qubit_id] = new_node
+            else:
+                prev.next[qubit_id] = new_node
+
+        self._link_global(new_node, node._global_prev, node)
+        return new_node
+
+    def remove(self, node: DagNode) -> None:
+        for qubit_id in node.qubit_ids:
+            prev = node.prev[qubit_id]
+            next_ = node.next[qubit_id]
+
+            if prev is None:
+                if next_ is None:
+                    del self._heads[qubit_id]
+                else:
+                    self._heads[qubit_id] = next_
+            else:
+                prev.next[qubit_id] = next_
+
+            if next_ is None:
+                if prev is None:
+                    del self._tails[qubit_id]
+                else:
+                    self._tails[qubit_id] = prev
+            else:
+                next_.prev[qubit_id] = prev
+
+        if node._global_prev is None:
+            self._first = node._global_next
+        else:
+            node._global_prev._global_next = node._global_next
+        if node._global_next is None:
+            self._last = node._global_prev
+        else:
+            node._global_next._global_prev = node._global_prev
+
+        node.prev.clear()
+        node.next.clear()
+        node._global_prev = node._global_next = None
+        self._size -= 1
+
+    def pop_first(self) -> DagNode:
+        """ Removes and returns the first node in the topological order. """
+        if self._first is None:
+            raise IndexError('pop from an empty CircuitDag')
+        node = self._first
+        self.remove(node)
+        return node
+
+    def replace(self, node: DagNode, commands: List[ICommand]) -> List[DagNode]:
+        """ Replaces `node` with `commands` acting on a subset of its qubits. """
+        new_nodes = [self.insert_before(node, command) for command in commands]
+        self.remove(node)
+        return new_nodes
+
+    def _link_global(self, node: DagNode, prev: Optional[DagNode], next_: Optional[DagNode]) -> None:
+        node._global_prev = prev
+        node._global_next = next_
+        if prev is None:
+            self._first = node
+        else:
+            prev._global_next = node
+        if next_ is None:
+            self._last = node
+        else:
+            next_._global_prev = node
+        self._size += 1
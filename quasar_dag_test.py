@@ -0,0 +1,81 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+from builtin_gates import H_GATE, X_GATE, Z_GATE
+from quasar_cmd import GateCmd, MeasurementCmd
+from quasar_dag import CircuitDag
+
+#
+##
+#
+
+class CircuitDagTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.x_0 = GateCmd(X_GATE, 0)
+        self.cx_01 = GateCmd(X_GATE, 1, control_qubit_ids={0})
+        self.x_1 = GateCmd(X_GATE, 1)
+        self.h_0 = GateCmd(H_GATE, 0)
+        self.dag = CircuitDag([self.x_0, self.cx_01, self.x_1, self.h_0])
+
+    def test_wires(self) -> None:
+        self.assertEqual(len(self.dag), 4)
+        self.assertListEqual(self.dag.get_qubit_ids(), [0, 1])
+        self.assertListEqual([node.command for node in self.dag.get_wire(0)], [self.x_0, self.cx_01, self.h_0])
+        self.assertListEqual([node.command for node in self.dag.get_wire(1)], [self.cx_01, self.x_1])
+        self.assertIs(self.dag.get_first(1).command, self.cx_01)
+        self.assertIs(self.dag.get_last(0).command, self.h_0)
+        self.assertIsNone(self.dag.get_last(2))
+
+    def test_remove(self) -> None:
+        cx = self.dag.get_first(1)
+        self.dag.remove(cx)
+        self.assertListEqual(self.dag.get_commands(), [self.x_0, self.x_1, self.h_0])
+        self.assertIs(self.dag.get_first(0).next[0].command, self.h_0)
+        self.assertIs(self.dag.get_first(1).command, self.x_1)
+
+        self.dag.remove(self.dag.get_first(1))
+        self.assertListEqual(self.dag.get_qubit_ids(), [0])
+        self.assertEqual(len(self.dag), 2)
+
+    def test_replace(self) -> None:
+        cz = GateCmd(Z_GATE, 1, control_qubit_ids={0})
+        h_1 = GateCmd(H_GATE, 1)
+        self.dag.replace(self.dag.get_first(1), [h_1, cz, h_1])
+        self.assertListEqual(self.dag.get_commands(), [self.x_0, h_1, cz, h_1, self.x_1, self.h_0])
+        self.assertListEqual([node.command for node in self.dag.get_wire(0)], [self.x_0, cz, self.h_0])
+        self.assertIs(self.dag.get_first(1).command, h_1)
+
+        with self.assertRaises(ValueError):
+            self.dag.insert_before(self.dag.get_first(0), MeasurementCmd(1, 0))
+
+    def test_remove_while_iterating(self) -> None:
+        for node in self.dag:
+            if node.command.gate == X_GATE and not node.command.get_control_qubit_ids():
+                self.dag.remove(node)
+        self.assertListEqual(self.dag.get_commands(), [self.cx_01, self.h_0])
+
+
+if __name__ == '__main__':
+    unittest.main()
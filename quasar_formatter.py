@@ -21,9 +21,13 @@
 #
 
 from abc import abstractmethod, ABC
-from typing import List, Set, TypeVar, Dict
+from typing import List, Optional, Set, TypeVar, Dict, TYPE_CHECKING
 
-from builtin_gates import BuiltinGate
+from builtin_gates import BuiltinGate, X_GATE
+from opaque_gates import OpaqueGate
+
+if TYPE_CHECKING:
+    from quasar_cmd import ICommand
 
 
 class IQAsmFormatter(ABC):
@@ -31,6 +35,8 @@ class IQAsmFormatter(ABC):
         self.qubits_counter = 0
         self.bits_counter = 0
         self.groups : List[int] = []
+        self.conditional_bits : Set[int] = set()
+        self.opaque_gates : Dict[OpaqueGate, Optional[List['ICommand']]] = {}
 
     def set_qubits_counter(self, qubits_counter: int):
         self.qubits_counter = qubits_counter
@@ -41,6 +47,16 @@ class IQAsmFormatter(ABC):
     def set_groups(self, groups: List[int]):
         self.groups = groups
 
+    def set_conditional_bits(self, conditional_bits: Set[int]):
+        """ Bits used as conditions of classically controlled gates. """
+        self.conditional_bits = conditional_bits
+
+    def set_opaque_gates(self, opaque_gates: Dict[OpaqueGate, Optional[List['ICommand']]]):
+        """ Opaque gates used by the circuit (in the order they have to be declared in)
+        mapped onto the commands of their bodies acting on the qubits 0, 1, ... being the arguments,
+        or None if they are declared without a body. """
+        self.opaque_gates = opaque_gates
+
     @abstractmethod
     def get_headers(self) -> List[str]:
         pass
@@ -53,6 +69,43 @@ class IQAsmFormatter(ABC):
     def gate(self, gate: BuiltinGate, qubit: int, params: List[float], control_qubit_ids: Set[int]) -> str:
         pass
 
+    def supports_control_state(self) -> bool:
+        """ Checks if `gate_with_control_state` emits the negative controls natively.
+        Otherwise they are expanded into X gates before the emission. """
+        return False
+
+    def supports_gate_definitions(self) -> bool:
+        """ Checks if the opaque gates with bodies are declared with these bodies (e.g. as OpenQASM `gate`),
+        so the repeated subcircuits can be defined once. """
+        return False
+
+    def gate_with_control_state(
+        self,
+        gate: BuiltinGate,
+        qubit: int,
+        params: List[float],
+        control_qubit_ids: Set[int],
+        negative_control_qubit_ids: Set[int]
+    ) -> List[str]:
+        """ Emits a gate with some controls on |0>, by default conjugating them with X gates. """
+        negations = [self.gate(X_GATE, qubit_id, [], set()) for qubit_id in sorted(negative_control_qubit_ids)]
+        return negations + [self.gate(gate, qubit, params, control_qubit_ids)] + negations
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        """ Emits an uncontrolled gate on each of the qubits, by default one by one. """
+        return [self.gate(gate, qubit_id, params, set()) for qubit_id in qubit_ids]
+
+    def repeat(self, count: int, commands: List['ICommand']) -> List[str]:
+        """ Emits `count` copies of the commands, by default expanded one after another. """
+        lines: List[str] = []
+        for _ in range(count):
+            for command in commands:
+                lines.extend(command.get_lines(self))
+        return lines
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        raise NotImplementedError(f'{type(self).__name__} does not support opaque gates')
+
     @abstractmethod
     def measure(self, qubit: int, bit: int) -> str:
         pass
@@ -61,11 +114,15 @@ class IQAsmFormatter(ABC):
     def reset(self, qubit: int) -> str:
         pass
 
+    def classical_if(self, bit: int, line: str) -> str:
+        """ Makes the operation in `line` conditioned on the classical `bit` being 1. """
+        raise NotImplementedError(f'{type(self).__name__} does not support classically controlled gates')
+
     T = TypeVar('T')
     def _get_for_gate(self, mapping: Dict[BuiltinGate, List[T]], gate: BuiltinGate, num_controls: int) -> T:
         if gate not in mapping:
             raise ValueError(f'Gate {gate} not supported')
-        if len(mapping[gate]) < num_controls:
-            raise ValueError(f'Gate {gate} cannot have at max {num_controls} control qubits.')
+        if len(mapping[gate]) <= num_controls:
+            raise ValueError(f'Gate {gate} cannot have {num_controls} control qubits.')
         return mapping[gate][num_controls]
 
@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from builtin_arithmetics import is_diagonal_gate
+from builtin_gates import X_GATE, Y_GATE
+from quasar_cmd import ICommand, ICmdVisitor, GateCmd, OpaqueGateCmd, RepeatCmd, MeasurementCmd, ResetCmd, ClassicalIfCmd, \
+    flatten_repeats
+
+#
+##
+#
+
+class _Usage(IntEnum):
+    """ What matters about a qubit for the rest of the circuit (ordered from the least). """
+    DEAD = 0  # Nothing, it is never measured
+    ZONLY = 1 # Its populations in the Z basis only (e.g. it is used as a control and then measured)
+    FULL = 2  # Its whole state
+
+
+def _is_diagonal(cmd: GateCmd) -> bool:
+    return is_diagonal_gate(cmd.gate, cmd._params)
+
+
+def _is_monomial(cmd: GateCmd) -> bool:
+    """ Permutation of the basis states up to phases, so it maps Z populations onto Z populations. """
+    return cmd.gate in (X_GATE, Y_GATE) or _is_diagonal(cmd)
+
+
+class _LightConeVisitor(ICmdVisitor):
+    """
+    Goes through the commands backwards keeping the usage of every qubit
+    and drops the commands which cannot change the measurement statistics:
+    - gates acting on qubits which are never measured afterwards,
+    - gates whose target is never measured afterwards and whose controls
+      only matter in the Z basis (e.g. a trailing uncompute of an ancilla),
+    - diagonal gates acting on qubits which only matter in the Z basis.
+    """
+
+    def run(self, commands: List[ICommand], usages: Dict[int, _Usage]) -> List[ICommand]:
+        self._usages = usages
+        self._kept: List[ICommand] = []
+
+        for command in reversed(commands):
+            command.accept(self)
+
+        return self._kept[::-1]
+
+    def _get(self, qubit_id: int) -> _Usage:
+        return self._usages.get(qubit_id, _Usage.DEAD)
+
+    def on_program(self, commands: List[ICommand]) -> None:
+        pass
+
+    def on_gate(self, cmd: GateCmd) -> None:
+        if self._is_kept(cmd):
+            self._kept.append(cmd)
+
+    def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+        # Nothing is known about the opaque gates, so they mix the whole states of their qubits
+        qubit_ids = cmd.get_ordered_qubit_ids()
+        if all(self._get(qubit_id) == _Usage.DEAD for qubit_id in qubit_ids):
+            return
+        for qubit_id in qubit_ids:
+            self._usages[qubit_id] = _Usage.FULL
+        self._kept.append(cmd)
+
+    def on_repeat(self, cmd: RepeatCmd) -> None:
+        # Kept folded, so it is treated like an opaque gate (its measurements are always kept)
+        qubit_ids = cmd.get_qubit_ids()
+        if all(self._get(qubit_id) == _Usage.DEAD for qubit_id in qubit_ids) and not cmd.get_bit_ids():
+            return
+        for qubit_id in qubit_ids:
+            self._usages[qubit_id] = _Usage.FULL
+        self._kept.append(cmd)
+
+    def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+        # The gate is applied or not, either way it is kept only if it matters
+        if self._is_kept(cif.command):
+            self._kept.append(cif)
+
+    def _is_kept(self, cmd: GateCmd) -> bool:
+        """ Checks if the gate matters and updates the usages of its qubits. """
+        target = cmd.get_target_qubit_id()
+        controls = cmd.get_control_qubit_ids()
+        target_usage = self._get(target)
+        any_control_full = any(self._get(qubit_id) == _Usage.FULL for qubit_id in controls)
+
+        if _is_diagonal(cmd):
+            if target_usage < _Usage.FULL and not any_control_full:
+                return False
+            new_target_usage = max(target_usage, _Usage.ZONLY)
+        else:
+            if target_usage == _Usage.DEAD and not any_control_full:
+                return False
+            if any_control_full or target_usage == _Usage.FULL or not _is_monomial(cmd):
+                new_target_usage = _Usage.FULL
+            else:
+                new_target_usage = _Usage.ZONLY
+
+        # A controlled gate is block-diagonal in its controls, so their coherence is not affected
+        for qubit_id in controls:
+            self._usages[qubit_id] = max(self._get(qubit_id), _Usage.ZONLY)
+        self._usages[target] = new_target_usage
+        return True
+
+    def on_measurement(self, m: MeasurementCmd) -> None:
+        # The measurement destroys the coherence, only the outcome matters before it
+        self._usages[m.get_target_qubit_id()] = _Usage.ZONLY
+        self._kept.append(m)
+
+    def on_reset(self, reset: ResetCmd) -> None:
+        qubit_id = reset.get_target_qubit_id()
+        if self._get(qubit_id) != _Usage.DEAD:
+            self._kept.append(reset)
+        self._usages[qubit_id] = _Usage.DEAD
+
+
+def prune_light_cone(commands: List[ICommand], measured_qubit_ids: Optional[Iterable[int]] = None) -> List[ICommand]:
+    """
+    Removes the commands outside of the backward light cone of the measurements.
+    The measured qubits are given with the `MeasurementCmd` commands
+    and `measured_qubit_ids` (qubits measured in the Z basis after the circuit).
+    """
+    usages = {qubit_id: _Usage.ZONLY for qubit_id in measured_qubit_ids or []}
+
+    if not usages and not any(isinstance(command, MeasurementCmd) for command in flatten_repeats(commands)):
+        raise ValueError('Nothing is measured, so the whole circuit would be pruned')
+
+    return _LightConeVisitor().run(commands, usages)
+
+#
+##
+#
+
+@dataclass
+class Compaction:
+    qubit_mapping: Dict[int, int] # original qubit id -> new qubit id
+    bit_mapping: Dict[int, int]   # original bit id -> new bit id
+
+    @property
+    def num_qubits(self) -> int:
+        return len(self.qubit_mapping)
+
+    @property
+    def num_bits(self) -> int:
+        return len(self.bit_mapping)
+
+
+def compact_registers(
+    commands: List[ICommand],
+    measured_qubit_ids: Optional[Iterable[int]] = None
+) -> Tuple[List[ICommand], Compaction]:
+    """ Renumbers the used qubits and bits densely keeping their order. """
+    qubit_ids = set(measured_qubit_ids or [])
+    bit_ids = set()
+    for command in commands:
+        qubit_ids |= command.get_qubit_ids()
+        bit_ids |= command.get_bit_ids()
+
+    compaction = Compaction(
+        qubit_mapping={qubit_id: index for (index, qubit_id) in enumerate(sorted(qubit_ids))},
+        bit_mapping={bit_id: index for (index, bit_id) in enumerate(sorted(bit_ids))},
+    )
+
+    def remapped(command: ICommand) -> ICommand:
+        if isinstance(command, MeasurementCmd):
+            return MeasurementCmd(
+                compaction.qubit_mapping[command.get_target_qubit_id()],
+                compaction.bit_mapping[command.get_target_bit_id()]
+            )
+        elif isinstance(command, ClassicalIfCmd):
+            return ClassicalIfCmd(
+                compaction.bit_mapping[command.get_bit_id()],
+                command.command.remapped(compaction.qubit_mapping)
+            )
+        elif isinstance(command, RepeatCmd):
+            return RepeatCmd(command.count, [remapped(body_command) for body_command in command.body])
+        else:
+            return command.remapped(compaction.qubit_mapping)
+
+    return [remapped(command) for command in commands], compaction
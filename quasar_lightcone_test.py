@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+from builtin_gates import H_GATE, U3_GATE, X_GATE, Z_GATE
+from quasar import All, H, If, Measurement, Program, Quasar, X
+from quasar_cmd import GateCmd, MeasurementCmd, ResetCmd
+from quasar_lightcone import compact_registers, prune_light_cone
+from quasar_qasm import QASMFormatter
+
+#
+##
+#
+
+class LightConeTest(unittest.TestCase):
+    def test_unmeasured(self) -> None:
+        h_0 = GateCmd(H_GATE, 0)
+        x_1 = GateCmd(X_GATE, 1)
+        commands = [h_0, x_1, MeasurementCmd(0, 0)]
+        self.assertListEqual(prune_light_cone(commands), [h_0, commands[2]])
+        self.assertListEqual(prune_light_cone([h_0, x_1], measured_qubit_ids=[1]), [x_1])
+
+    def test_trailing_uncompute(self) -> None:
+        compute = GateCmd(X_GATE, 2, control_qubit_ids={0, 1})
+        body = GateCmd(X_GATE, 3, control_qubit_ids={2})
+        commands = [GateCmd(H_GATE, 0), GateCmd(H_GATE, 1), compute, body, compute, GateCmd(Z_GATE, 3)]
+
+        actual = prune_light_cone(commands, measured_qubit_ids=[0, 1, 3])
+        self.assertListEqual(actual, commands[:4])
+
+    def test_coherence(self) -> None:
+        # The phase of the control matters when it is followed by H
+        commands = [GateCmd(H_GATE, 0), GateCmd(X_GATE, 1, control_qubit_ids={0}), GateCmd(H_GATE, 0)]
+        self.assertListEqual(prune_light_cone(commands, measured_qubit_ids=[0]), commands)
+
+        diagonal = [GateCmd(H_GATE, 0), GateCmd(U3_GATE, 0, params=[0, 0, 0.5]), MeasurementCmd(0, 0)]
+        self.assertListEqual(prune_light_cone(diagonal), [diagonal[0], diagonal[2]])
+
+    def test_reset(self) -> None:
+        commands = [GateCmd(H_GATE, 0), ResetCmd(0), GateCmd(X_GATE, 0), MeasurementCmd(0, 0)]
+        self.assertListEqual(prune_light_cone(commands), commands[1:])
+
+    def test_nothing_measured(self) -> None:
+        with self.assertRaises(ValueError):
+            prune_light_cone([GateCmd(H_GATE, 0)])
+
+    def test_compact_registers(self) -> None:
+        commands = [GateCmd(X_GATE, 5, control_qubit_ids={2}), MeasurementCmd(5, 3)]
+        actual, compaction = compact_registers(commands)
+        self.assertListEqual(actual[:1], [GateCmd(X_GATE, 1, control_qubit_ids={0})])
+        self.assertEqual(actual[1].get_target_qubit_id(), 1)
+        self.assertEqual(actual[1].get_target_bit_id(), 0)
+        self.assertEqual((compaction.num_qubits, compaction.num_bits), (2, 1))
+
+    def test_compile(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0, 0])
+        unused = prgm.Qubit()
+        bits = prgm.CBits(2)
+        prgm += H(qubits[0]) + H(qubits[1]) + X(unused)
+        prgm += If(All(qubits[:3])).Then(X(qubits[3]))
+        prgm += Measurement(qubits[3], bits[1])
+
+        quasar = Quasar()
+        actual = quasar.compile(prgm, QASMFormatter(), prune=True)
+        self.assertIn('qreg q[5];', actual)
+        self.assertIn('creg c[1];', actual)
+        self.assertIn('measure q[3] -> c[0];', actual)
+        self.assertEqual(sum(line.startswith('ccx') for line in actual), 2)
+        self.assertNotIn(unused.get_id(), quasar.compaction.qubit_mapping)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import cmath
+from dataclasses import dataclass
+from math import atan2, cos, sin
+from typing import List, Tuple
+
+from builtin_gates import X_GATE, U3_GATE
+from quasar_cmd import GateCmd
+
+#
+##
+#
+
+@dataclass
+class AncillaReport:
+    num_qubits: int            # Width of the compiled circuit
+    num_gates: int             # Number of the compiled gates
+    max_borrowed_ancillas: int # The maximal number of dirty ancillas borrowed by one gate
+
+
+def get_num_dirty_ancillas(num_controls: int) -> int:
+    """ Returns the number of dirty ancillas the V-chain of `get_dirty_mcx_commands` needs,
+    with fewer of them (but at least one) the gate is split into two halves. """
+    return max(num_controls - 2, 0)
+
+
+def get_dirty_mcx_commands(
+    control_qubit_ids: List[int],
+    target_qubit_id: int,
+    ancilla_qubit_ids: List[int]
+) -> List[GateCmd]:
+    """
+    Multi-controlled X built of CCX gates with ancillas in any state (e.g. borrowed idle
+    data qubits), they are restored at the end.
+    With n - 2 ancillas it is a V-chain of 4(n - 2) CCX gates (Barenco et al., Lemma 7.2).
+    With at least one ancilla, the controls are split into halves which are used
+    as the ancillas of each other (Barenco et al., Lemma 7.3).
+    """
+    num_controls = len(control_qubit_ids)
+    if num_controls <= 2:
+        return [GateCmd(X_GATE, target_qubit_id, control_qubit_ids=set(control_qubit_ids))]
+
+    if len(ancilla_qubit_ids) >= get_num_dirty_ancillas(num_controls):
+        return _get_v_chain_commands(control_qubit_ids, target_qubit_id, ancilla_qubit_ids)
+
+    if not ancilla_qubit_ids:
+        raise ValueError(f'Multi-controlled X with {num_controls} controls requires an ancilla')
+
+    # a ^= AND(A); t ^= AND(B) a; a ^= AND(A); t ^= AND(B) a  ==>  t ^= AND(A) AND(B)
+    ancilla = ancilla_qubit_ids[0]
+    half = (num_controls + 1) // 2
+    controls_a = control_qubit_ids[:half]
+    controls_b = control_qubit_ids[half:] + [ancilla]
+    compute_a = _get_v_chain_commands(controls_a, ancilla, control_qubit_ids[half:] + [target_qubit_id])
+    compute_t = _get_v_chain_commands(controls_b, target_qubit_id, controls_a)
+    return compute_a + compute_t + compute_a + compute_t
+
+
+def _get_v_chain_commands(
+    control_qubit_ids: List[int],
+    target_qubit_id: int,
+    ancilla_qubit_ids: List[int]
+) -> List[GateCmd]:
+    """
+    T_1 = CCX(c_1, c_2, a_1), T_k = CCX(c_k, a_{k-2}, a_{k-1}) for k > 2, a_{n-1} being the target:
+    T_n ... T_3 T_1 T_3 ... T_n  T_{n-1} ... T_3 T_1 T_3 ... T_{n-1}
+    """
+    num_controls = len(control_qubit_ids)
+    if num_controls <= 2:
+        return [GateCmd(X_GATE, target_qubit_id, control_qubit_ids=set(control_qubit_ids))]
+
+    controls = control_qubit_ids
+    chain = list(ancilla_qubit_ids[:get_num_dirty_ancillas(num_controls)]) + [target_qubit_id]
+
+    def toffoli(k: int) -> GateCmd:
+        """ T_k for k = 1 or 3 <= k <= n (1-based). """
+        if k == 1:
+            return GateCmd(X_GATE, chain[0], control_qubit_ids={controls[0], controls[1]})
+        return GateCmd(X_GATE, chain[k - 2], control_qubit_ids={controls[k - 1], chain[k - 3]})
+
+    def v_chain(n: int) -> List[GateCmd]:
+        steps = list(range(n, 2, -1))
+        return [toffoli(k) for k in steps] + [toffoli(1)] + [toffoli(k) for k in steps[::-1]]
+
+    return v_chain(num_controls) + v_chain(num_controls - 1)
+
+
+_EPS = 1e-12
+
+_Matrix = Tuple[Tuple[complex, complex], Tuple[complex, complex]]
+
+
+def _get_u3_matrix(params: List[float]) -> _Matrix:
+    theta, phi, lambda_ = params
+    return (
+        (cos(theta / 2), -cmath.exp(1j * lambda_) * sin(theta / 2)),
+        (cmath.exp(1j * phi) * sin(theta / 2), cmath.exp(1j * (phi + lambda_)) * cos(theta / 2)),
+    )
+
+
+def _get_adjoint(matrix: _Matrix) -> _Matrix:
+    ((m00, m01), (m10, m11)) = matrix
+    return ((m00.conjugate(), m10.conjugate()), (m01.conjugate(), m11.conjugate()))
+
+
+def _get_phase_and_u3_params(matrix: _Matrix) -> Tuple[float, List[float]]:
+    """ Returns `alpha` and U3 parameters such that `matrix` = exp(i alpha) U3(theta, phi, lambda). """
+    ((m00, m01), (m10, m11)) = matrix
+    theta = 2 * atan2(abs(m10), abs(m00))
+    alpha = cmath.phase(m00) if abs(m00) > _EPS else cmath.phase(m10)
+
+    if abs(m10) > _EPS:
+        phi = cmath.phase(m10) - alpha
+        lambda_ = cmath.phase(-m01) - alpha
+    else:
+        phi = 0.0
+        lambda_ = cmath.phase(m11) - alpha
+
+    return alpha, [theta, phi, lambda_]
+
+
+def get_sqrt_u3_params(params: List[float]) -> Tuple[float, List[float]]:
+    """ Returns `alpha` and U3 parameters of V = exp(i alpha) U3(...) such that V V = U3(`params`). """
+    ((m00, m01), (m10, m11)) = _get_u3_matrix(params)
+    s = cmath.sqrt(m00 * m11 - m01 * m10)
+    if abs(m00 + m11 + 2 * s) < _EPS:
+        s = -s
+    t = cmath.sqrt(m00 + m11 + 2 * s)
+    return _get_phase_and_u3_params((((m00 + s) / t, m01 / t), (m10 / t, (m11 + s) / t)))
+
+
+def _get_controlled_u3_commands(
+    control_qubit_id: int,
+    target_qubit_id: int,
+    alpha: float,
+    params: List[float]
+) -> List[GateCmd]:
+    """ Controlled exp(i alpha) U3(`params`), the phase becomes a phase gate on the control. """
+    commands = [GateCmd(U3_GATE, target_qubit_id, control_qubit_ids={control_qubit_id}, params=params)]
+    if abs(alpha) > _EPS:
+        commands.append(GateCmd(U3_GATE, control_qubit_id, params=[0, 0, alpha]))
+    return commands
+
+
+def get_ancilla_free_mcu_commands(
+    control_qubit_ids: List[int],
+    target_qubit_id: int,
+    params: List[float],
+    alpha: float = 0.0
+) -> List[GateCmd]:
+    """
+    Multi-controlled exp(i `alpha`) U3(`params`) without any ancilla (Barenco et al., Lemma 7.5):
+    C^n(U) = C_n(V) C^{n-1}(X)_n C_n(V^dagger) C^{n-1}(X)_n C^{n-1}(V) where V V = U.
+    The target qubit is borrowed by the multi-controlled X gates, so the number of gates
+    is quadratic in the number of controls (instead of linear with ancillas).
+    """
+    if not control_qubit_ids:
+        return [GateCmd(U3_GATE, target_qubit_id, params=params)]
+
+    *rest_qubit_ids, last_qubit_id = control_qubit_ids
+
+    if not rest_qubit_ids:
+        return _get_controlled_u3_commands(last_qubit_id, target_qubit_id, alpha, params)
+
+    sqrt_alpha, sqrt_params = get_sqrt_u3_params(params)
+    sqrt_alpha += alpha / 2
+    adjoint_alpha, adjoint_params = _get_phase_and_u3_params(_get_adjoint(_get_u3_matrix(sqrt_params)))
+    adjoint_alpha -= sqrt_alpha
+
+    mcx_commands = get_dirty_mcx_commands(rest_qubit_ids, last_qubit_id, [target_qubit_id])
+
+    return (
+        _get_controlled_u3_commands(last_qubit_id, target_qubit_id, sqrt_alpha, sqrt_params) +
+        mcx_commands +
+        _get_controlled_u3_commands(last_qubit_id, target_qubit_id, adjoint_alpha, adjoint_params) +
+        mcx_commands +
+        get_ancilla_free_mcu_commands(rest_qubit_ids, target_qubit_id, sqrt_params, sqrt_alpha)
+    )
@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import cmath
+from itertools import product
+from math import cos, pi, sin
+from typing import List
+import unittest
+
+from quasar import All, H, If, Program, Quasar, X
+from quasar_cmd import GateCmd
+from quasar_mcx import get_ancilla_free_mcu_commands, get_dirty_mcx_commands
+from quasar_qasm import QASMFormatter
+
+#
+##
+#
+
+def _simulate_basis(commands: List[GateCmd], state: List[int]) -> List[int]:
+    state = list(state)
+    for cmd in commands:
+        if all(state[qubit_id] for qubit_id in cmd.get_control_qubit_ids()):
+            state[cmd.get_target_qubit_id()] ^= 1
+    return state
+
+
+def _u3(params: List[float]) -> List[List[complex]]:
+    theta, phi, lambda_ = params
+    return [
+        [cos(theta / 2), -cmath.exp(1j * lambda_) * sin(theta / 2)],
+        [cmath.exp(1j * phi) * sin(theta / 2), cmath.exp(1j * (phi + lambda_)) * cos(theta / 2)],
+    ]
+
+
+def _simulate(commands: List[GateCmd], num_qubits: int, index: int) -> List[complex]:
+    """ Simulates U3 and X gates starting from the basis state `index`. """
+    state = [0j] * 2 ** num_qubits
+    state[index] = 1
+    for cmd in commands:
+        matrix = _u3(cmd._params) if cmd._params else [[0, 1], [1, 0]]
+        target = 1 << cmd.get_target_qubit_id()
+        controls = sum(1 << qubit_id for qubit_id in cmd.get_control_qubit_ids())
+        for i in range(len(state)):
+            if i & target == 0 and i & controls == controls:
+                a0, a1 = state[i], state[i | target]
+                state[i] = matrix[0][0] * a0 + matrix[0][1] * a1
+                state[i | target] = matrix[1][0] * a0 + matrix[1][1] * a1
+    return state
+
+
+class DirtyMcxTest(unittest.TestCase):
+    def _check(self, num_controls: int, num_ancillas: int) -> List[GateCmd]:
+        controls = list(range(num_controls))
+        target = num_controls
+        ancillas = list(range(num_controls + 1, num_controls + 1 + num_ancillas))
+        commands = get_dirty_mcx_commands(controls, target, ancillas)
+
+        for state in product([0, 1], repeat=num_controls + 1 + num_ancillas):
+            expected = list(state)
+            expected[target] ^= all(state[:num_controls])
+            self.assertListEqual(_simulate_basis(commands, list(state)), expected)
+        return commands
+
+    def test_v_chain(self) -> None:
+        for num_controls in range(1, 7):
+            commands = self._check(num_controls, max(num_controls - 2, 0))
+            if num_controls > 2:
+                self.assertEqual(len(commands), 4 * (num_controls - 2))
+
+    def test_one_ancilla(self) -> None:
+        for num_controls in range(3, 8):
+            self._check(num_controls, 1)
+
+    def test_no_ancilla(self) -> None:
+        with self.assertRaises(ValueError):
+            get_dirty_mcx_commands([0, 1, 2], 3, [])
+
+    def test_compile(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0] * 7)
+        prgm += H(qubits[0])
+        prgm += If(All(qubits[:5])).Then(X(qubits[5]))
+        prgm += If(All(qubits[:6])).Then(H(qubits[6]))
+
+        quasar = Quasar()
+        clean = quasar.compile(prgm, QASMFormatter())
+        clean_report = quasar.ancilla_report
+        dirty = quasar.compile(prgm, QASMFormatter(), dirty_ancillas=True)
+        dirty_report = quasar.ancilla_report
+
+        self.assertEqual(clean_report.num_qubits, 12)
+        self.assertEqual(dirty_report.num_qubits, 8)
+        self.assertGreater(dirty_report.num_gates, clean_report.num_gates)
+        self.assertEqual(dirty_report.max_borrowed_ancillas, 1)
+        self.assertIn('qreg q[12];', clean)
+        self.assertIn('qreg q[8];', dirty)
+
+
+class AncillaFreeMcuTest(unittest.TestCase):
+    def test_mcu(self) -> None:
+        for (num_controls, params) in product(range(1, 5), [[pi, 0, pi], [0.3, -1.2, 2.5]]):
+            commands = get_ancilla_free_mcu_commands(list(range(num_controls)), num_controls, params)
+            matrix = _u3(params)
+            all_controls = 2 ** num_controls - 1
+
+            for index in range(2 ** (num_controls + 1)):
+                expected = [0j] * 2 ** (num_controls + 1)
+                if index & all_controls == all_controls:
+                    bit = index >> num_controls
+                    expected[all_controls] = matrix[0][bit]
+                    expected[all_controls | 1 << num_controls] = matrix[1][bit]
+                else:
+                    expected[index] = 1
+
+                actual = _simulate(commands, num_controls + 1, index)
+                for (a, e) in zip(actual, expected):
+                    self.assertAlmostEqual(a, e)
+
+
+if __name__ == '__main__':
+    unittest.main()
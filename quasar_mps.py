@@ -0,0 +1,201 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines a matrix product state simulator of the compiled circuits.
+Its memory and time grow with the entanglement (the bond dimension) instead of
+exponentially with the number of qubits, so wide circuits with little entanglement
+(e.g. `Fourier` of product states or shallow arithmetic) can be simulated. """
+
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from builtin_gates import X_GATE, Y_GATE, Z_GATE
+from quasar_sim import ISimulator, apply_matrix, gate_matrix
+
+
+class MPSSimulator(ISimulator):
+    """ Keeps the state as a chain of tensors (one per qubit) of the shape
+    (left bond, 2, right bond). A gate is applied to its qubits made adjacent
+    in the chain by SWAP gates, they are left in their new places afterwards.
+    The singular values splitting the tensors back are truncated to at most
+    `max_bond_dimension` of them, discarding at most `max_truncation_error`
+    of the norm of the state each time. The discarded weight accumulates in
+    `truncation_error` (the fidelity of the final state is at least `1 - truncation_error`). """
+
+    def __init__(
+        self,
+        max_bond_dimension: Optional[int] = None,
+        max_truncation_error: float = 1e-12,
+        seed: Optional[int] = None
+    ) -> None:
+        super().__init__(seed)
+        self.max_bond_dimension = max_bond_dimension
+        self.max_truncation_error = max_truncation_error
+        self.truncation_error = 0.0
+        self.num_swaps = 0
+        self._tensors: List[np.ndarray] = []
+        self._qubit_ids: List[int] = []
+        self._sites: List[int] = []
+        # The tensors left of the center are left-orthonormal and the ones right of it right-orthonormal
+        self._center = 0
+
+    def _initialize(self) -> None:
+        zero = np.zeros((1, 2, 1), dtype=complex)
+        zero[0, 0, 0] = 1
+        self._tensors = [zero.copy() for _ in range(self.qubits_counter)]
+        self._qubit_ids = list(range(self.qubits_counter))
+        self._sites = list(range(self.qubits_counter))
+        self._center = 0
+        self.truncation_error = 0.0
+        self.num_swaps = 0
+
+    def get_bond_dimensions(self) -> List[int]:
+        self._flush()
+        return [tensor.shape[2] for tensor in self._tensors[:-1]]
+
+    def get_state(self) -> np.ndarray:
+        """ Returns the amplitudes of the final state, ordered like in `StatevectorSimulator`. """
+        self._flush()
+        state = np.ones((1, 1), dtype=complex)
+        for tensor in self._tensors:
+            state = np.tensordot(state, tensor, 1)
+            state = state.reshape(-1, tensor.shape[2])
+        state = state.reshape((2,) * self.qubits_counter)
+        # The qubit 0 is the least significant, so it is the last axis
+        return state.transpose([self._sites[qubit_id] for qubit_id in reversed(range(self.qubits_counter))]).reshape(-1)
+
+    def _move_center(self, site: int) -> None:
+        while self._center < site:
+            tensor = self._tensors[self._center]
+            q, r = np.linalg.qr(tensor.reshape(-1, tensor.shape[2]))
+            self._tensors[self._center] = q.reshape(tensor.shape[0], 2, -1)
+            self._tensors[self._center + 1] = np.tensordot(r, self._tensors[self._center + 1], 1)
+            self._center += 1
+        while self._center > site:
+            tensor = self._tensors[self._center]
+            q, r = np.linalg.qr(tensor.reshape(tensor.shape[0], -1).T)
+            self._tensors[self._center] = q.T.reshape(-1, 2, tensor.shape[2])
+            self._tensors[self._center - 1] = np.tensordot(self._tensors[self._center - 1], r.T, 1)
+            self._center -= 1
+
+    def _truncated_svd(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        u, s, vh = np.linalg.svd(matrix, full_matrices=False)
+        weights = s ** 2 / np.sum(s ** 2)
+        # The smallest singular values whose weights sum up to at most `max_truncation_error` are discarded
+        discardable = int(np.sum(np.cumsum(weights[::-1]) <= self.max_truncation_error))
+        keep = max(1, len(s) - discardable)
+        if self.max_bond_dimension is not None:
+            keep = min(keep, self.max_bond_dimension)
+        self.truncation_error += float(np.sum(weights[keep:]))
+        s = s[:keep] / np.linalg.norm(s[:keep])
+        return u[:, :keep], s, vh[:keep]
+
+    def _update_block(self, start: int, end: int, update: Callable[[np.ndarray], None]) -> None:
+        """ Contracts the tensors of the sites from `start` to `end` into a single tensor
+        of the shape (left bond, 2, ..., 2, right bond), updates it in place and splits it back. """
+        self._move_center(start)
+        block = self._tensors[start]
+        for site in range(start + 1, end + 1):
+            block = np.tensordot(block, self._tensors[site], 1)
+        update(block)
+
+        for site in range(start, end):
+            left_bond = block.shape[0]
+            u, s, vh = self._truncated_svd(block.reshape(left_bond * 2, -1))
+            self._tensors[site] = u.reshape(left_bond, 2, -1)
+            block = (s[:, None] * vh).reshape((len(s),) + block.shape[2:])
+        self._tensors[end] = block
+        self._center = end
+
+    def _swap(self, site: int) -> None:
+        """ Swaps the qubits on the sites `site` and `site + 1`. """
+        def swapped(block: np.ndarray) -> None:
+            block[...] = block.transpose(0, 2, 1, 3).copy()
+
+        self._update_block(site, site + 1, swapped)
+        left, right = self._qubit_ids[site], self._qubit_ids[site + 1]
+        self._qubit_ids[site], self._qubit_ids[site + 1] = right, left
+        self._sites[left], self._sites[right] = site + 1, site
+        self.num_swaps += 1
+
+    def _gather(self, qubit_ids: List[int]) -> int:
+        """ Moves the qubits to consecutive sites around their median one and returns the first site. """
+        qubit_ids = sorted(qubit_ids, key=lambda qubit_id: self._sites[qubit_id])
+        median = len(qubit_ids) // 2
+        start = self._sites[qubit_ids[median]] - median
+
+        # The qubits closer to the median are moved first, so the moved ones do not pass each other
+        for index in reversed(range(median)):
+            while self._sites[qubit_ids[index]] < start + index:
+                self._swap(self._sites[qubit_ids[index]])
+        for index in range(median + 1, len(qubit_ids)):
+            while self._sites[qubit_ids[index]] > start + index:
+                self._swap(self._sites[qubit_ids[index]] - 1)
+        return start
+
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        start = self._gather(qubit_ids + list(controls))
+        end = start + len(qubit_ids) + len(controls) - 1
+
+        def applied(block: np.ndarray) -> None:
+            # The first axis of the block is the left bond
+            apply_matrix(
+                block,
+                matrix,
+                [1 + self._sites[qubit_id] - start for qubit_id in qubit_ids],
+                {1 + self._sites[qubit_id] - start: value for qubit_id, value in controls.items()}
+            )
+
+        self._update_block(start, end, applied)
+
+    def _measure(self, qubit: int) -> int:
+        self._move_center(self._sites[qubit])
+        tensor = self._tensors[self._center]
+        probability = float(np.sum(np.abs(tensor[:, 1, :]) ** 2))
+        value = int(self._rng.random() < probability)
+        tensor[:, 1 - value, :] = 0
+        tensor /= math.sqrt(probability if value else 1 - probability)
+        return value
+
+    def expectation_values(self, paulis: List[str]) -> List[float]:
+        """ Returns the expectation values of the Pauli strings (see `StatevectorSimulator.expectation_values`),
+        each one is contracted along the chain. """
+        self._check_pauli_strings(paulis)
+        self._flush()
+        operators = {
+            'I': np.eye(2, dtype=complex),
+            'X': gate_matrix(X_GATE, []),
+            'Y': gate_matrix(Y_GATE, []),
+            'Z': gate_matrix(Z_GATE, []),
+        }
+        values: List[float] = []
+        for pauli in paulis:
+            environment = np.ones((1, 1), dtype=complex)
+            for site, tensor in enumerate(self._tensors):
+                qubit_id = self._qubit_ids[site]
+                operator = operators[pauli[qubit_id] if qubit_id < len(pauli) else 'I']
+                environment = np.einsum('ac,aib,ij,cjd->bd', environment, tensor.conj(), operator, tensor)
+            values.append(float(environment[0, 0].real))
+        return values
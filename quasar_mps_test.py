@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+import numpy as np
+
+from quasar import All, CX, H, If, Measurement, Program, Quasar, RY, Swap, T, X
+from qfourier import Fourier
+from quasar_mps import MPSSimulator
+from quasar_sim import StatevectorSimulator
+
+#
+##
+#
+
+class MPSSimulatorTest(unittest.TestCase):
+    def test_state(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 1, 0, 0, 1])
+        prgm += H(qubits[0]) + RY(qubits[3], 0.3) + T(qubits[3])
+        prgm += If(All([qubits[0], qubits[4]])).Then(X(qubits[2]))
+        prgm += If(All([qubits[3], qubits[1], qubits[0]])).Then(H(qubits[4]))
+        prgm += Swap(qubits[4], qubits[1]) + CX(qubits[2], qubits[0])
+
+        expected = StatevectorSimulator()
+        Quasar().compile(prgm, expected)
+        actual = MPSSimulator()
+        Quasar().compile(prgm, actual)
+        np.testing.assert_allclose(actual.get_state(), expected.get_state(), atol=1e-9)
+        np.testing.assert_allclose(
+            actual.expectation_values(['ZIZ', 'XIIY', 'IIIIX']),
+            expected.expectation_values(['ZIZ', 'XIIY', 'IIIIX']),
+            atol=1e-9
+        )
+        self.assertGreater(actual.num_swaps, 0)
+        self.assertLess(actual.truncation_error, 1e-9)
+
+    def test_wide_circuit(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(24 * [1, 0])
+        prgm += Fourier(qubits)
+
+        simulator = MPSSimulator()
+        Quasar().compile(prgm, simulator)
+        # The Fourier transform of a basis state is a product state
+        self.assertEqual(max(simulator.get_bond_dimensions()), 1)
+        self.assertAlmostEqual(simulator.expectation_values(['X'])[0], 1)
+
+    def test_truncation(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        bits = prgm.CBits(1)
+        prgm += H(qubits[0]) + CX(qubits[0], qubits[1]) + CX(qubits[1], qubits[2])
+
+        simulator = MPSSimulator()
+        Quasar().compile(prgm, simulator)
+        self.assertListEqual(simulator.get_bond_dimensions(), [2, 2])
+        self.assertAlmostEqual(simulator.truncation_error, 0)
+
+        simulator = MPSSimulator(max_bond_dimension=1)
+        Quasar().compile(prgm, simulator)
+        self.assertListEqual(simulator.get_bond_dimensions(), [1, 1])
+        self.assertAlmostEqual(simulator.truncation_error, 0.5)
+
+        prgm += Measurement(qubits[2], bits[0])
+        simulator = MPSSimulator(seed=1)
+        Quasar().compile(prgm, simulator)
+        value = 1 - 2 * simulator.bits[0]
+        np.testing.assert_allclose(simulator.expectation_values(['Z', 'IZ', 'ZZZ']), [value, value, value], atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,84 +20,261 @@
 # SOFTWARE.
 #
 
-from itertools import chain
-from typing import List, Set, Tuple
+from typing import Iterable, Iterator, List, Optional
 
-from builtin_arithmetics import invert_gate
+from builtin_arithmetics import check_commutation, invert_gate
+from builtin_gates import X_GATE
 from quasar_cmd import ICommand, ICmdVisitor, \
-  GateCmd, MeasurementCmd, ResetCmd
+  GateCmd, OpaqueGateCmd, BroadcastCmd, RepeatCmd, MeasurementCmd, ResetCmd, ClassicalIfCmd
+from quasar_dag import CircuitDag, DagNode
 
+# The number of commands an inverse is looked for behind on each wire, so that the optimization stays linear
+_MAX_COMMUTATION_DEPTH = 8
 
-class _CmdStackInserterVisitor(ICmdVisitor):
-  def run(
-    self,
-    commands: List[ICommand],
-    commands_stack: List[List[Tuple[int, ICommand]]]
-  ) -> List[List[Tuple[int, ICommand]]]:
+
+class _DagInserterVisitor(ICmdVisitor):
+  def __init__(self, dag: CircuitDag) -> None:
+    self._dag = dag
+
+  def run(self, commands: Iterable[ICommand]) -> CircuitDag:
 
     #
-    # Stacks for individual qubits, representing all the gates/operations/...
-    #   affecting that qubit, putting the latest applied operation on the top of the stack.
+    # Wires of individual qubits, representing all the gates/operations/...
+    #   affecting that qubit, the latest applied operation being the last one.
     #
     # Prog: X(0), X(1), CX(1, 2), CCX(0, 1, 2), ...
     #
-    #             [CCX(0,1,2)]
-    # [CCX(0,1,2)][CX(1,2)   ][CCX(0,1,2)]
-    # [X(0)      ][X(1)      ][CX(1,2)   ]
-    # [----Q0----][----Q1----][----Q2----]...[----QN----]
+    # Q0: [X(0)]-------------------[CCX(0,1,2)]
+    # Q1: [X(1)]---[CX(1,2)]-------[CCX(0,1,2)]
+    # Q2:          [CX(1,2)]-------[CCX(0,1,2)]
     #
-    self._commands_stack = commands_stack
+    for command in commands:
+      command.accept(self)
 
-    self._id = 0
+    return self._dag
 
-    for (id_, command) in enumerate(commands):
-      self.set_id(id_)
-      command.accept(self)
+  def _fold_negation(self, cmd: GateCmd) -> bool:
+    """ Folds X(q), G, X(q), where q is a control of G, into G controlled on the negated q. """
+    if cmd._gate != X_GATE or cmd._control_qubit_ids:
+      return False
+
+    qubit_id = cmd._target_qubit_id
+    last_node = self._dag.get_last(qubit_id)
+    if last_node is None or not isinstance(last_node.command, GateCmd) \
+        or qubit_id not in last_node.command._control_qubit_ids:
+      return False
 
-    return self._commands_stack
+    negation_node = last_node.prev[qubit_id]
+    if negation_node is not None and isinstance(negation_node.command, BroadcastCmd) \
+        and negation_node.command._gate == X_GATE:
+      negation_node = self._split(negation_node, qubit_id)
+    if negation_node is None or not isinstance(negation_node.command, GateCmd) \
+        or negation_node.command != cmd:
+      return False
 
-  def set_id(self, id_: int) -> None:
-    self._id = id_
+    gate = last_node.command
+    folded = GateCmd(
+      gate._gate,
+      gate._target_qubit_id,
+      gate._control_qubit_ids,
+      gate._params,
+      gate._relative_phase,
+      gate._negative_control_qubit_ids ^ {qubit_id}
+    )
+    self._dag.remove(negation_node)
+
+    if all(self._dag.get_last(qubit_id) is last_node for qubit_id in last_node.qubit_ids):
+      # The folded gate may cancel out with its predecessors now
+      self._dag.remove(last_node)
+      self.on_gate(folded)
+    else:
+      self._dag.replace(last_node, [folded])
+    return True
+
+  def _split(self, node: DagNode, qubit_id: int) -> DagNode:
+    """ Replaces the broadcast `node` with its gates, returns the gate acting on `qubit_id`. """
+    new_nodes = self._dag.replace(node, node.command.expanded())
+    return next(new_node for new_node in new_nodes if new_node.qubit_ids == (qubit_id,))
 
   def on_gate(self, cmd: GateCmd) -> None:
-    affected_qubit_ids: Set[int] = {cmd._target_qubit_id} | cmd._control_qubit_ids
+    if self._fold_negation(cmd):
+      return
 
-    inverse_gate, inverse_params = invert_gate(cmd._gate, cmd._params)
+    # The command cancels out only with the last node of all its wires
+    last_node = self._dag.get_last(cmd._target_qubit_id)
+
+    if last_node is not None and isinstance(last_node.command, BroadcastCmd) and not cmd._control_qubit_ids:
+      # The gate cancels out with a single gate of the broadcast
+      if (last_node.command._gate, last_node.command._params) == invert_gate(cmd._gate, cmd._params):
+        last_node = self._split(last_node, cmd._target_qubit_id)
 
-    eliminate = True
-    for qubit_id in affected_qubit_ids:
-      if not self._commands_stack[qubit_id]:
-        eliminate = False
-        continue
-      _, last_cmd = self._commands_stack[qubit_id][-1]
-      if not isinstance(last_cmd, GateCmd):
-        eliminate = False
-        continue
-      if last_cmd._control_qubit_ids != cmd._control_qubit_ids:
-        eliminate = False
-      if last_cmd._target_qubit_id != cmd._target_qubit_id:
-        eliminate = False
-      if last_cmd._gate != inverse_gate:
-        eliminate = False
-      if last_cmd._params != inverse_params:
+    eliminate = (
+      last_node is not None
+      and isinstance(last_node.command, GateCmd)
+      and last_node.command._target_qubit_id == cmd._target_qubit_id
+      and last_node.command._control_qubit_ids == cmd._control_qubit_ids
+      and last_node.command._negative_control_qubit_ids == cmd._negative_control_qubit_ids
+    )
+
+    if eliminate:
+      inverse_gate, inverse_params = invert_gate(cmd._gate, cmd._params)
+      eliminate = (
+        last_node.command._gate == inverse_gate
         # TODO(adsz): Allow approx.
-        eliminate = False
+        and last_node.command._params == inverse_params
+        and all(self._dag.get_last(qubit_id) is last_node for qubit_id in cmd._control_qubit_ids)
+      )
+
+    if not eliminate:
+      # The inverse may be hidden behind the commands it commutes with, e.g. T(0), CZ(0, 1), TDG(0)
+      inverse_gate, inverse_params = invert_gate(cmd._gate, cmd._params)
+      last_node = self._find_inverse(cmd, GateCmd(
+        inverse_gate,
+        cmd._target_qubit_id,
+        cmd._control_qubit_ids,
+        inverse_params,
+        cmd._relative_phase,
+        cmd._negative_control_qubit_ids
+      ))
+      eliminate = last_node is not None
 
     if eliminate:
-      for qubit_id in affected_qubit_ids:
-        self._commands_stack[qubit_id].pop()
+      self._dag.remove(last_node)
+    else:
+      self._dag.append(cmd)
+
+  def _find_inverse(self, cmd: ICommand, inverse: ICommand) -> Optional[DagNode]:
+    """ Finds the `inverse` of `cmd` going back along its wires over (a bounded number of)
+    the commands it commutes with. """
+    qubit_ids = cmd.get_qubit_ids()
+
+    # The nearest inverse is looked up first, the commutation is checked only on the way to it
+    qubit_id = next(iter(qubit_ids))
+    found = self._dag.get_last(qubit_id)
+    depth = 0
+    while found is not None and found.command != inverse:
+      if depth == _MAX_COMMUTATION_DEPTH:
+        return None
+      found = found.prev[qubit_id]
+      depth += 1
+
+    if found is None:
+      return None
+
+    for qubit_id in qubit_ids:
+      node = self._dag.get_last(qubit_id)
+      depth = 0
+      while node is not found:
+        if depth == _MAX_COMMUTATION_DEPTH or not check_commutation(cmd, node.command):
+          return None
+        node = node.prev[qubit_id]
+        depth += 1
+
+    return found
+
+  def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+    inverse_node = None
+    if cmd.gate.inverse is not None:
+      inverse_gate, inverse_params = invert_gate(cmd.gate, cmd.params)
+      inverse_node = self._find_inverse(cmd, OpaqueGateCmd(inverse_gate, cmd.get_ordered_qubit_ids(), inverse_params))
+    if inverse_node is not None:
+      self._dag.remove(inverse_node)
     else:
-      for qubit_id in affected_qubit_ids:
-        self._commands_stack[qubit_id].append((self._id, cmd))
+      self._dag.append(cmd)
+
+  def _interacts(self, cmd: BroadcastCmd, qubit_id: int) -> bool:
+    """ Checks if a gate of the broadcast could cancel out or fold into the last command of its wire. """
+    last_node = self._dag.get_last(qubit_id)
+    if last_node is None:
+      return False
+
+    inverse = invert_gate(cmd._gate, cmd._params)
+    last = last_node.command
+    if isinstance(last, BroadcastCmd):
+      return (last._gate, last._params) == inverse
+    if isinstance(last, GateCmd):
+      if cmd._gate == X_GATE and qubit_id in last._control_qubit_ids:
+        return True
+      return not last._control_qubit_ids and (last._gate, last._params) == inverse
+    return False
+
+  def on_broadcast(self, cmd: BroadcastCmd) -> None:
+    inverse_gate, inverse_params = invert_gate(cmd._gate, cmd._params)
+    last_nodes = {self._dag.get_last(qubit_id) for qubit_id in cmd._qubit_ids}
+
+    if len(last_nodes) == 1:
+      # The whole broadcast cancels out with an inverse one on the same qubits
+      last_node = next(iter(last_nodes))
+      last = last_node.command if last_node is not None else None
+      if isinstance(last, BroadcastCmd) and (last._gate, last._params) == (inverse_gate, inverse_params) \
+          and last.get_qubit_ids() == cmd.get_qubit_ids():
+        self._dag.remove(last_node)
+        return
+
+    if any(self._interacts(cmd, qubit_id) for qubit_id in cmd._qubit_ids):
+      # Expanded only if some of its gates are optimized out
+      for command in cmd.expanded():
+        self.on_gate(command)
+      return
+
+    self._dag.append(cmd)
+
+  @staticmethod
+  def _optimized(commands: List[ICommand]) -> List[ICommand]:
+    return _DagInserterVisitor(CircuitDag()).run(commands).get_commands()
+
+  def on_repeat(self, cmd: RepeatCmd) -> None:
+    """ The body is optimized once. The seam between its consecutive copies is optimized by rotating
+    the loop: body^n = prefix (suffix prefix)^(n-1) suffix, where the prefix is the part of the body
+    optimized with the end of the previous copy. """
+    body = self._optimized(cmd.body)
+    if not body:
+      return
+
+    # The second copy of the body is inserted after the first one to find the seam
+    dag = CircuitDag()
+    inserter = _DagInserterVisitor(dag)
+    inserter.run(body)
+    seam_length = 0
+    for (index, command) in enumerate(body):
+      size = len(dag)
+      command.accept(inserter)
+      if len(dag) != size + 1:
+        seam_length = index + 1
+
+    # Two copies cancel out
+    count = cmd.count % 2 if len(dag) == 0 else cmd.count
+
+    if count > 1 and seam_length > 0:
+      prefix, suffix = body[:seam_length], body[seam_length:]
+      loop = self._optimized(suffix + prefix)
+      if len(loop) < len(body):
+        for command in prefix:
+          command.accept(self)
+        if loop:
+          # The rotated loop may have a seam of its own
+          self.on_repeat(RepeatCmd(count - 1, loop))
+        for command in suffix:
+          command.accept(self)
+        return
+
+    if count == 1:
+      for command in body:
+        command.accept(self)
+    elif count > 1:
+      self._dag.append(RepeatCmd(count, body))
 
   def on_program(self, commands: List[ICommand]) -> None:
     pass
 
   def on_measurement(self, m: MeasurementCmd) -> None:
-    self._commands_stack[m.get_target_qubit_id()].append((self._id, m))
+    self._dag.append(m)
 
   def on_reset(self, reset: ResetCmd) -> None:
-    self._commands_stack[reset.get_target_qubit_id()].append((self._id, reset))
+    self._dag.append(reset)
+
+  def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+    self._dag.append(cif)
 
 #
 ##
@@ -105,13 +282,26 @@ class _CmdStackInserterVisitor(ICmdVisitor):
 
 class QuasarOpt:
   @staticmethod
-  def _serialize(commands_stacks: List[List[Tuple[int, ICommand]]]) -> List[ICommand]:
-    flat = chain.from_iterable(commands_stacks)
-    unique = dict(flat).items()
-    return [cmd for (_, cmd) in sorted(unique)]
+  def run(commands: List[ICommand], max_used_qubit_id: int) -> List[ICommand]:
+    # The DAG grows its wires on demand, `max_used_qubit_id` is kept for compatibility
+    dag = _DagInserterVisitor(CircuitDag()).run(commands)
+    return dag.get_commands()
 
   @staticmethod
-  def run(commands: List[ICommand], max_used_qubit_id: int) -> List[ICommand]:
-    commands_stacks: List[List[Tuple[int, ICommand]]] = [[] for _ in range(max_used_qubit_id + 1)]
-    commands_stacks = _CmdStackInserterVisitor().run(commands, commands_stacks)
-    return QuasarOpt._serialize(commands_stacks)
+  def stream(commands: Iterable[ICommand], window_size: int) -> Iterator[ICommand]:
+    """ Optimizes `commands` on the fly keeping at most `window_size` pending commands.
+    The oldest command is emitted once it leaves the window, so the memory usage does not
+    depend on the circuit length, and only the cancellations within the window are found. """
+    if window_size < 1:
+      raise ValueError(f'Window size has to be positive, got {window_size}')
+
+    dag = CircuitDag()
+    inserter = _DagInserterVisitor(dag)
+
+    for command in commands:
+      command.accept(inserter)
+      while len(dag) > window_size:
+        yield dag.pop_first().command
+
+    while len(dag) > 0:
+      yield dag.pop_first().command
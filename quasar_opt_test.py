@@ -22,9 +22,12 @@
 
 from typing import List
 import unittest
+from unittest.mock import patch
 
-from builtin_gates import X_GATE, U3_GATE, Y_GATE, Z_GATE, H_GATE
-from quasar_cmd import ICommand, ResetCmd, MeasurementCmd, GateCmd
+from builtin_arithmetics import check_commutation
+from builtin_gates import X_GATE, U3_GATE, Y_GATE, Z_GATE, H_GATE, T_GATE, TDG_GATE, RZ_GATE
+from opaque_gates import negated_params, register_opaque_gate, unregister_opaque_gate
+from quasar_cmd import ICommand, ResetCmd, MeasurementCmd, GateCmd, OpaqueGateCmd, BroadcastCmd, RepeatCmd
 from quasar_opt import QuasarOpt
 
 #
@@ -133,7 +136,8 @@ class QCompilerTest(unittest.TestCase):
       cmd_3: ICommand = GateCmd(cmd_class, 1, control_qubit_ids={0})
       commands: List[ICommand] = [cmd_1, cmd_2, cmd_3]
       actual: List[ICommand] = QuasarOpt().run(commands, min_unused_qubit_id)
-      expected: List[ICommand] = [cmd_1, cmd_2, cmd_3]
+      # The diagonal gates commute, so cmd_1 cancels out with cmd_3
+      expected: List[ICommand] = [cmd_2] if cmd_class == Z_GATE else [cmd_1, cmd_2, cmd_3]
       self.assertListEqual(actual, expected)
 
     def _test_two_qubits_command_4(self, cmd_class) -> None:
@@ -273,7 +277,8 @@ class QCompilerTest(unittest.TestCase):
       cmd_3: ICommand = GateCmd(cmd_class, 2, control_qubit_ids={0, 1})
       commands: List[ICommand] = [cmd_1, cmd_2, cmd_3]
       actual: List[ICommand] = QuasarOpt().run(commands, min_unused_qubit_id)
-      expected: List[ICommand] = [cmd_1, cmd_2, cmd_3]
+      # The X gate on the target commutes with the controlled X gates
+      expected: List[ICommand] = [cmd_2]
       self.assertListEqual(actual, expected)
 
     def _test_one_qubit_reset_command_1(self, cmd_class_1, cmd_class_2) -> None:
@@ -433,5 +438,142 @@ class QCompilerTest(unittest.TestCase):
           self._test_three_qubits_reset_command_3(cmd_3q_class, cmd_reset)
 
 
+    def test_fold_negative_controls(self) -> None:
+      negation: ICommand = GateCmd(X_GATE, 0)
+      cmd_1: ICommand = GateCmd(Z_GATE, 2, control_qubit_ids={0, 1})
+      cmd_2: ICommand = GateCmd(H_GATE, 1)
+
+      actual: List[ICommand] = QuasarOpt.run([negation, cmd_1, negation, cmd_2], 3)
+      expected: List[ICommand] = [
+        GateCmd(Z_GATE, 2, control_qubit_ids={0, 1}, negative_control_qubit_ids={0}),
+        cmd_2,
+      ]
+      self.assertListEqual(actual, expected)
+
+      # The folded gate cancels out with its negatively controlled twin
+      actual = QuasarOpt.run([negation, cmd_1, negation, expected[0]], 3)
+      self.assertListEqual(actual, [])
+
+    def test_commuting_gates(self) -> None:
+      t: ICommand = GateCmd(T_GATE, 0)
+      cz: ICommand = GateCmd(Z_GATE, 1, control_qubit_ids={0})
+      tdg: ICommand = GateCmd(TDG_GATE, 0)
+      self.assertListEqual(QuasarOpt.run([t, cz, tdg], 2), [cz])
+
+      rz: ICommand = GateCmd(RZ_GATE, 0, params=[0.3])
+      crz: ICommand = GateCmd(RZ_GATE, 0, control_qubit_ids={1}, params=[0.7])
+      rz_inverse: ICommand = GateCmd(RZ_GATE, 0, params=[-0.3])
+      self.assertListEqual(QuasarOpt.run([rz, crz, rz_inverse], 2), [crz])
+
+      x: ICommand = GateCmd(X_GATE, 1)
+      cx: ICommand = GateCmd(X_GATE, 1, control_qubit_ids={2})
+      self.assertListEqual(QuasarOpt.run([x, cx, x], 3), [cx])
+
+      # The gates in between have to commute on all the wires
+      cx_1: ICommand = GateCmd(X_GATE, 0, control_qubit_ids={1})
+      self.assertListEqual(QuasarOpt.run([t, cx_1, tdg], 2), [t, cx_1, tdg])
+      self.assertListEqual(QuasarOpt.run([cz, x, cz], 2), [cz, x, cz])
+
+    def test_commuting_gates_linear(self) -> None:
+      def count_steps(commands: List[ICommand]) -> int:
+        steps = [0]
+
+        def counting_eq(cmd: GateCmd, other: object) -> bool:
+          steps[0] += 1
+          return eq(cmd, other)
+
+        def counting_commutation(cmd_1: ICommand, cmd_2: ICommand) -> bool:
+          steps[0] += 1
+          return check_commutation(cmd_1, cmd_2)
+
+        eq = GateCmd.__eq__
+        with patch.object(GateCmd, '__eq__', counting_eq), \
+            patch('quasar_opt.check_commutation', counting_commutation):
+          QuasarOpt.run(commands, 2)
+        return steps[0]
+
+      for n in (500, 4000):
+        # The inverses are behind a long run of the commands they commute with
+        commands: List[ICommand] = [GateCmd(T_GATE, i % 2) for i in range(n)]
+        commands += [GateCmd(Z_GATE, 1, control_qubit_ids={0}), GateCmd(TDG_GATE, 0), GateCmd(RZ_GATE, 1, params=[0.5])] * n
+        self.assertLess(count_steps(commands), 50 * len(commands))
+
+    def test_opaque_gates(self) -> None:
+      rzz = register_opaque_gate('opt_rzz', 2, 1, inverse=negated_params, commutes_with={'Z'})
+      self.addCleanup(unregister_opaque_gate, 'opt_rzz')
+      cmd_1: ICommand = OpaqueGateCmd(rzz, [0, 1], [0.5])
+      cmd_2: ICommand = GateCmd(Z_GATE, 1)
+      cmd_3: ICommand = OpaqueGateCmd(rzz, [0, 1], [-0.5])
+
+      actual: List[ICommand] = QuasarOpt.run([cmd_1, cmd_2, cmd_3], 2)
+      self.assertListEqual(actual, [cmd_2])
+
+      # The qubits have to be in the same order and the gates in between have to commute
+      cmd_4: ICommand = OpaqueGateCmd(rzz, [1, 0], [-0.5])
+      self.assertListEqual(QuasarOpt.run([cmd_1, cmd_4], 2), [cmd_1, cmd_4])
+      cmd_5: ICommand = GateCmd(H_GATE, 1)
+      self.assertListEqual(QuasarOpt.run([cmd_1, cmd_5, cmd_3], 2), [cmd_1, cmd_5, cmd_3])
+
+    def test_broadcast(self) -> None:
+      cmd_1: ICommand = BroadcastCmd(H_GATE, [0, 1, 2])
+      cmd_2: ICommand = GateCmd(X_GATE, 3, control_qubit_ids={4})
+      cmd_3: ICommand = BroadcastCmd(H_GATE, [2, 1, 0])
+
+      # The inverse broadcast on the same qubits cancels out as a whole
+      actual: List[ICommand] = QuasarOpt.run([cmd_1, cmd_2, cmd_3], 5)
+      self.assertListEqual(actual, [cmd_2])
+
+      # Otherwise it is split into gates only if some of them cancel out
+      cmd_4: ICommand = BroadcastCmd(H_GATE, [1, 2, 3])
+      actual = QuasarOpt.run([cmd_1, cmd_4], 4)
+      self.assertListEqual(actual, [GateCmd(H_GATE, 0), GateCmd(H_GATE, 3)])
+      cmd_5: ICommand = GateCmd(X_GATE, 1, control_qubit_ids={0})
+      cmd_6: ICommand = BroadcastCmd(H_GATE, [1, 3])
+      actual = QuasarOpt.run([cmd_1, cmd_5, cmd_6], 4)
+      self.assertListEqual(actual, [cmd_1, cmd_5, cmd_6])
+
+      # The negations of a register fold into the negative controls
+      cmd_7: ICommand = BroadcastCmd(X_GATE, [0, 1])
+      cmd_8: ICommand = GateCmd(Z_GATE, 2, control_qubit_ids={0, 1})
+      actual = QuasarOpt.run([cmd_7, cmd_8, cmd_7], 3)
+      self.assertListEqual(actual, [GateCmd(Z_GATE, 2, control_qubit_ids={0, 1}, negative_control_qubit_ids={0, 1})])
+
+    def test_repeat(self) -> None:
+      cmd_1: ICommand = GateCmd(H_GATE, 0)
+      cmd_2: ICommand = GateCmd(X_GATE, 1, control_qubit_ids={0})
+      cmd_3: ICommand = GateCmd(H_GATE, 1)
+
+      # The body is optimized once, without a seam it is kept folded
+      actual: List[ICommand] = QuasarOpt.run([RepeatCmd(5, [cmd_1, cmd_2, cmd_3, cmd_3])], 2)
+      self.assertListEqual(actual, [RepeatCmd(5, [cmd_1, cmd_2])])
+
+      # The H gates at the seam cancel out: (H CX H)^n = H CX^n H
+      actual = QuasarOpt.run([RepeatCmd(5, [cmd_1, cmd_2, cmd_1])], 2)
+      self.assertListEqual(actual, [cmd_1, cmd_2, cmd_1])
+      actual = QuasarOpt.run([RepeatCmd(6, [cmd_1, cmd_2, cmd_1])], 2)
+      self.assertListEqual(actual, [])
+
+      # A repeat is not optimized with its neighbours
+      actual = QuasarOpt.run([cmd_3, RepeatCmd(3, [cmd_2, cmd_3]), cmd_3], 2)
+      self.assertListEqual(actual, [cmd_3, RepeatCmd(3, [cmd_2, cmd_3]), cmd_3])
+
+    def test_stream(self) -> None:
+      cmd_1: ICommand = GateCmd(X_GATE, 1, control_qubit_ids={0})
+      cmd_2: ICommand = GateCmd(H_GATE, 2)
+      cmd_3: ICommand = GateCmd(X_GATE, 1, control_qubit_ids={0})
+      cmd_4: ICommand = GateCmd(H_GATE, 2)
+      commands: List[ICommand] = [cmd_1, cmd_2, cmd_3, cmd_4]
+
+      actual: List[ICommand] = list(QuasarOpt.stream(iter(commands), window_size=2))
+      self.assertListEqual(actual, [])
+
+      # cmd_1 leaves the window before cmd_3 arrives
+      actual = list(QuasarOpt.stream(iter([cmd_1, cmd_2, cmd_4, cmd_3]), window_size=1))
+      self.assertListEqual(actual, [cmd_1, cmd_3])
+
+      with self.assertRaises(ValueError):
+        list(QuasarOpt.stream(commands, window_size=0))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -20,9 +20,11 @@
 # SOFTWARE.
 #
 
-from typing import List, Set
+from typing import List, Optional, Set
 
-from builtin_gates import X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, BuiltinGate
+from builtin_gates import X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, BuiltinGate, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate, is_qelib1_gate
 from quasar_formatter import IQAsmFormatter
 
 
@@ -33,29 +35,103 @@ class QASMFormatter(IQAsmFormatter):
         Z_GATE: ['z', 'cz'],
         H_GATE: ['h', 'ch'],
         U3_GATE: ['u3', 'cu3'],
+        RX_GATE: ['rx', 'crx'],
+        RY_GATE: ['ry', 'cry'],
+        RZ_GATE: ['rz', 'crz'],
+        P_GATE: ['u1', 'cu1'],
+        S_GATE: ['s'],
+        SDG_GATE: ['sdg'],
+        T_GATE: ['t'],
+        TDG_GATE: ['tdg'],
     }
 
     def get_headers(self) -> List[str]:
         return [
             f'OPENQASM 2.0;',
             f'include "qelib1.inc";',
+        ] + self._get_declarations() + [
             f' ',
             f'qreg q[{self.qubits_counter}];',
             f'creg c[{self.bits_counter}];',
+        ] + [
+            # OpenQASM 2.0 conditions compare whole registers, so each conditional bit has its own
+            f'creg c{bit}[1];' for bit in sorted(self.conditional_bits)
+        ] + [
             f' '
         ]
 
     def get_footers(self) -> List[str]:
         return []
 
+    def supports_gate_definitions(self) -> bool:
+        return True
+
+    def _get_declarations(self) -> List[str]:
+        lines: List[str] = []
+
+        for (gate, body) in self.opaque_gates.items():
+            if is_qelib1_gate(gate):
+                continue
+            declaration = gate.name
+            if gate.num_params:
+                declaration += '(' + ', '.join(f'p{index}' for index in range(gate.num_params)) + ')'
+            declaration += ' ' + ', '.join(f'a{index}' for index in range(gate.num_qubits))
+
+            if body is None:
+                lines.append(f'opaque {declaration};')
+            else:
+                body_formatter = _GateBodyFormatter()
+                lines.append(f'gate {declaration} {{')
+                lines.extend('    ' + line for command in body for line in command.get_lines(body_formatter))
+                lines.append('}')
+
+        return lines
+
+    def _get_qubit(self, qubit_id: int) -> str:
+        return f'q[{qubit_id}]'
+
+    def _get_register(self) -> Optional[str]:
+        return 'q'
+
     def gate(self, gate: BuiltinGate, qubit: int, params: List[float], control_qubit_ids: Set[int]) -> str:
         operator_name = self._get_for_gate(self.GATES_MAPPING, gate, len(control_qubit_ids))
         if params:
             operator_name += '(' + ', '.join(map(str, params)) + ')'
-        return operator_name + ' ' + ', '.join(map(lambda i: f'q[{i}]', sorted(control_qubit_ids) + [qubit])) + ';'
+        return operator_name + ' ' + ', '.join(map(self._get_qubit, sorted(control_qubit_ids) + [qubit])) + ';'
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        """ A gate on the whole register uses the broadcast syntax (e.g. `h q;`). """
+        register = self._get_register()
+        if register is None or sorted(qubit_ids) != list(range(self.qubits_counter)):
+            return super().broadcast(gate, qubit_ids, params)
+        operator_name = self._get_for_gate(self.GATES_MAPPING, gate, 0)
+        if params:
+            operator_name += '(' + ', '.join(map(str, params)) + ')'
+        return [f'{operator_name} {register};']
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        operator_name = gate.name
+        if params:
+            operator_name += '(' + ', '.join(map(str, params)) + ')'
+        return operator_name + ' ' + ', '.join(map(self._get_qubit, qubit_ids)) + ';'
 
     def measure(self, qubit: int, bit: int) -> str:
+        if bit in self.conditional_bits:
+            return f'measure q[{qubit}] -> c{bit}[0];'
         return f'measure q[{qubit}] -> c[{bit}];'
 
     def reset(self, qubit: int) -> str:
         return f'reset q[{qubit}];'
+
+    def classical_if(self, bit: int, line: str) -> str:
+        return f'if(c{bit}==1) {line}'
+
+
+class _GateBodyFormatter(QASMFormatter):
+    """ Formats the body of a `gate` declaration, the qubits are its arguments `a0`, `a1`, ... """
+
+    def _get_qubit(self, qubit_id: int) -> str:
+        return f'a{qubit_id}'
+
+    def _get_register(self) -> Optional[str]:
+        return None
@@ -16,6 +16,11 @@ class QasmFormatterTest(unittest.TestCase):
         self.assertEqual(f.gate(X_GATE, 10, [], {20, 30}).strip(),
                          'ccx q[20], q[30], q[10];')
 
+    def test_too_many_controls(self) -> None:
+        f = QASMFormatter()
+        with self.assertRaises(ValueError):
+            f.gate(Z_GATE, 10, [], {20, 30})
+
     def test_is_loadable(self) -> None:
         f = QASMFormatter()
         f.set_qubits_counter(2)
@@ -24,7 +24,9 @@ from typing import Any, List, Set
 
 import qiskit
 
-from builtin_gates import BuiltinGate, X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE
+from builtin_gates import BuiltinGate, X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate, is_qelib1_gate
 from quasar import IQAsmFormatter
 
 
@@ -39,8 +41,41 @@ class QiskitFormatter(IQAsmFormatter):
         Z_GATE: ['z', 'cz'],
         H_GATE: ['h', 'ch'],
         U3_GATE: ['u3', 'cu3'],
+        RX_GATE: ['rx', 'crx'],
+        RY_GATE: ['ry', 'cry'],
+        RZ_GATE: ['rz', 'crz'],
+        P_GATE: ['u1', 'cu1'],
+        S_GATE: ['s'],
+        SDG_GATE: ['sdg'],
+        T_GATE: ['t'],
+        TDG_GATE: ['tdg'],
     }
 
+    GATE_CLASSES = {
+        X_GATE: 'XGate',
+        Y_GATE: 'YGate',
+        Z_GATE: 'ZGate',
+        H_GATE: 'HGate',
+        U3_GATE: 'U3Gate',
+        RX_GATE: 'RXGate',
+        RY_GATE: 'RYGate',
+        RZ_GATE: 'RZGate',
+        P_GATE: 'U1Gate',
+        S_GATE: 'SGate',
+        SDG_GATE: 'SdgGate',
+        T_GATE: 'TGate',
+        TDG_GATE: 'TdgGate',
+    }
+
+    @staticmethod
+    def _get_ctrl_state(control_qubit_ids: Set[int], negative_control_qubit_ids: Set[int]) -> int:
+        """ The i-th bit is the state of the i-th control (in the order of the arguments). """
+        return sum(
+            1 << index
+            for (index, qubit_id) in enumerate(sorted(control_qubit_ids))
+            if qubit_id not in negative_control_qubit_ids
+        )
+
     def get_headers(self) -> List[str]:
         return [
             f'self.q_register = qiskit.QuantumRegister({self.qubits_counter}, "q_register")',
@@ -58,12 +93,57 @@ class QiskitFormatter(IQAsmFormatter):
         arguments.extend(map(lambda i: f'self.q_register[{i}]', sorted(control_qubit_ids) + [qubit]))
         return f'self.circuit.{method_name}(' + ', '.join(arguments) + ')'
 
+    def supports_control_state(self) -> bool:
+        return True
+
+    def gate_with_control_state(
+        self,
+        gate: BuiltinGate,
+        qubit: int,
+        params: List[float],
+        control_qubit_ids: Set[int],
+        negative_control_qubit_ids: Set[int]
+    ) -> List[str]:
+        gate_class = 'qiskit.circuit.library.' + self.GATE_CLASSES[gate]
+        ctrl_state = self._get_ctrl_state(control_qubit_ids, negative_control_qubit_ids)
+        qubits = ', '.join(map(lambda i: f'self.q_register[{i}]', sorted(control_qubit_ids) + [qubit]))
+        return [
+            f'self.circuit.append({gate_class}(' + ', '.join(map(str, params)) + ')'
+            f'.control({len(control_qubit_ids)}, ctrl_state={ctrl_state}), [{qubits}])'
+        ]
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        method_name = self._get_for_gate(self.GATES_MAPPING, gate, 0)
+        arguments: List[str] = []
+        arguments.extend(map(str, params))
+        if sorted(qubit_ids) == list(range(self.qubits_counter)):
+            arguments.append('self.q_register')
+        else:
+            arguments.append('[' + ', '.join(map(lambda i: f'self.q_register[{i}]', qubit_ids)) + ']')
+        return [f'self.circuit.{method_name}(' + ', '.join(arguments) + ')']
+
+    def repeat(self, count: int, commands: List[Any]) -> List[str]:
+        """ The body is emitted once inside a loop. """
+        lines = [line for command in commands for line in command.get_lines(self)]
+        return [f'for _ in range({count}):'] + ['    ' + line for line in lines]
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        """ A gate with a matrix is a unitary instruction, the other ones are custom opaque instructions. """
+        qubits = ', '.join(map(lambda i: f'self.q_register[{i}]', qubit_ids))
+        if gate.matrix is not None:
+            matrix = [[complex(entry) for entry in row] for row in gate.matrix(params)]
+            return f'self.circuit.unitary({matrix!r}, [{qubits}], label={gate.name!r})'
+        return f'self.circuit.append(qiskit.circuit.Gate({gate.name!r}, {gate.num_qubits}, {params!r}), [{qubits}])'
+
     def measure(self, qubit: int, bit: int) -> str:
         return f'self.circuit.measure(self.q_register[{qubit}], self.c_register[{bit}])'
 
     def reset(self, qubit: int) -> str:
         return f'self.reset(self.q_register[{qubit}])'
 
+    def classical_if(self, bit: int, line: str) -> str:
+        return f'{line}.c_if(self.c_register[{bit}], 1)'
+
 #
 ##
 #
@@ -86,6 +166,14 @@ class QiskitBuilder(QiskitFormatter):
             Z_GATE: [self.circuit.z, self.circuit.cz],
             H_GATE: [self.circuit.h, self.circuit.ch],
             U3_GATE: [self.circuit.u3, self.circuit.cu3],
+            RX_GATE: [self.circuit.rx, self.circuit.crx],
+            RY_GATE: [self.circuit.ry, self.circuit.cry],
+            RZ_GATE: [self.circuit.rz, self.circuit.crz],
+            P_GATE: [self.circuit.u1, self.circuit.cu1],
+            S_GATE: [self.circuit.s],
+            SDG_GATE: [self.circuit.sdg],
+            T_GATE: [self.circuit.t],
+            TDG_GATE: [self.circuit.tdg],
         }
 
     def get_circuit(self):
@@ -107,9 +195,48 @@ class QiskitBuilder(QiskitFormatter):
         arguments: List[Any] = []
         arguments.extend(params)
         arguments.extend(map(lambda i: self.q_register[i], sorted(control_qubit_ids) + [qubit]))
-        method(*arguments)
+        self._last_instructions = method(*arguments)
         return super().gate(gate, qubit, params, control_qubit_ids)
 
+    def gate_with_control_state(
+        self,
+        gate: BuiltinGate,
+        qubit: int,
+        params: List[float],
+        control_qubit_ids: Set[int],
+        negative_control_qubit_ids: Set[int]
+    ) -> List[str]:
+        gate_class = getattr(qiskit.circuit.library, self.GATE_CLASSES[gate])
+        controlled_gate = gate_class(*params).control(
+            len(control_qubit_ids),
+            ctrl_state=self._get_ctrl_state(control_qubit_ids, negative_control_qubit_ids)
+        )
+        qubits = [self.q_register[i] for i in sorted(control_qubit_ids) + [qubit]]
+        self._last_instructions = self.circuit.append(controlled_gate, qubits)
+        return super().gate_with_control_state(gate, qubit, params, control_qubit_ids, negative_control_qubit_ids)
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        method = self._get_for_gate(self._gates_mapping, gate, 0)
+        self._last_instructions = method(*params, [self.q_register[i] for i in qubit_ids])
+        return super().broadcast(gate, qubit_ids, params)
+
+    def repeat(self, count: int, commands: List[Any]) -> List[str]:
+        # The circuit is built gate by gate, so the body is applied `count` times
+        return IQAsmFormatter.repeat(self, count, commands)
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        qubits = [self.q_register[i] for i in qubit_ids]
+        if is_qelib1_gate(gate):
+            self._last_instructions = getattr(self.circuit, gate.name)(*params, *qubits)
+        elif gate.matrix is not None:
+            self._last_instructions = self.circuit.unitary(gate.matrix(params), qubits, label=gate.name)
+        else:
+            self._last_instructions = self.circuit.append(
+                qiskit.circuit.Gate(gate.name, gate.num_qubits, params),
+                qubits
+            )
+        return super().opaque_gate(gate, qubit_ids, params)
+
     def measure(self, qubit: int, bit: int) -> str:
         self.circuit.measure(self.q_register[qubit], self.c_register[bit])
         return super().measure(qubit, bit)
@@ -117,3 +244,7 @@ class QiskitBuilder(QiskitFormatter):
     def reset(self, qubit: int) -> str:
         self.circuit.reset(self.q_register[qubit])
         return super().reset(qubit)
+
+    def classical_if(self, bit: int, line: str) -> str:
+        self._last_instructions.c_if(self.c_register[bit], 1)
+        return super().classical_if(bit, line)
@@ -3,6 +3,7 @@ import unittest
 from qiskit.circuit.library.standard_gates import CXGate
 
 from builtin_gates import X_GATE
+from opaque_gates import register_opaque_gate, unregister_opaque_gate
 from quasar_qiskit import QiskitFormatter, QiskitBuilder
 
 
@@ -13,6 +14,14 @@ class QiskitFormatterTest(unittest.TestCase):
         self.assertEqual(f.gate(X_GATE, 10, [], {20}),
                          'self.circuit.cx(self.q_register[20], self.q_register[10])')
 
+    def test_opaque_gate(self) -> None:
+        gate = register_opaque_gate('qiskit_block', 2, 1)
+        self.addCleanup(unregister_opaque_gate, 'qiskit_block')
+        f = QiskitFormatter()
+        self.assertEqual(f.opaque_gate(gate, [1, 0], [0.5]),
+                         "self.circuit.append(qiskit.circuit.Gate('qiskit_block', 2, [0.5]), "
+                         "[self.q_register[1], self.q_register[0]])")
+
     def test_builder(self) -> None:
         f = QiskitBuilder()
         f.set_qubits_counter(3)
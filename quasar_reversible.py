@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines an evaluator of the reversible (classical) circuits made of X gates
+with any controls, like the arithmetics of `qutils` or the oracles. It evaluates the circuit on many inputs at once,
+each qubit is a row of 64-bit words holding its values for 64 inputs per word. """
+
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from builtin_arithmetics import is_diagonal_gate
+from builtin_gates import BuiltinGate, X_GATE, Y_GATE
+from opaque_gates import OpaqueGate
+from quasar_qasm import QASMFormatter
+
+# (target, controls, swapped qubits), the target of a SWAP is None
+_Operation = Tuple[Optional[int], Tuple[int, ...], Tuple[int, ...]]
+
+
+class ReversibleEvaluator(QASMFormatter):
+    """ Records the circuit while it is emitted as OpenQASM and evaluates it on batches of basis states.
+    X (and Y, equal to it up to a phase) gates with any controls and SWAP gates permute the basis states,
+    the diagonal gates only change their phases, so they are skipped. Other gates, measurements and resets
+    raise a `ValueError`. The qubit with id `i` is the `i`-th column of the inputs and the outputs. """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._operations: List[_Operation] = []
+
+    def get_headers(self) -> List[str]:
+        self._operations = []
+        return super().get_headers()
+
+    def gate(self, gate: BuiltinGate, qubit: int, params: List[float], control_qubit_ids: Set[int]) -> str:
+        if gate in {X_GATE, Y_GATE}:
+            self._operations.append((qubit, tuple(sorted(control_qubit_ids)), ()))
+        elif not is_diagonal_gate(gate, params):
+            raise ValueError(f'Gate {gate} does not permute the basis states')
+        return super().gate(gate, qubit, params, control_qubit_ids)
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        # Gate by gate, as the register syntax would not pass through `gate`
+        return [self.gate(gate, qubit_id, params, set()) for qubit_id in qubit_ids]
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        if gate.name == 'swap':
+            self._operations.append((None, (), tuple(qubit_ids)))
+        elif self.opaque_gates.get(gate) is not None:
+            mapping = dict(enumerate(qubit_ids))
+            for command in self.opaque_gates[gate]:
+                command.remapped(mapping).get_lines(self)
+        else:
+            raise ValueError(f'Opaque gate {gate.name} has no body to evaluate')
+        return super().opaque_gate(gate, qubit_ids, params)
+
+    def measure(self, qubit: int, bit: int) -> str:
+        raise ValueError('Measurements cannot be evaluated as a reversible circuit')
+
+    def reset(self, qubit: int) -> str:
+        raise ValueError('Resets cannot be evaluated as a reversible circuit')
+
+    def run_packed(self, words: np.ndarray) -> np.ndarray:
+        """ Evaluates the circuit on the words of the shape (qubits counter, number of words),
+        the bit `j` of the word `k` of the row `i` is the value of the qubit `i` for the input `64 * k + j`. """
+        words = words.copy()
+        for (target, controls, swapped) in self._operations:
+            if target is None:
+                first, second = swapped
+                words[[first, second]] = words[[second, first]]
+                continue
+            if not controls:
+                words[target] = ~words[target]
+                continue
+            mask = words[controls[0]].copy()
+            for control in controls[1:]:
+                mask &= words[control]
+            words[target] ^= mask
+        return words
+
+    def run(self, inputs: np.ndarray) -> np.ndarray:
+        """ Evaluates the circuit on the rows of the 0/1 array of the shape (number of inputs, number of qubits),
+        the missing columns (e.g. of the ancillas) are zeros. Returns the array of the outputs of the shape
+        (number of inputs, qubits counter). """
+        num_inputs = len(inputs)
+        bits = np.zeros((self.qubits_counter, -(-num_inputs // 64) * 64), dtype=np.uint8)
+        bits[:inputs.shape[1], :num_inputs] = np.asarray(inputs, dtype=np.uint8).T
+        words = np.packbits(bits, axis=1, bitorder='little').view('<u8')
+        outputs = np.unpackbits(self.run_packed(words).view(np.uint8), axis=1, bitorder='little')
+        return outputs[:, :num_inputs].T
+
+    def get_permutation_table(self, qubit_ids: Optional[List[int]] = None) -> np.ndarray:
+        """ Evaluates the circuit on all the basis states of the `qubit_ids` (by default all the qubits),
+        the other qubits (ancillas) start in 0 and a `ValueError` is raised if they do not return to 0.
+        The bit `j` of an index of the returned table (and of its value) is the qubit `qubit_ids[j]`. """
+        if qubit_ids is None:
+            qubit_ids = list(range(self.qubits_counter))
+        num_inputs = 2 ** len(qubit_ids)
+        words = np.zeros((self.qubits_counter, max(1, num_inputs // 64)), dtype=np.uint64)
+
+        # The inputs are counted up, so the bit `j` of the input `64 * k + i` is the bit `j` of `i`
+        # for the first 6 qubits, and the bit `j - 6` of `k` for the others
+        indices = np.arange(len(words[0]), dtype=np.uint64)
+        for position, qubit_id in enumerate(qubit_ids):
+            if position < 6:
+                pattern = sum(1 << index for index in range(64) if (index >> position) & 1)
+                words[qubit_id] = pattern & (2 ** min(64, num_inputs) - 1)
+            else:
+                words[qubit_id] = np.where((indices >> np.uint64(position - 6)) & np.uint64(1), ~np.uint64(0), 0)
+        words = self.run_packed(words)
+
+        for qubit_id in sorted(set(range(self.qubits_counter)) - set(qubit_ids)):
+            if np.any(words[qubit_id]):
+                raise ValueError(f'Ancilla {qubit_id} does not return to 0')
+
+        bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder='little')[:, :num_inputs]
+        table = np.zeros(num_inputs, dtype=np.int64)
+        for position, qubit_id in enumerate(qubit_ids):
+            table |= bits[qubit_id].astype(np.int64) << position
+        return table
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import unittest
+
+import numpy as np
+
+from quasar import H, Program, Quasar, Swap, X, Z
+from quasar_reversible import ReversibleEvaluator
+from qutils import Inc
+
+#
+##
+#
+
+class ReversibleEvaluatorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.prgm = Program()
+        self.qubits = self.prgm.Qubits(6 * [0])
+        self.prgm += Inc(self.qubits) + Z(self.qubits[0]) + Swap(self.qubits[0], self.qubits[5])
+
+    def test_permutation_table(self) -> None:
+        evaluator = ReversibleEvaluator()
+        Quasar().compile(self.prgm, evaluator)
+        self.assertGreater(evaluator.qubits_counter, 6)
+
+        def get_value(index: int) -> int:
+            # The last qubit of the register is the least significant one
+            return sum(((index >> position) & 1) << (5 - position) for position in range(6))
+
+        table = evaluator.get_permutation_table([qubit.get_id() for qubit in self.qubits])
+        for index in range(64):
+            value = (get_value(index) + 1) % 64
+            swapped = (value & 0b011110) | ((value & 1) << 5) | (value >> 5)
+            self.assertEqual(get_value(int(table[index])), swapped)
+
+        # The batches of inputs give the same outputs
+        inputs = np.random.default_rng(0).integers(0, 2, (1000, 6))
+        outputs = evaluator.run(inputs)
+        self.assertTupleEqual(outputs.shape, (1000, evaluator.qubits_counter))
+        self.assertFalse(np.any(outputs[:, 6:]))
+        indices = inputs @ (1 << np.arange(6))
+        np.testing.assert_array_equal(outputs[:, :6] @ (1 << np.arange(6)), table[indices])
+
+    def test_errors(self) -> None:
+        evaluator = ReversibleEvaluator()
+        Quasar().compile(self.prgm + X(self.qubits[5]), evaluator)
+        with self.assertRaises(ValueError):
+            evaluator.get_permutation_table([qubit.get_id() for qubit in self.qubits[:5]])
+
+        with self.assertRaises(ValueError):
+            Quasar().compile(self.prgm + H(self.qubits[0]), ReversibleEvaluator())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,353 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Hashable, Iterable, List, Set, Tuple
+
+from builtin_gates import X_GATE
+from quasar_cmd import ICommand, GateCmd, expand_broadcasts, expand_repeats
+
+#
+##
+#
+
+class CouplingGraph:
+    """ Connectivity of physical qubits: a two-qubit gate can be applied only on adjacent ones. """
+
+    def __init__(self, num_qubits: int, edges: Iterable[Tuple[int, int]]) -> None:
+        self._num_qubits = num_qubits
+        self._neighbours: List[List[int]] = [[] for _ in range(num_qubits)]
+
+        for (a, b) in edges:
+            if not (0 <= a < num_qubits and 0 <= b < num_qubits) or a == b:
+                raise ValueError(f'Invalid edge ({a}, {b}) for {num_qubits} qubits')
+            if b not in self._neighbours[a]:
+                self._neighbours[a].append(b)
+                self._neighbours[b].append(a)
+
+        self._distances = [self._bfs(qubit) for qubit in range(num_qubits)]
+
+        if any(distance < 0 for distances in self._distances for distance in distances):
+            raise ValueError('Coupling graph has to be connected')
+
+    @staticmethod
+    def line(num_qubits: int) -> 'CouplingGraph':
+        return CouplingGraph(num_qubits, [(i, i + 1) for i in range(num_qubits - 1)])
+
+    @staticmethod
+    def ring(num_qubits: int) -> 'CouplingGraph':
+        edges = [(i, (i + 1) % num_qubits) for i in range(num_qubits)] if num_qubits > 2 else []
+        return CouplingGraph(num_qubits, edges or [(i, i + 1) for i in range(num_qubits - 1)])
+
+    @staticmethod
+    def grid(rows: int, cols: int) -> 'CouplingGraph':
+        edges: List[Tuple[int, int]] = []
+        for row in range(rows):
+            for col in range(cols):
+                if col + 1 < cols:
+                    edges.append((row * cols + col, row * cols + col + 1))
+                if row + 1 < rows:
+                    edges.append((row * cols + col, (row + 1) * cols + col))
+        return CouplingGraph(rows * cols, edges)
+
+    @staticmethod
+    def from_edges(edges: Iterable[Tuple[int, int]]) -> 'CouplingGraph':
+        edges = list(edges)
+        return CouplingGraph(1 + max(max(edge) for edge in edges), edges)
+
+    def _bfs(self, source: int) -> List[int]:
+        distances = [-1] * self._num_qubits
+        distances[source] = 0
+        queue: Deque[int] = deque([source])
+        while queue:
+            qubit = queue.popleft()
+            for neighbour in self._neighbours[qubit]:
+                if distances[neighbour] < 0:
+                    distances[neighbour] = distances[qubit] + 1
+                    queue.append(neighbour)
+        return distances
+
+    def get_num_qubits(self) -> int:
+        return self._num_qubits
+
+    def get_neighbours(self, qubit: int) -> List[int]:
+        return self._neighbours[qubit]
+
+    def get_distance(self, qubit_1: int, qubit_2: int) -> int:
+        return self._distances[qubit_1][qubit_2]
+
+    def get_edges(self) -> List[Tuple[int, int]]:
+        return [(a, b) for a in range(self._num_qubits) for b in self._neighbours[a] if a < b]
+
+
+@dataclass
+class RoutingReport:
+    num_swaps: int
+    depth: int
+    routed_depth: int
+    initial_layout: List[int] # logical qubit id -> physical qubit id
+    final_layout: List[int]
+
+    @property
+    def depth_overhead(self) -> int:
+        return self.routed_depth - self.depth
+
+
+def get_depth(commands: List[ICommand]) -> int:
+    levels: Dict[int, int] = {}
+    depth = 0
+    for command in commands:
+        qubit_ids = command.get_qubit_ids()
+        level = 1 + max(levels.get(qubit_id, 0) for qubit_id in qubit_ids)
+        for qubit_id in qubit_ids:
+            levels[qubit_id] = level
+        depth = max(depth, level)
+    return depth
+
+#
+##
+#
+
+class QuasarRouter:
+    """ Maps logical qubits onto a coupling graph inserting SWAP gates (as three CX gates).
+    The initial layout places interacting qubits (e.g. ancillas and their controls) close
+    to each other, the SWAPs are chosen by the front layer distance with a lookahead
+    on the following commands (the SABRE heuristic). """
+
+    def __init__(self, coupling: CouplingGraph, lookahead: int = 20, lookahead_weight: float = 0.5) -> None:
+        self._coupling = coupling
+        self._lookahead = lookahead
+        self._lookahead_weight = lookahead_weight
+
+    @staticmethod
+    def run(
+        commands: List[ICommand],
+        num_qubits: int,
+        coupling: CouplingGraph,
+        lookahead: int = 20
+    ) -> Tuple[List[ICommand], RoutingReport]:
+        return QuasarRouter(coupling, lookahead).route(commands, num_qubits)
+
+    def route(self, commands: List[ICommand], num_qubits: int) -> Tuple[List[ICommand], RoutingReport]:
+        if num_qubits > self._coupling.get_num_qubits():
+            raise ValueError(
+                f'Circuit uses {num_qubits} qubits, '
+                f'but the coupling graph has only {self._coupling.get_num_qubits()}'
+            )
+
+        # The gates of a broadcast are routed one by one, the layout differs
+        # between the copies of a repeat, so they are routed one by one too
+        commands = expand_broadcasts(expand_repeats(commands))
+
+        for command in commands:
+            if len(command.get_qubit_ids()) > 2:
+                raise ValueError(
+                    f'Cannot route {command}: commands have to act on at most two qubits '
+                    f'(use a Target without native multi-controlled gates, e.g. CX_U3_TARGET)'
+                )
+
+        self._commands = commands
+        self._layout = self._get_initial_layout(num_qubits)
+        self._physical_to_logical: Dict[int, int] = {p: l for (l, p) in enumerate(self._layout)}
+        initial_layout = list(self._layout)
+
+        self._result: List[ICommand] = []
+        self._num_swaps = 0
+        self._run()
+
+        report = RoutingReport(
+            num_swaps=self._num_swaps,
+            depth=get_depth(commands),
+            routed_depth=get_depth(self._result),
+            initial_layout=initial_layout,
+            final_layout=list(self._layout),
+        )
+        return self._result, report
+
+    def _get_initial_layout(self, num_qubits: int) -> List[int]:
+        coupling = self._coupling
+        weights: Dict[int, Dict[int, int]] = {}
+        order: List[int] = []
+
+        for command in self._commands:
+            qubit_ids = sorted(command.get_qubit_ids())
+            for qubit_id in qubit_ids:
+                if qubit_id not in weights:
+                    weights[qubit_id] = {}
+                    order.append(qubit_id)
+            if len(qubit_ids) == 2:
+                a, b = qubit_ids
+                weights[a][b] = weights[a].get(b, 0) + 1
+                weights[b][a] = weights[b].get(a, 0) + 1
+
+        order.extend(qubit_id for qubit_id in range(num_qubits) if qubit_id not in weights)
+
+        # The most interacting qubits are placed first, each next one is the most connected to the placed ones
+        unplaced = list(order)
+        order = []
+        while unplaced:
+            logical = max(unplaced, key=lambda q: (
+                sum(weight for (other, weight) in weights.get(q, {}).items() if other in order),
+                sum(weights.get(q, {}).values()) if not order else 0,
+            ))
+            unplaced.remove(logical)
+            order.append(logical)
+
+        physical = range(coupling.get_num_qubits())
+        center = min(physical, key=lambda p: sum(coupling.get_distance(p, q) for q in physical))
+        layout: Dict[int, int] = {}
+        free: Set[int] = set(physical)
+
+        for logical in order:
+            placed = [(layout[other], weight) for (other, weight) in weights.get(logical, {}).items() if other in layout]
+
+            def cost(p: int) -> Tuple[int, int]:
+                interaction = sum(weight * coupling.get_distance(p, q) for (q, weight) in placed)
+                compactness = sum(coupling.get_distance(p, q) for q in layout.values())
+                return (interaction, compactness if layout else coupling.get_distance(p, center))
+
+            best = min(sorted(free), key=cost)
+            layout[logical] = best
+            free.remove(best)
+
+        return [layout[qubit_id] for qubit_id in range(num_qubits)]
+
+    def _is_executable(self, command: ICommand) -> bool:
+        return len(command.get_qubit_ids()) < 2 or self._get_distance(command) == 1
+
+    def _get_distance(self, command: ICommand) -> int:
+        a, b = command.get_qubit_ids()
+        return self._coupling.get_distance(self._layout[a], self._layout[b])
+
+    def _swap(self, physical_1: int, physical_2: int) -> None:
+        self._result.extend([
+            GateCmd(X_GATE, physical_2, control_qubit_ids={physical_1}),
+            GateCmd(X_GATE, physical_1, control_qubit_ids={physical_2}),
+            GateCmd(X_GATE, physical_2, control_qubit_ids={physical_1}),
+        ])
+        self._num_swaps += 1
+        self._swap_layout(physical_1, physical_2)
+
+    def _run(self) -> None:
+        commands = self._commands
+
+        def get_resources(command: ICommand) -> List[Hashable]:
+            """ Qubits and classical bits, the order of commands using them is kept. """
+            return list(command.get_qubit_ids()) + [('bit', bit_id) for bit_id in command.get_bit_ids()]
+
+        queues: Dict[Hashable, Deque[int]] = {}
+        for (index, command) in enumerate(commands):
+            for resource in get_resources(command):
+                queues.setdefault(resource, deque()).append(index)
+
+        def is_ready(index: int) -> bool:
+            return all(queues[resource][0] == index for resource in get_resources(commands[index]))
+
+        front: Set[int] = {queue[0] for queue in queues.values() if is_ready(queue[0])}
+        executed = [False] * len(commands)
+        cursor = 0
+        decay = [1.0] * self._coupling.get_num_qubits()
+        swaps_without_progress = 0
+
+        while front:
+            progress = True
+            while progress:
+                progress = False
+                for index in sorted(front):
+                    if not self._is_executable(commands[index]):
+                        continue
+                    command = commands[index]
+                    self._result.append(command.remapped(dict(enumerate(self._layout))))
+                    executed[index] = True
+                    front.remove(index)
+                    progress = True
+                    for resource in get_resources(command):
+                        queues[resource].popleft()
+                        if queues[resource] and is_ready(queues[resource][0]):
+                            front.add(queues[resource][0])
+
+            if not front:
+                break
+
+            while cursor < len(commands) and executed[cursor]:
+                cursor += 1
+
+            if swaps_without_progress > 2 * self._coupling.get_num_qubits():
+                # The heuristic does not converge, move the qubits of the first gate together
+                a, b = commands[min(front)].get_qubit_ids()
+                physical_a, physical_b = self._layout[a], self._layout[b]
+                step = min(
+                    self._coupling.get_neighbours(physical_a),
+                    key=lambda p: self._coupling.get_distance(p, physical_b)
+                )
+                self._swap(physical_a, step)
+                continue
+
+            self._swap(*self._choose_swap(front, executed, cursor, decay))
+            swaps_without_progress += 1
+
+            if all(self._is_executable(commands[index]) is False for index in front):
+                continue
+            swaps_without_progress = 0
+            decay = [1.0] * len(decay)
+
+    def _choose_swap(self, front: Set[int], executed: List[bool], cursor: int, decay: List[float]) -> Tuple[int, int]:
+        commands = self._commands
+        extended: List[ICommand] = []
+        index = cursor
+        while index < len(commands) and len(extended) < self._lookahead:
+            if not executed[index] and index not in front and len(commands[index].get_qubit_ids()) == 2:
+                extended.append(commands[index])
+            index += 1
+
+        front_commands = [commands[index] for index in front]
+        candidates: Set[Tuple[int, int]] = set()
+        for command in front_commands:
+            for qubit_id in command.get_qubit_ids():
+                physical = self._layout[qubit_id]
+                for neighbour in self._coupling.get_neighbours(physical):
+                    candidates.add((min(physical, neighbour), max(physical, neighbour)))
+
+        def score(swap: Tuple[int, int]) -> float:
+            self._swap_layout(*swap)
+            front_cost = sum(self._get_distance(command) for command in front_commands) / len(front_commands)
+            extended_cost = sum(self._get_distance(command) for command in extended) / len(extended) if extended else 0
+            self._swap_layout(*swap)
+            return max(decay[swap[0]], decay[swap[1]]) * (front_cost + self._lookahead_weight * extended_cost)
+
+        best = min(sorted(candidates), key=score)
+        decay[best[0]] += 0.001
+        decay[best[1]] += 0.001
+        return best
+
+    def _swap_layout(self, physical_1: int, physical_2: int) -> None:
+        """ Swaps the layout only (no commands are emitted). """
+        logical_1 = self._physical_to_logical.pop(physical_1, None)
+        logical_2 = self._physical_to_logical.pop(physical_2, None)
+        if logical_1 is not None:
+            self._layout[logical_1] = physical_2
+            self._physical_to_logical[physical_2] = logical_1
+        if logical_2 is not None:
+            self._layout[logical_2] = physical_1
+            self._physical_to_logical[physical_1] = logical_2
@@ -0,0 +1,115 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import random
+from typing import List
+import unittest
+
+from builtin_gates import U3_GATE, X_GATE
+from quasar import CX, H, Program, Quasar
+from quasar_cmd import GateCmd, ICommand
+from quasar_qasm import QASMFormatter
+from quasar_routing import CouplingGraph, QuasarRouter, get_depth
+from quasar_target import CX_U3_TARGET
+
+#
+##
+#
+
+class CouplingGraphTest(unittest.TestCase):
+    def test_distances(self) -> None:
+        line = CouplingGraph.line(5)
+        self.assertEqual(line.get_distance(0, 4), 4)
+        self.assertEqual(CouplingGraph.ring(5).get_distance(0, 4), 1)
+        self.assertEqual(CouplingGraph.grid(3, 3).get_distance(0, 8), 4)
+        self.assertListEqual(line.get_edges(), [(0, 1), (1, 2), (2, 3), (3, 4)])
+
+    def test_disconnected(self) -> None:
+        with self.assertRaises(ValueError):
+            CouplingGraph(4, [(0, 1), (2, 3)])
+
+
+class QuasarRouterTest(unittest.TestCase):
+    @staticmethod
+    def _simulate_basis(commands: List[ICommand], state: List[int]) -> List[int]:
+        """ Classical simulation of a circuit consisting of X gates only. """
+        state = list(state)
+        for cmd in commands:
+            if all(state[qubit_id] for qubit_id in cmd.get_control_qubit_ids()):
+                state[cmd.get_target_qubit_id()] ^= 1
+        return state
+
+    def test_adjacent(self) -> None:
+        random.seed(0)
+        coupling = CouplingGraph.grid(2, 3)
+        commands = [GateCmd(X_GATE, t, control_qubit_ids={c}) for (c, t) in (random.sample(range(6), 2) for _ in range(50))]
+        routed, report = QuasarRouter.run(commands, 6, coupling)
+
+        for cmd in routed:
+            qubit_ids = sorted(cmd.get_qubit_ids())
+            self.assertEqual(coupling.get_distance(*qubit_ids), 1)
+        self.assertEqual(len(routed), len(commands) + 3 * report.num_swaps)
+        self.assertEqual(report.depth, get_depth(commands))
+
+        for index in range(2 ** 6):
+            logical = [(index >> qubit_id) & 1 for qubit_id in range(6)]
+            physical = [0] * 6
+            for (qubit_id, value) in enumerate(logical):
+                physical[report.initial_layout[qubit_id]] = value
+
+            expected = self._simulate_basis(commands, logical)
+            actual = self._simulate_basis(routed, physical)
+            self.assertListEqual(actual, [expected[report.final_layout.index(p)] for p in range(6)])
+
+    def test_no_swaps_needed(self) -> None:
+        commands = [
+            GateCmd(X_GATE, 1, control_qubit_ids={0}),
+            GateCmd(X_GATE, 2, control_qubit_ids={1}),
+            GateCmd(U3_GATE, 2, params=[0.1, 0.2, 0.3]),
+        ]
+        _, report = QuasarRouter.run(commands, 3, CouplingGraph.line(3))
+        self.assertEqual(report.num_swaps, 0)
+        self.assertEqual(report.depth_overhead, 0)
+
+    def test_too_many_qubits(self) -> None:
+        with self.assertRaises(ValueError):
+            QuasarRouter.run([GateCmd(X_GATE, 0, control_qubit_ids={1, 2})], 3, CouplingGraph.line(3))
+        with self.assertRaises(ValueError):
+            QuasarRouter.run([], 4, CouplingGraph.line(3))
+
+    def test_compile(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0, 0])
+        prgm += H(qubits[0])
+        prgm += CX(qubits[0], qubits[3])
+        prgm += CX(qubits[1], qubits[3])
+        prgm += CX(qubits[2], qubits[0])
+
+        quasar = Quasar()
+        quasar.compile(prgm, QASMFormatter(), target=CX_U3_TARGET, coupling=CouplingGraph.line(4))
+        self.assertIsNotNone(quasar.routing_report)
+        self.assertEqual(len(quasar.routing_report.initial_layout), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,470 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines a NumPy statevector simulator of the compiled circuits.
+It is a formatter, so the circuit is simulated while it is emitted by `Quasar.compile`,
+and the expectation values of the Pauli observables are computed exactly from the final state. """
+
+from abc import abstractmethod
+import cmath
+from concurrent.futures import ThreadPoolExecutor
+import math
+from typing import Callable, Dict, List, Optional, Set, TypeVar
+
+import numpy as np
+
+from builtin_gates import X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, BuiltinGate, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate
+from quasar_qasm import QASMFormatter
+
+
+def gate_matrix(gate: BuiltinGate, params: List[float]) -> np.ndarray:
+    """ Returns the unitary of the (uncontrolled) builtin gate, the OpenQASM conventions are used. """
+    if gate == X_GATE:
+        return np.array([[0, 1], [1, 0]], dtype=complex)
+    if gate == Y_GATE:
+        return np.array([[0, -1j], [1j, 0]], dtype=complex)
+    if gate == Z_GATE:
+        return np.diag([1, -1]).astype(complex)
+    if gate == H_GATE:
+        return np.array([[1, 1], [1, -1]], dtype=complex) / math.sqrt(2)
+    if gate == U3_GATE:
+        theta, phi, lam = params
+        return np.array([
+            [math.cos(theta / 2), -cmath.exp(1j * lam) * math.sin(theta / 2)],
+            [cmath.exp(1j * phi) * math.sin(theta / 2), cmath.exp(1j * (phi + lam)) * math.cos(theta / 2)],
+        ])
+    if gate == RX_GATE:
+        cos, sin = math.cos(params[0] / 2), math.sin(params[0] / 2)
+        return np.array([[cos, -1j * sin], [-1j * sin, cos]])
+    if gate == RY_GATE:
+        cos, sin = math.cos(params[0] / 2), math.sin(params[0] / 2)
+        return np.array([[cos, -sin], [sin, cos]], dtype=complex)
+    if gate == RZ_GATE:
+        return np.diag([cmath.exp(-0.5j * params[0]), cmath.exp(0.5j * params[0])])
+    phases = {
+        P_GATE: lambda: cmath.exp(1j * params[0]),
+        S_GATE: lambda: 1j,
+        SDG_GATE: lambda: -1j,
+        T_GATE: lambda: cmath.exp(0.25j * math.pi),
+        TDG_GATE: lambda: cmath.exp(-0.25j * math.pi),
+    }
+    if gate in phases:
+        return np.diag([1, phases[gate]()])
+    raise ValueError(f'Gate {gate} not supported')
+
+
+_SWAP_MATRIX = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+
+
+def apply_matrix(
+    tensor: np.ndarray,
+    matrix: np.ndarray,
+    axes: List[int],
+    controls: Dict[int, int] = None
+) -> None:
+    """ Applies in place the matrix on the `axes` of the tensor (the first one being the least significant
+    qubit of the matrix) to the entries in which each control axis has the value it maps onto. """
+    controls = controls or {}
+    index: List = [slice(None)] * tensor.ndim
+    for axis, value in controls.items():
+        index[axis] = value
+    view = tensor[tuple(index)]
+
+    # The integer indices drop the control axes, so the remaining ones are shifted
+    shifted_axes = [axis - sum(1 for control in controls if control < axis) for axis in reversed(axes)]
+    view = np.moveaxis(view, shifted_axes, range(len(axes)))
+    amplitudes = view.reshape(2 ** len(axes), -1)
+    view[...] = (matrix @ amplitudes).reshape(view.shape)
+
+
+def _get_parities(indices: np.ndarray, mask: int) -> np.ndarray:
+    """ Returns the parities of the bits of `indices & mask`, folding the halves of the words together. """
+    bits = indices & mask
+    shift = 32
+    while shift:
+        bits ^= bits >> shift
+        shift //= 2
+    return bits & 1
+
+
+def _group_qubit_wise_commuting(paulis: List[str]) -> List[List[int]]:
+    """ Greedily splits the Pauli strings into the sets commuting qubit by qubit
+    (having the same Pauli or the identity on each qubit), so each set is measured in one basis. """
+    groups: List[List[int]] = []
+    bases: List[Dict[int, str]] = []
+    for index, pauli in enumerate(paulis):
+        operators = {qubit_id: operator for qubit_id, operator in enumerate(pauli) if operator != 'I'}
+        for group, basis in zip(groups, bases):
+            if all(basis.get(qubit_id, operator) == operator for qubit_id, operator in operators.items()):
+                group.append(index)
+                basis.update(operators)
+                break
+        else:
+            groups.append([index])
+            bases.append(operators)
+    return groups
+
+
+class ISimulator(QASMFormatter):
+    """ Simulates the circuit while it is emitted as OpenQASM, the gates are passed
+    to `_apply_matrix` and the measurements to `_measure` of the implementations.
+    The measurements and the resets are sampled with the generator seeded with `seed`,
+    their outcomes are available in `bits`. """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        super().__init__()
+        self._rng = np.random.default_rng(seed)
+        self.bits: List[int] = []
+        # The last operation is applied lazily, so that `classical_if` can still skip it
+        self._pending: Optional[Callable[[], None]] = None
+
+    @abstractmethod
+    def _initialize(self) -> None:
+        """ Sets the state of `qubits_counter` qubits to |0...0>. """
+        pass
+
+    @abstractmethod
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        """ Applies the matrix on the `qubit_ids` (the first one being the least significant)
+        to the amplitudes in which each control qubit has the value it maps onto. """
+        pass
+
+    @abstractmethod
+    def _measure(self, qubit: int) -> int:
+        """ Samples the value of the qubit and collapses the state. """
+        pass
+
+    def get_headers(self) -> List[str]:
+        self._initialize()
+        self.bits = [0] * self.bits_counter
+        self._pending = None
+        return super().get_headers()
+
+    def get_footers(self) -> List[str]:
+        self._flush()
+        return super().get_footers()
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending()
+
+    def _postpone(self, operation: Callable[[], None]) -> None:
+        self._flush()
+        self._pending = operation
+
+    def gate(self, gate: BuiltinGate, qubit: int, params: List[float], control_qubit_ids: Set[int]) -> str:
+        matrix = gate_matrix(gate, params)
+        controls = {qubit_id: 1 for qubit_id in control_qubit_ids}
+        self._postpone(lambda: self._apply_matrix(matrix, [qubit], controls))
+        return super().gate(gate, qubit, params, control_qubit_ids)
+
+    def broadcast(self, gate: BuiltinGate, qubit_ids: List[int], params: List[float]) -> List[str]:
+        # Gate by gate, as the register syntax would not pass through `gate`
+        return [self.gate(gate, qubit_id, params, set()) for qubit_id in qubit_ids]
+
+    def opaque_gate(self, gate: OpaqueGate, qubit_ids: List[int], params: List[float]) -> str:
+        if gate.matrix is not None:
+            matrix = np.array(gate.matrix(params), dtype=complex)
+            self._postpone(lambda: self._apply_matrix(matrix, qubit_ids, {}))
+        elif self.opaque_gates.get(gate) is not None:
+            mapping = dict(enumerate(qubit_ids))
+            for command in self.opaque_gates[gate]:
+                command.remapped(mapping).get_lines(self)
+        else:
+            raise ValueError(f'Opaque gate {gate.name} has neither a matrix nor a body to simulate')
+        return super().opaque_gate(gate, qubit_ids, params)
+
+    def measure(self, qubit: int, bit: int) -> str:
+        def apply() -> None:
+            self.bits[bit] = self._measure(qubit)
+
+        self._postpone(apply)
+        return super().measure(qubit, bit)
+
+    def reset(self, qubit: int) -> str:
+        def apply() -> None:
+            if self._measure(qubit):
+                self._apply_matrix(gate_matrix(X_GATE, []), [qubit], {})
+
+        self._postpone(apply)
+        return super().reset(qubit)
+
+    def _check_pauli_strings(self, paulis: List[str]) -> None:
+        for pauli in paulis:
+            if len(pauli) > self.qubits_counter or set(pauli) - set('IXYZ'):
+                raise ValueError(f'{pauli!r} is not a Pauli string on {self.qubits_counter} qubits')
+
+    def classical_if(self, bit: int, line: str) -> str:
+        # The gate of the line is the pending operation, the measurement setting the bit was already applied
+        if not self.bits[bit]:
+            self._pending = None
+        return super().classical_if(bit, line)
+
+
+class StatevectorSimulator(ISimulator):
+    """ The qubit with id `i` is the `i`-th least significant bit of the index
+    of an amplitude (like in `OpaqueGate.matrix`). """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        super().__init__(seed)
+        self._state = np.ones(1, dtype=complex)
+
+    def _initialize(self) -> None:
+        self._state = np.zeros(2 ** self.qubits_counter, dtype=complex)
+        self._state[0] = 1
+
+    def get_state(self) -> np.ndarray:
+        """ Returns the amplitudes of the final state. """
+        self._flush()
+        return self._state
+
+    def _get_axis(self, qubit_id: int) -> int:
+        # The qubit 0 is the least significant, so it is the last axis of the state reshaped into a tensor
+        return self.qubits_counter - 1 - qubit_id
+
+    def _rotate(self, state: np.ndarray, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        apply_matrix(
+            state.reshape((2,) * self.qubits_counter),
+            matrix,
+            [self._get_axis(qubit_id) for qubit_id in qubit_ids],
+            {self._get_axis(qubit_id): value for qubit_id, value in controls.items()}
+        )
+
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        self._rotate(self._state, matrix, qubit_ids, controls)
+
+    def _measure(self, qubit: int) -> int:
+        tensor = self._state.reshape((2,) * self.qubits_counter)
+        index: List = [slice(None)] * self.qubits_counter
+        index[self._get_axis(qubit)] = 1
+        probability = np.sum(np.abs(tensor[tuple(index)]) ** 2)
+        value = int(self._rng.random() < probability)
+        index[self._get_axis(qubit)] = 1 - value
+        tensor[tuple(index)] = 0
+        self._state /= math.sqrt(probability if value else 1 - probability)
+        return value
+
+    def expectation_values(self, paulis: List[str]) -> List[float]:
+        """ Returns the exact expectation values of the Pauli strings in the final state.
+        The `i`-th character of a string (`I`, `X`, `Y` or `Z`) acts on the qubit with id `i`,
+        the missing ones are identities. The strings commuting qubit by qubit share a single
+        change of the basis of the state, in which they are diagonal. """
+        self._check_pauli_strings(paulis)
+        state = self.get_state()
+        indices = np.arange(len(state))
+        values = [0.0] * len(paulis)
+
+        for group in _group_qubit_wise_commuting(paulis):
+            rotated = state.copy()
+            basis = {
+                qubit_id: operator
+                for index in group
+                for qubit_id, operator in enumerate(paulis[index])
+                if operator != 'I'
+            }
+            for qubit_id, operator in basis.items():
+                # Y = S X Sdg and X = H Z H are rotated into Z
+                if operator == 'Y':
+                    self._rotate(rotated, gate_matrix(SDG_GATE, []), [qubit_id], {})
+                if operator in 'XY':
+                    self._rotate(rotated, gate_matrix(H_GATE, []), [qubit_id], {})
+            probabilities = np.abs(rotated) ** 2
+
+            for index in group:
+                mask = sum(1 << qubit_id for qubit_id, operator in enumerate(paulis[index]) if operator != 'I')
+                signs = 1 - 2 * _get_parities(indices, mask)
+                values[index] = float(np.dot(probabilities, signs))
+
+        return values
+
+
+class ChunkedStatevectorSimulator(StatevectorSimulator):
+    """ Splits the state into the chunks of `2 ** chunk_qubits` amplitudes (small enough to stay
+    in the cache), which are updated in parallel by `num_threads` threads (NumPy releases the GIL
+    in its kernels). With `path` set, the state is kept in a memory-mapped file, so it may exceed the RAM.
+    The lower (physical) qubits of the index of an amplitude are local to the chunks and the higher ones
+    select the chunks. A gate acting on a higher qubit first swaps it with a local one, so each gate
+    updates its chunks independently, while the controls on the higher qubits only select the chunks. """
+
+    def __init__(
+        self,
+        chunk_qubits: int = 16,
+        num_threads: Optional[int] = None,
+        path: Optional[str] = None,
+        seed: Optional[int] = None
+    ) -> None:
+        super().__init__(seed)
+        if chunk_qubits < 1:
+            raise ValueError(f'A chunk has to hold at least one qubit, not {chunk_qubits}')
+        self.chunk_qubits = chunk_qubits
+        self.path = path
+        self._executor = ThreadPoolExecutor(num_threads)
+        self._local_qubits = 0
+        # The logical qubit `i` is the bit `_physical[i]` of the index of an amplitude
+        self._physical: List[int] = []
+
+    def _initialize(self) -> None:
+        size = 2 ** self.qubits_counter
+        if self.path is None:
+            self._state = np.zeros(size, dtype=complex)
+        else:
+            self._state = np.memmap(self.path, dtype=complex, mode='w+', shape=(size,))
+            self._state[:] = 0
+        self._state[0] = 1
+        self._local_qubits = min(self.qubits_counter, self.chunk_qubits)
+        self._physical = list(range(self.qubits_counter))
+
+    T = TypeVar('T')
+    def _map(self, function: Callable[[int], T], chunk_indices: List[int]) -> List[T]:
+        if len(chunk_indices) == 1:
+            return [function(chunk_indices[0])]
+        return list(self._executor.map(function, chunk_indices))
+
+    def _get_chunks(self) -> np.ndarray:
+        return self._state.reshape(-1, 2 ** self._local_qubits)
+
+    def get_state(self) -> np.ndarray:
+        """ Returns the amplitudes of the final state, a copy if the qubits were swapped between the chunks. """
+        self._flush()
+        if self._physical == list(range(self.qubits_counter)):
+            return self._state
+        tensor = self._state.reshape((2,) * self.qubits_counter)
+        axes = [self._get_axis(self._physical[qubit_id]) for qubit_id in reversed(range(self.qubits_counter))]
+        return tensor.transpose(axes).reshape(-1)
+
+    def _swap_physical(self, local: int, other: int) -> None:
+        """ Swaps the local physical qubit with the one selecting the chunks. """
+        chunks = self._get_chunks()
+        chunk_bit = 1 << (other - self._local_qubits)
+
+        def swap(index: int) -> None:
+            # The amplitudes with the local bit 1 of the chunk with the bit 0 are exchanged
+            # with the amplitudes with the local bit 0 of the chunk with the bit 1
+            first = chunks[index].reshape(-1, 2, 2 ** local)
+            second = chunks[index | chunk_bit].reshape(-1, 2, 2 ** local)
+            swapped = first[:, 1].copy()
+            first[:, 1] = second[:, 0]
+            second[:, 0] = swapped
+
+        self._map(swap, [index for index in range(len(chunks)) if not index & chunk_bit])
+        first_qubit, second_qubit = self._physical.index(local), self._physical.index(other)
+        self._physical[first_qubit], self._physical[second_qubit] = other, local
+
+    def _localize(self, qubit_ids: List[int]) -> None:
+        """ Swaps the qubits selecting the chunks with the local ones not used by the gate. """
+        for qubit_id in qubit_ids:
+            if self._physical[qubit_id] >= self._local_qubits:
+                used = {self._physical[other] for other in qubit_ids}
+                free = [local for local in range(self._local_qubits) if local not in used]
+                if not free:
+                    raise ValueError(f'A gate on {len(qubit_ids)} qubits does not fit into chunks of {self.chunk_qubits} qubits')
+                self._swap_physical(free[-1], self._physical[qubit_id])
+
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        if len(qubit_ids) == 2 and not controls and np.array_equal(matrix, _SWAP_MATRIX):
+            # Only the physical qubits of the logical ones are swapped
+            first, second = qubit_ids
+            self._physical[first], self._physical[second] = self._physical[second], self._physical[first]
+            return
+        self._localize(qubit_ids)
+        local_qubits = self._local_qubits
+        local_controls = {}
+        chunks_mask = chunks_value = 0
+        for qubit_id, value in controls.items():
+            physical = self._physical[qubit_id]
+            if physical < local_qubits:
+                local_controls[local_qubits - 1 - physical] = value
+            else:
+                chunks_mask |= 1 << (physical - local_qubits)
+                chunks_value |= value << (physical - local_qubits)
+        axes = [local_qubits - 1 - self._physical[qubit_id] for qubit_id in qubit_ids]
+        chunks = self._get_chunks()
+
+        def update(index: int) -> None:
+            apply_matrix(chunks[index].reshape((2,) * local_qubits), matrix, axes, local_controls)
+
+        self._map(update, [index for index in range(len(chunks)) if index & chunks_mask == chunks_value])
+
+    def _get_halves(self, qubit: int, index: int, value: int) -> np.ndarray:
+        """ Returns the amplitudes of the chunk in which the qubit has the value (possibly none of them). """
+        chunk = self._get_chunks()[index]
+        physical = self._physical[qubit]
+        if physical >= self._local_qubits:
+            return chunk if (index >> (physical - self._local_qubits)) & 1 == value else chunk[:0]
+        return chunk.reshape(-1, 2, 2 ** physical)[:, value]
+
+    def _measure(self, qubit: int) -> int:
+        chunk_indices = list(range(len(self._get_chunks())))
+        probability = sum(self._map(
+            lambda index: float(np.sum(np.abs(self._get_halves(qubit, index, 1)) ** 2)),
+            chunk_indices
+        ))
+        value = int(self._rng.random() < probability)
+        norm = math.sqrt(probability if value else 1 - probability)
+
+        def collapse(index: int) -> None:
+            self._get_halves(qubit, index, 1 - value)[...] = 0
+            self._get_halves(qubit, index, value)[...] /= norm
+
+        self._map(collapse, chunk_indices)
+        return value
+
+    def expectation_values(self, paulis: List[str]) -> List[float]:
+        """ Returns the expectation values of the Pauli strings (see `StatevectorSimulator.expectation_values`)
+        without copying the state. A Pauli string maps a basis state onto the basis state with the flipped
+        bits and a phase, the strings flipping the same bits share the products of the amplitudes of each
+        chunk and its partner chunk, which are evaluated with the parity masks of each string. """
+        self._check_pauli_strings(paulis)
+        self._flush()
+        local_qubits = self._local_qubits
+        chunks = self._get_chunks()
+        local_indices = np.arange(chunks.shape[1])
+
+        def get_mask(pauli: str, operators: str) -> int:
+            return sum(1 << self._physical[qubit_id] for qubit_id, operator in enumerate(pauli) if operator in operators)
+
+        groups: Dict[int, List[int]] = {}
+        for index, pauli in enumerate(paulis):
+            groups.setdefault(get_mask(pauli, 'XY'), []).append(index)
+
+        values = [0.0] * len(paulis)
+        for flip_mask, group in groups.items():
+            sign_masks = [get_mask(paulis[index], 'YZ') for index in group]
+
+            def evaluate(chunk_index: int) -> List[complex]:
+                partner = chunks[chunk_index ^ (flip_mask >> local_qubits)]
+                products = partner[local_indices ^ (flip_mask & (len(local_indices) - 1))].conj() * chunks[chunk_index]
+                return [
+                    (-1) ** bin(chunk_index & (sign_mask >> local_qubits)).count('1')
+                    * np.dot(products, 1 - 2 * _get_parities(local_indices, sign_mask & (len(local_indices) - 1)))
+                    for sign_mask in sign_masks
+                ]
+
+            sums = np.sum(self._map(evaluate, list(range(len(chunks)))), axis=0)
+            for index, total in zip(group, sums):
+                # Y = i X Z
+                values[index] = float((1j ** paulis[index].count('Y') * total).real)
+        return values
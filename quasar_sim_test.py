@@ -0,0 +1,115 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from quasar import All, CX, H, If, Measurement, Program, Quasar, RY, Swap, T, X
+from quasar_sim import ChunkedStatevectorSimulator, StatevectorSimulator, _group_qubit_wise_commuting
+
+#
+##
+#
+
+class StatevectorSimulatorTest(unittest.TestCase):
+    def test_state(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        prgm += H(qubits[0]) + If(All(qubits[0])).Then(X(qubits[1])) + Swap(qubits[1], qubits[2])
+
+        simulator = StatevectorSimulator()
+        Quasar().compile(prgm, simulator)
+        expected = np.zeros(8)
+        expected[0b000] = expected[0b101] = 1 / math.sqrt(2)
+        np.testing.assert_allclose(simulator.get_state(), expected, atol=1e-12)
+
+    def test_expectation_values(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        prgm += H(qubits[0]) + CX(qubits[0], qubits[1]) + RY(qubits[2], math.pi / 3)
+
+        simulator = StatevectorSimulator()
+        Quasar().compile(prgm, simulator)
+        actual = simulator.expectation_values(['ZZ', 'XX', 'YY', 'XY', 'Z', 'IIZ', 'IIX', 'ZZX', ''])
+        expected = [1, 1, -1, 0, 0, 0.5, math.sqrt(3) / 2, math.sqrt(3) / 2, 1]
+        np.testing.assert_allclose(actual, expected, atol=1e-12)
+
+        with self.assertRaises(ValueError):
+            simulator.expectation_values(['IIIZ'])
+
+    def test_grouping(self) -> None:
+        self.assertListEqual(_group_qubit_wise_commuting(['ZZ', 'XX', 'ZI', 'IX', 'YZ', 'IZ']), [[0, 2, 5], [1, 3], [4]])
+
+    def test_measurement(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0])
+        bits = prgm.CBits(1)
+        prgm += H(qubits[0]) + Measurement(qubits[0], bits[0]) + CX(qubits[0], qubits[1])
+
+        outcomes = set()
+        for seed in range(8):
+            simulator = StatevectorSimulator(seed)
+            Quasar().compile(prgm, simulator)
+            bit = simulator.bits[0]
+            outcomes.add(bit)
+            np.testing.assert_allclose(simulator.expectation_values(['ZI', 'IZ']), [1 - 2 * bit, 1 - 2 * bit])
+        self.assertSetEqual(outcomes, {0, 1})
+
+
+class ChunkedStatevectorSimulatorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.prgm = Program()
+        qubits = self.prgm.Qubits([0, 1, 0, 0, 1, 0])
+        bits = self.prgm.CBits(1)
+        self.prgm += H(qubits) + RY(qubits[5], 0.4) + T(qubits[4]) + If(All(qubits[3:5])).Then(X(qubits[0]))
+        self.prgm += CX(qubits[5], qubits[1]) + Swap(qubits[0], qubits[2]) + CX(qubits[0], qubits[5])
+        self.prgm += Measurement(qubits[5], bits[0]) + H(qubits[4])
+
+    def test_chunks(self) -> None:
+        expected = StatevectorSimulator(seed=2)
+        Quasar().compile(self.prgm, expected)
+        paulis = ['XYZ', 'ZIIZZX', 'IIIIXX']
+
+        for chunk_qubits in [2, 6]:
+            actual = ChunkedStatevectorSimulator(chunk_qubits, num_threads=2, seed=2)
+            Quasar().compile(self.prgm, actual)
+            self.assertListEqual(actual.bits, expected.bits)
+            np.testing.assert_allclose(actual.get_state(), expected.get_state(), atol=1e-12)
+            np.testing.assert_allclose(actual.expectation_values(paulis), expected.expectation_values(paulis), atol=1e-12)
+
+    def test_memory_map(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.bin')
+            simulator = ChunkedStatevectorSimulator(3, path=path, seed=2)
+            Quasar().compile(self.prgm, simulator)
+            self.assertEqual(os.path.getsize(path), 16 * 2 ** 6)
+            self.assertAlmostEqual(np.linalg.norm(simulator.get_state()), 1)
+            del simulator
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines a sparse simulator of the compiled circuits keeping only the nonzero
+amplitudes, so the memory grows with their number instead of exponentially with the number
+of qubits. The mostly classical circuits (the arithmetics of `qutils`, the oracles computing
+and uncomputing ancillas) touch only a few basis states even on many qubits. """
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from quasar_sim import StatevectorSimulator
+
+
+def _get_monomial_entries(matrix: np.ndarray) -> Optional[List[Tuple[int, complex]]]:
+    """ Returns the row and the value of the only nonzero entry of each column
+    (e.g. for X, SWAP or a diagonal gate), or None if some column has more of them. """
+    entries: List[Tuple[int, complex]] = []
+    for column in matrix.T:
+        rows = np.flatnonzero(column)
+        if len(rows) != 1:
+            return None
+        entries.append((int(rows[0]), complex(column[rows[0]])))
+    return entries
+
+
+class SparseSimulator(StatevectorSimulator):
+    """ Keeps the nonzero amplitudes in a dictionary keyed by the basis states (ordered like in
+    `StatevectorSimulator`). The gates permuting the basis states (X, CX, CCX, SWAP, up to phases)
+    move the amplitudes, the others (like H or U3) branch them and the amplitudes with the magnitude
+    below `prune_threshold` are dropped. Once more than `max_density` of the amplitudes of a state
+    of at most `max_dense_qubits` qubits are nonzero, the simulation continues with the dense state. """
+
+    def __init__(
+        self,
+        prune_threshold: float = 1e-12,
+        max_density: float = 0.25,
+        max_dense_qubits: int = 26,
+        seed: Optional[int] = None
+    ) -> None:
+        super().__init__(seed)
+        self.prune_threshold = prune_threshold
+        self.max_density = max_density
+        self.max_dense_qubits = max_dense_qubits
+        self._amplitudes: Optional[Dict[int, complex]] = {0: 1}
+
+    def _initialize(self) -> None:
+        self._amplitudes = {0: 1}
+        self._state = np.ones(1, dtype=complex)
+
+    def is_dense(self) -> bool:
+        return self._amplitudes is None
+
+    def get_amplitudes(self) -> Dict[int, complex]:
+        """ Returns the nonzero amplitudes of the final state keyed by the basis states. """
+        self._flush()
+        if self._amplitudes is None:
+            return {int(index): complex(self._state[index]) for index in np.flatnonzero(self._state)}
+        return dict(self._amplitudes)
+
+    def get_state(self) -> np.ndarray:
+        self._flush()
+        if self._amplitudes is None:
+            return self._state
+        state = np.zeros(2 ** self.qubits_counter, dtype=complex)
+        for index, amplitude in self._amplitudes.items():
+            state[index] = amplitude
+        return state
+
+    def _densify_if_needed(self) -> None:
+        if self.qubits_counter <= self.max_dense_qubits \
+                and len(self._amplitudes) > self.max_density * 2 ** self.qubits_counter:
+            self._state = self.get_state()
+            self._amplitudes = None
+
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        if self._amplitudes is None:
+            super()._apply_matrix(matrix, qubit_ids, controls)
+            return
+
+        control_mask = sum(1 << qubit_id for qubit_id in controls)
+        control_value = sum(value << qubit_id for qubit_id, value in controls.items())
+        qubits_mask = sum(1 << qubit_id for qubit_id in qubit_ids)
+
+        def get_sub_index(index: int) -> int:
+            return sum(((index >> qubit_id) & 1) << position for position, qubit_id in enumerate(qubit_ids))
+
+        def set_sub_index(index: int, sub_index: int) -> int:
+            return (index & ~qubits_mask) \
+                | sum(((sub_index >> position) & 1) << qubit_id for position, qubit_id in enumerate(qubit_ids))
+
+        amplitudes: Dict[int, complex] = {}
+        entries = _get_monomial_entries(matrix)
+        if entries is not None:
+            # A permutation of the basis states (with phases), the amplitudes are moved without branching
+            for index, amplitude in self._amplitudes.items():
+                if index & control_mask == control_value:
+                    row, value = entries[get_sub_index(index)]
+                    amplitudes[set_sub_index(index, row)] = value * amplitude
+                else:
+                    amplitudes[index] = amplitude
+            self._amplitudes = amplitudes
+            return
+
+        # The amplitudes are grouped by the basis states of the other qubits and multiplied by the matrix
+        groups: Dict[int, np.ndarray] = {}
+        for index, amplitude in self._amplitudes.items():
+            if index & control_mask == control_value:
+                rest = index & ~qubits_mask
+                if rest not in groups:
+                    groups[rest] = np.zeros(len(matrix), dtype=complex)
+                groups[rest][get_sub_index(index)] = amplitude
+            else:
+                amplitudes[index] = amplitude
+        for rest, group in groups.items():
+            for sub_index, amplitude in enumerate(matrix @ group):
+                if abs(amplitude) > self.prune_threshold:
+                    amplitudes[set_sub_index(rest, sub_index)] = amplitude
+        self._amplitudes = amplitudes
+        self._densify_if_needed()
+
+    def _measure(self, qubit: int) -> int:
+        if self._amplitudes is None:
+            return super()._measure(qubit)
+
+        probability = sum(abs(amplitude) ** 2 for index, amplitude in self._amplitudes.items() if (index >> qubit) & 1)
+        value = int(self._rng.random() < probability)
+        norm = math.sqrt(probability if value else 1 - probability)
+        self._amplitudes = {
+            index: amplitude / norm
+            for index, amplitude in self._amplitudes.items()
+            if (index >> qubit) & 1 == value
+        }
+        return value
+
+    def expectation_values(self, paulis: List[str]) -> List[float]:
+        """ Returns the expectation values of the Pauli strings (see `StatevectorSimulator.expectation_values`).
+        A Pauli string maps a basis state onto a basis state with a phase, so the sparse state
+        is multiplied by its conjugated copy with the flipped basis states. """
+        if self._amplitudes is None:
+            return super().expectation_values(paulis)
+        self._check_pauli_strings(paulis)
+        self._flush()
+
+        values: List[float] = []
+        for pauli in paulis:
+            flip_mask = sum(1 << qubit_id for qubit_id, operator in enumerate(pauli) if operator in 'XY')
+            sign_mask = sum(1 << qubit_id for qubit_id, operator in enumerate(pauli) if operator in 'YZ')
+            # Y = i X Z
+            phase = 1j ** pauli.count('Y')
+            value = 0j
+            for index, amplitude in self._amplitudes.items():
+                flipped = self._amplitudes.get(index ^ flip_mask)
+                if flipped is not None:
+                    value += flipped.conjugate() * amplitude * (-1) ** bin(index & sign_mask).count('1')
+            values.append(float((phase * value).real))
+        return values
@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import math
+import unittest
+
+import numpy as np
+
+from quasar import CX, H, Measurement, Program, Quasar, RY, Swap, U3
+from quasar_sim import StatevectorSimulator
+from quasar_sparse import SparseSimulator
+from qutils import Inc, Set
+
+#
+##
+#
+
+class SparseSimulatorTest(unittest.TestCase):
+    def test_state(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 1, 0, 1])
+        bits = prgm.CBits(1)
+        prgm += H(qubits[0]) + Inc(qubits) + Swap(qubits[1], qubits[3]) + U3(qubits[2], 0.1, 0.2, 0.3)
+        prgm += Measurement(qubits[0], bits[0]) + CX(qubits[0], qubits[2])
+
+        expected = StatevectorSimulator(seed=3)
+        Quasar().compile(prgm, expected)
+        actual = SparseSimulator(seed=3)
+        Quasar().compile(prgm, actual)
+        self.assertFalse(actual.is_dense())
+        self.assertListEqual(actual.bits, expected.bits)
+        np.testing.assert_allclose(actual.get_state(), expected.get_state(), atol=1e-12)
+        np.testing.assert_allclose(
+            actual.expectation_values(['Z', 'IYZX', 'IIXZ']),
+            expected.expectation_values(['Z', 'IYZX', 'IIXZ']),
+            atol=1e-12
+        )
+
+    def test_wide_arithmetics(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(60 * [0])
+        prgm += Set(qubits, 12345) + H(qubits[-1]) + Inc(qubits) + Inc(qubits)
+
+        simulator = SparseSimulator()
+        Quasar().compile(prgm, simulator)
+
+        def get_index(value: int) -> int:
+            # The last qubit of the register is the least significant one
+            return sum(((value >> (len(qubits) - 1 - position)) & 1) << position for position in range(len(qubits)))
+
+        amplitudes = simulator.get_amplitudes()
+        self.assertSetEqual(set(amplitudes), {get_index(12346), get_index(12347)})
+        self.assertAlmostEqual(abs(amplitudes[get_index(12346)]), 1 / math.sqrt(2))
+
+    def test_dense_fallback(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        prgm += H(qubits[0])
+
+        simulator = SparseSimulator()
+        Quasar().compile(prgm, simulator)
+        self.assertFalse(simulator.is_dense())
+
+        prgm += RY(qubits[1], 0.5) + H(qubits[2])
+        simulator = SparseSimulator()
+        Quasar().compile(prgm, simulator)
+        self.assertTrue(simulator.is_dense())
+        self.assertEqual(len(simulator.get_amplitudes()), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+""" This file defines a stabilizer (tableau) simulator of the Clifford circuits, following
+Aaronson and Gottesman "Improved simulation of stabilizer circuits" (the CHP simulator).
+Its memory grows quadratically and the time of a gate linearly with the number of qubits,
+so the Clifford circuits on thousands of qubits can be simulated. """
+
+import cmath
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from builtin_gates import H_GATE, S_GATE, X_GATE, Y_GATE, Z_GATE
+from quasar_sim import ISimulator, gate_matrix
+
+
+def _get_clifford_words() -> List[Tuple[np.ndarray, str]]:
+    """ Returns the 24 single-qubit Clifford gates (up to a phase) as the products of H and S gates,
+    the letters of a word are applied from the first one. """
+    generators = {'H': gate_matrix(H_GATE, []), 'S': gate_matrix(S_GATE, [])}
+    words = [(np.eye(2, dtype=complex), '')]
+    for matrix, word in words:
+        for letter, generator in generators.items():
+            product = generator @ matrix
+            if not any(_get_phase(product, other) is not None for other, _ in words):
+                words.append((product, word + letter))
+    return words
+
+
+def _get_phase(matrix: np.ndarray, other: np.ndarray) -> Optional[complex]:
+    """ Returns the phase `p` such that `matrix == p * other`, or None if there is none. """
+    phase = np.trace(other.conj().T @ matrix) / 2
+    if abs(abs(phase) - 1) > 1e-9 or not np.allclose(matrix, phase * other, atol=1e-9):
+        return None
+    return phase
+
+
+_CLIFFORD_WORDS = _get_clifford_words()
+
+_PAULIS = {'X': gate_matrix(X_GATE, []), 'Y': gate_matrix(Y_GATE, []), 'Z': gate_matrix(Z_GATE, [])}
+
+_SWAP = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+
+
+def _count_bits(words: np.ndarray) -> np.ndarray:
+    """ Returns the numbers of the set bits of the words along the last axis. """
+    return np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def _get_product_sign(x: np.ndarray, z: np.ndarray, r: np.ndarray) -> int:
+    """ Returns the sign of the product of the commuting rows (given as words) in their order.
+    With Y = i X Z on each qubit a row is `(-1)^r i^|x & z| X^x Z^z` and moving Z^z_i past X^x_j
+    gives `(-1)^(z_i . x_j)`, so the exponent of `i` of the product is computed at once. """
+    if not len(x):
+        return 0
+    preceding_z = np.bitwise_xor.accumulate(z, axis=0)[:-1]
+    product_x = np.bitwise_xor.reduce(x, axis=0)
+    product_z = np.bitwise_xor.reduce(z, axis=0)
+    exponent = 2 * int(np.sum(r)) + int(np.sum(_count_bits(x & z))) \
+        + 2 * int(np.sum(_count_bits(preceding_z & x[1:]))) - int(_count_bits(product_x & product_z))
+    return (exponent % 4) // 2
+
+
+class StabilizerSimulator(ISimulator):
+    """ Keeps the tableau of `n` destabilizers and `n` stabilizers of the state. Each row
+    is a Pauli string with a sign, its X and Z parts are stored per qubit as the bits of words,
+    64 rows per word, so each gate updates a few words of its qubits.
+    Only the Clifford gates are supported: the gates equal up to a phase to products of H and S
+    (including U3 and rotations with the Clifford angles), the controlled Paulis (CX, CY, CZ, up to
+    a phase being a power of `i`) and SWAP. Any other gate raises a `ValueError`. """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        super().__init__(seed)
+        self._x = np.zeros((0, 1), dtype=np.uint64)
+        self._z = np.zeros((0, 1), dtype=np.uint64)
+        self._r = np.zeros(1, dtype=np.uint64)
+
+    def _initialize(self) -> None:
+        num_words = max(1, -(-2 * self.qubits_counter // 64))
+        self._x = np.zeros((self.qubits_counter, num_words), dtype=np.uint64)
+        self._z = np.zeros((self.qubits_counter, num_words), dtype=np.uint64)
+        self._r = np.zeros(num_words, dtype=np.uint64)
+        # The destabilizer `i` is X on the qubit `i` and the stabilizer `n + i` is Z on it
+        for qubit_id in range(self.qubits_counter):
+            self._x[qubit_id] = self._get_row_mask(qubit_id)
+            self._z[qubit_id] = self._get_row_mask(self.qubits_counter + qubit_id)
+
+    def _get_row_mask(self, row: int) -> np.ndarray:
+        mask = np.zeros(len(self._r), dtype=np.uint64)
+        mask[row // 64] = np.uint64(1) << np.uint64(row % 64)
+        return mask
+
+    def _h(self, qubit: int) -> None:
+        self._r ^= self._x[qubit] & self._z[qubit]
+        self._x[qubit], self._z[qubit] = self._z[qubit].copy(), self._x[qubit].copy()
+
+    def _s(self, qubit: int) -> None:
+        self._r ^= self._x[qubit] & self._z[qubit]
+        self._z[qubit] ^= self._x[qubit]
+
+    def _pauli(self, qubit: int, pauli: str) -> None:
+        # The rows anticommuting with the Pauli change their signs
+        if pauli in 'XY':
+            self._r ^= self._z[qubit]
+        if pauli in 'YZ':
+            self._r ^= self._x[qubit]
+
+    def _cx(self, control: int, target: int) -> None:
+        self._r ^= self._x[control] & self._z[target] & ~(self._x[target] ^ self._z[control])
+        self._x[target] ^= self._x[control]
+        self._z[control] ^= self._z[target]
+
+    def _phase(self, qubit: int, phase: complex) -> None:
+        """ Applies diag(1, phase) for a power of `i`. """
+        for _ in range(round(cmath.phase(phase) / (cmath.pi / 2)) % 4):
+            self._s(qubit)
+
+    def _apply_matrix(self, matrix: np.ndarray, qubit_ids: List[int], controls: Dict[int, int]) -> None:
+        if len(qubit_ids) == 2 and not controls and np.allclose(matrix, _SWAP):
+            first, second = qubit_ids
+            self._cx(first, second)
+            self._cx(second, first)
+            self._cx(first, second)
+            return
+        if len(qubit_ids) != 1 or len(controls) > 1 or not all(controls.values()):
+            raise ValueError(f'Gate on {len(qubit_ids)} qubits with {len(controls)} controls is not a Clifford gate')
+        qubit = qubit_ids[0]
+
+        if not controls:
+            for _, word in (entry for entry in _CLIFFORD_WORDS if _get_phase(matrix, entry[0]) is not None):
+                for letter in word:
+                    (self._h if letter == 'H' else self._s)(qubit)
+                return
+            raise ValueError(f'Gate {matrix.tolist()} is not a Clifford gate')
+
+        control = list(controls)[0]
+        for pauli, other in _PAULIS.items():
+            phase = _get_phase(matrix, other)
+            if phase is not None and min(abs(phase - power) for power in (1, 1j, -1, -1j)) < 1e-9:
+                break
+        else:
+            phase = _get_phase(matrix, np.eye(2))
+            if phase is None or min(abs(phase - power) for power in (1, 1j, -1, -1j)) > 1e-9:
+                raise ValueError(f'Controlled gate {matrix.tolist()} is not a Clifford gate')
+            pauli = 'I'
+
+        # The controlled phase * P is the controlled P followed by diag(1, phase) on the control
+        if pauli == 'Z':
+            self._h(qubit)
+        if pauli == 'Y':
+            self._phase(qubit, -1j)
+        if pauli != 'I':
+            self._cx(control, qubit)
+        if pauli == 'Y':
+            self._s(qubit)
+        if pauli == 'Z':
+            self._h(qubit)
+        self._phase(control, phase)
+
+    def _get_rows(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns the X and the Z parts of the rows with the qubits as the bits of words
+        (of the shape (2 * n, words)) and the signs of the rows as bits. """
+        num_rows = 2 * self.qubits_counter
+
+        def transposed(words: np.ndarray) -> np.ndarray:
+            bits = np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')[:, :num_rows]
+            return self._pack(bits.T)
+
+        r = np.unpackbits(self._r.view(np.uint8), bitorder='little')[:num_rows]
+        return transposed(self._x), transposed(self._z), r
+
+    @staticmethod
+    def _pack(bits: np.ndarray) -> np.ndarray:
+        """ Packs the bits along the last axis into 64-bit words. """
+        padded = np.zeros(bits.shape[:-1] + (max(64, -(-bits.shape[-1] // 64) * 64),), dtype=np.uint8)
+        padded[..., :bits.shape[-1]] = bits
+        return np.packbits(padded, axis=-1, bitorder='little').view('<u8')
+
+    def _set_rows(self, x: np.ndarray, z: np.ndarray, r: np.ndarray) -> None:
+        def transposed(words: np.ndarray) -> np.ndarray:
+            bits = np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')[:, :self.qubits_counter]
+            return self._pack(bits.T)
+
+        self._x, self._z, self._r = transposed(x), transposed(z), self._pack(r)
+
+    def _measure_rows(self, x: np.ndarray, z: np.ndarray, r: np.ndarray, qubit: int) -> int:
+        """ Measures the qubit in the tableau given by `_get_rows`, updating it in place. """
+        num_qubits = self.qubits_counter
+        word, bit = qubit // 64, np.uint64(qubit % 64)
+        anticommuting = np.flatnonzero((x[:, word] >> bit) & np.uint64(1))
+        stabilizers = anticommuting[anticommuting >= num_qubits]
+        if not len(stabilizers):
+            # The outcome is determined, Z of the qubit is the product of the stabilizers
+            # paired with the destabilizers anticommuting with it
+            rows = num_qubits + anticommuting
+            return _get_product_sign(x[rows], z[rows], r[rows])
+
+        # The other rows anticommuting with Z of the qubit are multiplied by the pivot row
+        pivot = stabilizers[0]
+        rows = anticommuting[anticommuting != pivot]
+        pivot_x, pivot_z = x[pivot], z[pivot]
+        exponents = 2 * r[rows].astype(np.int64) + 2 * int(r[pivot]) \
+            + int(_count_bits(pivot_x & pivot_z)) + _count_bits(x[rows] & z[rows]) \
+            + 2 * _count_bits(pivot_z & x[rows]) - _count_bits((x[rows] ^ pivot_x) & (z[rows] ^ pivot_z))
+        r[rows] = (exponents % 4) // 2
+        x[rows] ^= pivot_x
+        z[rows] ^= pivot_z
+
+        x[pivot - num_qubits], z[pivot - num_qubits], r[pivot - num_qubits] = x[pivot], z[pivot], r[pivot]
+        x[pivot] = 0
+        z[pivot] = 0
+        z[pivot, word] = np.uint64(1) << bit
+        r[pivot] = self._rng.integers(2)
+        return int(r[pivot])
+
+    def _measure(self, qubit: int) -> int:
+        x, z, r = self._get_rows()
+        value = self._measure_rows(x, z, r, qubit)
+        self._set_rows(x, z, r)
+        return value
+
+    def sample(self, shots: int, qubit_ids: Optional[List[int]] = None) -> np.ndarray:
+        """ Returns the outcomes of `shots` measurements of the `qubit_ids` (by default all the qubits)
+        of the final state, of the shape (shots, number of qubits). The outcomes of a stabilizer state
+        are uniform over an affine space: an outcome of a single measurement flipped by the random
+        combinations of the X parts of the stabilizers. """
+        self._flush()
+        if qubit_ids is None:
+            qubit_ids = list(range(self.qubits_counter))
+        x, z, r = self._get_rows()
+        stabilizers_x = np.unpackbits(x[self.qubits_counter:].view(np.uint8), axis=-1, bitorder='little')
+        stabilizers_x = stabilizers_x[:, qubit_ids].astype(float)
+        outcome = np.array([self._measure_rows(x, z, r, qubit_id) for qubit_id in qubit_ids])
+
+        combinations = self._rng.integers(0, 2, (shots, self.qubits_counter)).astype(float)
+        return ((combinations @ stabilizers_x).astype(np.int64) % 2 ^ outcome).astype(np.uint8)
+
+    def expectation_values(self, paulis: List[str]) -> List[float]:
+        """ Returns the expectation values of the Pauli strings (see `StatevectorSimulator.expectation_values`),
+        which are 0 for the strings anticommuting with some stabilizer and the signs of the products
+        of the stabilizers for the other ones. """
+        self._check_pauli_strings(paulis)
+        self._flush()
+        num_qubits = self.qubits_counter
+        x, z, r = self._get_rows()
+
+        values: List[float] = []
+        for pauli in paulis:
+            pauli_x = self._pack(np.array([operator in 'XY' for operator in pauli.ljust(num_qubits, 'I')], dtype=np.uint8))
+            pauli_z = self._pack(np.array([operator in 'YZ' for operator in pauli.ljust(num_qubits, 'I')], dtype=np.uint8))
+            anticommuting = (_count_bits(x & pauli_z) + _count_bits(z & pauli_x)) % 2
+            if np.any(anticommuting[num_qubits:]):
+                values.append(0.0)
+            else:
+                rows = num_qubits + np.flatnonzero(anticommuting[:num_qubits])
+                values.append(float(1 - 2 * _get_product_sign(x[rows], z[rows], r[rows])))
+        return values
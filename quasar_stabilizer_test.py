@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from math import pi
+import unittest
+
+import numpy as np
+
+from quasar import CX, CZ, H, If, Measurement, Program, Quasar, RX, S, Swap, T, U3, Y, Zero
+from quasar_sim import StatevectorSimulator
+from quasar_stabilizer import StabilizerSimulator
+
+#
+##
+#
+
+class StabilizerSimulatorTest(unittest.TestCase):
+    def test_expectation_values(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 1, 0, 0])
+        prgm += H(qubits[0]) + CX(qubits[0], qubits[2]) + S(qubits[2]) + U3(qubits[3], pi / 2, 0, pi)
+        prgm += If(Zero(qubits[1])).Then(Y(qubits[3])) + CZ(qubits[3], qubits[1]) + Swap(qubits[0], qubits[1])
+        prgm += RX(qubits[1], pi / 2)
+
+        expected = StatevectorSimulator()
+        Quasar().compile(prgm, expected)
+        actual = StabilizerSimulator()
+        Quasar().compile(prgm, actual)
+        paulis = ['IXY', 'IYY', 'IZZ', 'IIIX', 'XZIX', 'ZXZ', 'YXYZ']
+        np.testing.assert_allclose(actual.expectation_values(paulis), expected.expectation_values(paulis), atol=1e-9)
+
+    def test_wide_circuit(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(1000 * [0])
+        bits = prgm.CBits(1)
+        prgm += H(qubits[0])
+        for index in range(len(qubits) - 1):
+            prgm += CX(qubits[index], qubits[index + 1])
+
+        simulator = StabilizerSimulator(seed=0)
+        Quasar().compile(prgm, simulator)
+        self.assertListEqual(simulator.expectation_values(['ZZ', 'X' * 1000, 'Z']), [1, 1, 0])
+        samples = simulator.sample(100, [0, 500, 999])
+        self.assertTupleEqual(samples.shape, (100, 3))
+        self.assertSetEqual({tuple(sample) for sample in samples}, {(0, 0, 0), (1, 1, 1)})
+
+        prgm += Measurement(qubits[500], bits[0])
+        simulator = StabilizerSimulator(seed=1)
+        Quasar().compile(prgm, simulator)
+        self.assertEqual(simulator.expectation_values(['Z' + 998 * 'I' + 'Z'])[0], 1)
+        self.assertEqual(simulator.expectation_values([999 * 'I' + 'Z'])[0], 1 - 2 * simulator.bits[0])
+
+    def test_non_clifford(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        with self.assertRaises(ValueError):
+            Quasar().compile(prgm + T(qubits[0]), StabilizerSimulator())
+        with self.assertRaises(ValueError):
+            Quasar().compile(prgm + If(Zero(qubits[0:2])).Then(H(qubits[2])), StabilizerSimulator())
+
+
+if __name__ == '__main__':
+    unittest.main()
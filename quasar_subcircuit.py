@@ -0,0 +1,206 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from opaque_gates import OpaqueGate
+from quasar_cmd import ICommand, GateCmd, OpaqueGateCmd, BroadcastCmd, RepeatCmd
+
+#
+##
+#
+
+# A subcircuit is defined only if it is used at least twice and has at least that many commands
+# (a shorter one would not pay off the lines of its definition)
+_MIN_SUBCIRCUIT_LENGTH = 4
+
+# The shape of a unitary command (everything except its qubits) and its qubits in the order of its arguments
+_Arguments = Tuple[Tuple, List[int]]
+
+
+def _get_arguments(command: ICommand) -> Optional[_Arguments]:
+    """ Returns None for the commands which cannot be a part of a subcircuit (e.g. measurements). """
+    if isinstance(command, GateCmd):
+        qubit_ids = sorted(command.get_control_qubit_ids()) + [command.get_target_qubit_id()]
+        negative = tuple(qubit_id in command.get_negative_control_qubit_ids() for qubit_id in qubit_ids)
+        return (GateCmd, command.gate, tuple(command._params), negative), qubit_ids
+    if isinstance(command, (BroadcastCmd, OpaqueGateCmd)):
+        qubit_ids = command.get_ordered_qubit_ids()
+        return (type(command), command.gate, tuple(command.params), len(qubit_ids)), qubit_ids
+    return None
+
+
+def _get_mapping(qubit_ids: Iterable[int]) -> Dict[int, int]:
+    """ Maps the qubits onto the subcircuit arguments in the order of their first use. """
+    mapping: Dict[int, int] = {}
+    for qubit_id in qubit_ids:
+        mapping.setdefault(qubit_id, len(mapping))
+    return mapping
+
+
+def _get_pair_key(first: Optional[_Arguments], second: Optional[_Arguments]) -> Optional[Tuple]:
+    """ Returns the key of two consecutive commands which is equal for the same commands on other qubits. """
+    if first is None or second is None:
+        return None
+    qubit_ids = first[1] + second[1]
+    mapping = _get_mapping(qubit_ids)
+    return first[0], second[0], tuple(mapping[qubit_id] for qubit_id in qubit_ids)
+
+
+class _SubcircuitExtractor:
+    """
+    Finds the repeated sequences of unitary commands (equal up to the qubits they act on)
+    in the manner of the Re-Pair compression:
+    - every pair of consecutive commands occurring at least twice becomes a subcircuit
+      (the subcircuits are commands too, so they are paired into longer ones in the next rounds),
+    - the body of a repeat is compressed on its own and becomes a single subcircuit,
+    - the subcircuits which are used once or are too short are inlined back.
+    """
+
+    def __init__(self) -> None:
+        self._gates: Dict[Tuple, OpaqueGate] = {} # pair key -> subcircuit
+        self._bodies: Dict[OpaqueGate, List[ICommand]] = {} # subcircuit -> body, in the order of creation
+
+    def _create(self, commands: List[ICommand]) -> OpaqueGateCmd:
+        """ Creates a subcircuit of `commands`, returns its call. """
+        mapping = _get_mapping(qubit_id for command in commands for qubit_id in _get_arguments(command)[1])
+        gate = OpaqueGate(f'${len(self._bodies)}', len(mapping))
+        self._bodies[gate] = [command.remapped(mapping) for command in commands]
+        return OpaqueGateCmd(gate, list(mapping))
+
+    def _get_call(self, key: Tuple, first: ICommand, second: ICommand) -> OpaqueGateCmd:
+        qubit_ids = list(_get_mapping(_get_arguments(first)[1] + _get_arguments(second)[1]))
+        if key not in self._gates:
+            self._gates[key] = self._create([first, second]).gate
+        return OpaqueGateCmd(self._gates[key], qubit_ids)
+
+    def compress(self, commands: List[ICommand]) -> List[ICommand]:
+        commands = [
+            RepeatCmd(command.count, self._compress_body(command.body)) if isinstance(command, RepeatCmd) else command
+            for command in commands
+        ]
+
+        while True:
+            arguments = [_get_arguments(command) for command in commands]
+            keys = [_get_pair_key(first, second) for (first, second) in zip(arguments, arguments[1:])]
+
+            # The overlapping occurrences (e.g. of XX in XXX) are counted once
+            counts: Counter = Counter()
+            last_indices: Dict[Tuple, int] = {}
+            for (index, key) in enumerate(keys):
+                if key is not None and last_indices.get(key) != index - 1:
+                    counts[key] += 1
+                    last_indices[key] = index
+
+            repeated = {key for (key, count) in counts.items() if count > 1}
+            if not repeated:
+                return commands
+
+            result: List[ICommand] = []
+            index = 0
+            while index < len(commands):
+                # A more frequent pair takes the command over
+                if index < len(keys) and keys[index] in repeated and not (
+                    index + 1 < len(keys) and counts[keys[index + 1]] > counts[keys[index]]
+                ):
+                    result.append(self._get_call(keys[index], commands[index], commands[index + 1]))
+                    index += 2
+                else:
+                    result.append(commands[index])
+                    index += 1
+            commands = result
+
+    def _compress_body(self, body: List[ICommand]) -> List[ICommand]:
+        body = self.compress(body)
+        if len(body) > 1 and all(_get_arguments(command) is not None for command in body):
+            return [self._create(body)]
+        return body
+
+    def _count_uses(self, commands: List[ICommand], uses: Counter, weight: int) -> None:
+        for command in commands:
+            if isinstance(command, RepeatCmd):
+                self._count_uses(command.body, uses, weight * command.count)
+            elif isinstance(command, OpaqueGateCmd) and command.gate in self._bodies:
+                uses[command.gate] += weight
+
+    def _get_defined(self, commands: List[ICommand]) -> Set[OpaqueGate]:
+        """ Returns the subcircuits worth a definition, the other ones are inlined. """
+        uses: Counter = Counter()
+        self._count_uses(commands, uses, 1)
+        lengths: Dict[OpaqueGate, int] = {}
+        for (gate, body) in self._bodies.items():
+            self._count_uses(body, uses, 1)
+            lengths[gate] = sum(lengths.get(command.gate, 1) if isinstance(command, OpaqueGateCmd) else 1 for command in body)
+
+        # A subcircuit is decided after all the ones which may use it
+        defined: Set[OpaqueGate] = set()
+        for gate in reversed(list(self._bodies)):
+            if uses[gate] > 1 and lengths[gate] >= _MIN_SUBCIRCUIT_LENGTH:
+                defined.add(gate)
+                continue
+            # Once inlined, the subcircuits it uses are used wherever it was
+            for command in self._bodies[gate]:
+                if isinstance(command, OpaqueGateCmd) and command.gate in self._bodies:
+                    uses[command.gate] += uses[gate] - 1
+
+        return defined
+
+    def run(self, commands: List[ICommand], reserved_names: Set[str]) -> Tuple[List[ICommand], Dict[OpaqueGate, List[ICommand]]]:
+        commands = self.compress(commands)
+        defined = self._get_defined(commands)
+
+        names = (f'subcircuit{index}' for index in range(len(self._bodies) + len(reserved_names)))
+        gates: Dict[OpaqueGate, OpaqueGate] = {}
+        for gate in self._bodies:
+            if gate in defined:
+                name = next(name for name in names if name not in reserved_names)
+                gates[gate] = OpaqueGate(name, gate.num_qubits)
+
+        def inlined(commands: List[ICommand]) -> List[ICommand]:
+            result: List[ICommand] = []
+            for command in commands:
+                if isinstance(command, RepeatCmd):
+                    result.append(RepeatCmd(command.count, inlined(command.body)))
+                elif isinstance(command, OpaqueGateCmd) and command.gate in gates:
+                    result.append(OpaqueGateCmd(gates[command.gate], command.get_ordered_qubit_ids()))
+                elif isinstance(command, OpaqueGateCmd) and command.gate in self._bodies:
+                    mapping = dict(enumerate(command.get_ordered_qubit_ids()))
+                    result.extend(inlined([body_command.remapped(mapping) for body_command in self._bodies[command.gate]]))
+                else:
+                    result.append(command)
+            return result
+
+        return inlined(commands), {gates[gate]: inlined(self._bodies[gate]) for gate in gates}
+
+
+def extract_subcircuits(
+    commands: List[ICommand],
+    reserved_names: Iterable[str] = ()
+) -> Tuple[List[ICommand], Dict[OpaqueGate, List[ICommand]]]:
+    """ Replaces the repeated sequences of unitary commands with calls of subcircuits, opaque gates
+    named `subcircuit0`, `subcircuit1`, ... (except `reserved_names`), so that they can be defined once.
+    Returns the commands and the subcircuits (in the order they have to be declared in) mapped onto
+    their bodies acting on the qubits 0, 1, ... being their arguments. The expanded circuit is the same. """
+    return _SubcircuitExtractor().run(commands, set(reserved_names))
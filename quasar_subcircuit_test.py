@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+
+import unittest
+
+from builtin_gates import H_GATE, X_GATE, Z_GATE
+from opaque_gates import OpaqueGate
+from quasar import H, Measurement, Program, Quasar, T
+from quasar_cmd import GateCmd, MeasurementCmd, OpaqueGateCmd, RepeatCmd
+from quasar_qasm import QASMFormatter
+from quasar_subcircuit import extract_subcircuits
+from qutils import Inc
+
+#
+##
+#
+
+class SubcircuitTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.block = [
+            GateCmd(X_GATE, 1, control_qubit_ids={0}),
+            GateCmd(H_GATE, 1),
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}),
+            GateCmd(Z_GATE, 0),
+        ]
+
+    def test_repeated_block(self) -> None:
+        moved = [command.remapped({0: 3, 1: 4, 2: 5}) for command in self.block]
+        measurement = MeasurementCmd(0, 0)
+        commands = self.block + moved + [measurement] + self.block + [GateCmd(H_GATE, 1)]
+
+        actual, subcircuits = extract_subcircuits(commands, reserved_names=['subcircuit0'])
+        gate = OpaqueGate('subcircuit1', 3)
+        self.assertDictEqual(subcircuits, {gate: self.block})
+        self.assertListEqual(actual, [
+            OpaqueGateCmd(gate, [0, 1, 2]),
+            OpaqueGateCmd(gate, [3, 4, 5]),
+            measurement,
+            OpaqueGateCmd(gate, [0, 1, 2]),
+            GateCmd(H_GATE, 1),
+        ])
+
+        # A block used once (or too short) is not worth a definition
+        self.assertEqual(extract_subcircuits(self.block + moved[:3]), (self.block + moved[:3], {}))
+
+    def test_repeat(self) -> None:
+        actual, subcircuits = extract_subcircuits([RepeatCmd(3, self.block)])
+        gate = OpaqueGate('subcircuit0', 3)
+        self.assertDictEqual(subcircuits, {gate: self.block})
+        self.assertListEqual(actual, [RepeatCmd(3, [OpaqueGateCmd(gate, [0, 1, 2])])])
+
+    def test_nested(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(6 * [0])
+        for _ in range(100):
+            prgm += Inc(qubits)
+        compiler = Quasar()
+        compiler.compile(prgm, QASMFormatter())
+
+        # The blocks of blocks are subcircuits too, so the code shrinks by orders of magnitude
+        actual = compiler.compile(prgm, QASMFormatter(), define_subcircuits=True)
+        self.assertLess(len(actual), compiler.ancilla_report.num_gates // 20)
+        self.assertEqual(compiler.ancilla_report.num_gates, 1800)
+
+    def test_qasm(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits(4 * [0])
+        bits = prgm.CBits(1)
+
+        def block(a, b):
+            return Inc([a, b]) + H(a) + T(b)
+
+        prgm += block(qubits[0], qubits[1]) + Measurement(qubits[0], bits[0])
+        prgm += block(qubits[2], qubits[3]) + block(qubits[1], qubits[2])
+
+        actual = Quasar().compile(prgm, QASMFormatter(), define_subcircuits=True)
+        self.assertListEqual(actual, [
+            'OPENQASM 2.0;',
+            'include "qelib1.inc";',
+            'gate subcircuit0 a0, a1 {',
+            '    cx a0, a1;',
+            '    x a0;',
+            '    h a1;',
+            '    t a0;',
+            '}',
+            ' ',
+            'qreg q[4];',
+            'creg c[1];',
+            ' ',
+            'subcircuit0 q[1], q[0];',
+            'measure q[0] -> c[0];',
+            'subcircuit0 q[3], q[2];',
+            'subcircuit0 q[2], q[1];',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,505 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from math import pi
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from builtin_arithmetics import is_diagonal_gate
+from builtin_gates import BuiltinGate, X_GATE, Y_GATE, Z_GATE, H_GATE, U3_GATE, \
+    RX_GATE, RY_GATE, RZ_GATE, P_GATE, S_GATE, SDG_GATE, T_GATE, TDG_GATE
+from opaque_gates import OpaqueGate
+from quasar_cmd import ICommand, ICmdVisitor, GateCmd, OpaqueGateCmd, BroadcastCmd, RepeatCmd, MeasurementCmd, ResetCmd, ClassicalIfCmd
+
+#
+##
+#
+
+# U3 parameters of the single qubit builtin gates (exactly, including the global phase)
+_U3_PARAMS: Dict[BuiltinGate, List[float]] = {
+    X_GATE: [pi, 0, pi],
+    Y_GATE: [pi, pi/2, pi/2],
+    Z_GATE: [0, 0, pi],
+    H_GATE: [pi/2, 0, pi],
+    S_GATE: [0, 0, pi/2],
+    SDG_GATE: [0, 0, -pi/2],
+    T_GATE: [0, 0, pi/4],
+    TDG_GATE: [0, 0, -pi/4],
+}
+
+# Phase gates equal to P with the given parameter
+_P_PARAMS: Dict[BuiltinGate, float] = {
+    Z_GATE: pi,
+    S_GATE: pi/2,
+    SDG_GATE: -pi/2,
+    T_GATE: pi/4,
+    TDG_GATE: -pi/4,
+}
+
+
+def get_u3_phase_and_params(gate: BuiltinGate, params: List[float]) -> Tuple[float, List[float]]:
+    """ Returns `alpha` and the U3 parameters such that the gate is exp(i `alpha`) U3(params). """
+    if gate == U3_GATE:
+        return 0.0, params
+    if gate == RX_GATE:
+        return 0.0, [params[0], -pi/2, pi/2]
+    if gate == RY_GATE:
+        return 0.0, [params[0], 0, 0]
+    if gate == RZ_GATE:
+        return -params[0] / 2, [0, 0, params[0]]
+    if gate == P_GATE:
+        return 0.0, [0, 0, params[0]]
+    if gate in _U3_PARAMS:
+        return 0.0, _U3_PARAMS[gate]
+    raise NotImplementedError(f'Dont know how to express {gate} as U3')
+
+
+def to_u3_params(gate: BuiltinGate, params: List[float]) -> List[float]:
+    """ Returns the U3 parameters of the gate up to its global phase (see `get_u3_phase_and_params`). """
+    return get_u3_phase_and_params(gate, params)[1]
+
+
+class Target:
+    """ Describes a native gate set of a backend.
+    `gates` maps a builtin gate onto the maximal number of its control qubits
+    supported natively (0 means only an uncontrolled gate).
+    `costs` maps a builtin gate onto the relative costs of the gate with 0, 1, 2, ... controls.
+    Non-native gates are lowered into CX and U3 gates, so these two have to be native
+    for any lowering to happen.
+    `opaque_gates` makes all the (uncontrolled) opaque gates native, otherwise only the ones
+    listed in `gates` are, the others are expanded by the compiler with their definitions. """
+
+    def __init__(
+        self,
+        gates: Dict[Union[BuiltinGate, OpaqueGate], int],
+        costs: Optional[Dict[Union[BuiltinGate, OpaqueGate], List[float]]] = None,
+        opaque_gates: bool = False
+    ) -> None:
+        self._gates = gates
+        self._costs = costs or {}
+        self._opaque_gates = opaque_gates
+
+    def is_native(self, gate: Union[BuiltinGate, OpaqueGate], num_controls: int) -> bool:
+        if isinstance(gate, OpaqueGate) and self._opaque_gates:
+            return num_controls == 0
+        return num_controls <= self._gates.get(gate, -1)
+
+    def get_max_controls(self, gate: BuiltinGate) -> int:
+        """ Returns the number of controls the compiler may leave on `gate`,
+        natively or by the lowering (CCX into Clifford+T, controlled U into CX+U3). """
+        return max(self._gates.get(gate, -1), 2 if gate == X_GATE else 1)
+
+    def get_gate_cost(self, gate: Union[BuiltinGate, OpaqueGate], num_controls: int) -> float:
+        costs = self._costs.get(gate, [])
+        if num_controls < len(costs):
+            return costs[num_controls]
+        if isinstance(gate, OpaqueGate):
+            return gate.cost
+        return 1.0
+
+    def get_cost(self, commands: List[ICommand]) -> float:
+        return sum(
+            self.get_gate_cost(command.gate, len(command.get_control_qubit_ids()))
+            for command in commands if isinstance(command, GateCmd)
+        ) + sum(
+            self.get_gate_cost(command.gate, 0)
+            for command in commands if isinstance(command, OpaqueGateCmd)
+        ) + sum(
+            self.get_gate_cost(command.gate, 0) * len(command.get_qubit_ids())
+            for command in commands if isinstance(command, BroadcastCmd)
+        ) + sum(
+            self.get_cost(command.body) * command.count
+            for command in commands if isinstance(command, RepeatCmd)
+        )
+
+    def lower(self, commands: List[ICommand]) -> List[ICommand]:
+        """ Decomposes all the non-native commands into the native ones. """
+        return _LoweringVisitor(self).run(commands)
+
+    def stream(self, commands: Iterable[ICommand]) -> Iterator[ICommand]:
+        """ Lowers the commands on the fly. The mirrored twins of the relative phase commands are not known
+        in advance, so they are lowered exactly, otherwise the result is the same as of `Target.lower`. """
+        return _LoweringVisitor(self).stream(commands)
+
+
+DEFAULT_TARGET = Target({
+    X_GATE: 2,
+    Y_GATE: 1,
+    Z_GATE: 1,
+    H_GATE: 1,
+    U3_GATE: 1,
+    RX_GATE: 1,
+    RY_GATE: 1,
+    RZ_GATE: 1,
+    P_GATE: 1,
+    S_GATE: 0,
+    SDG_GATE: 0,
+    T_GATE: 0,
+    TDG_GATE: 0,
+}, opaque_gates=True)
+
+CX_U3_TARGET = Target({
+    X_GATE: 1,
+    U3_GATE: 0,
+})
+
+#
+##
+#
+
+def _u1(qubit_id: int, arg1: float) -> GateCmd:
+    return GateCmd(U3_GATE, qubit_id, params=[0, 0, arg1])
+
+
+def _cx(control_qubit_id: int, target_qubit_id: int) -> GateCmd:
+    return GateCmd(X_GATE, target_qubit_id, control_qubit_ids={control_qubit_id})
+
+
+def get_cu3_commands(control_qubit_id: int, target_qubit_id: int, params: List[float]) -> List[GateCmd]:
+    """ Controlled U3 (with its exact phase) via the ABC decomposition. """
+    theta, phi, lambda_ = params
+    return [
+        _u1(control_qubit_id, (lambda_ + phi) / 2),
+        _u1(target_qubit_id, (lambda_ - phi) / 2),
+        _cx(control_qubit_id, target_qubit_id),
+        GateCmd(U3_GATE, target_qubit_id, params=[-theta / 2, 0, -(phi + lambda_) / 2]),
+        _cx(control_qubit_id, target_qubit_id),
+        GateCmd(U3_GATE, target_qubit_id, params=[theta / 2, phi, 0]),
+    ]
+
+
+def get_ccx_commands(control_qubit_id_1: int, control_qubit_id_2: int, target_qubit_id: int) -> List[GateCmd]:
+    """ CCX in Clifford+T: 6 CX and 7 T/Tdg gates. """
+    a, b, t = control_qubit_id_1, control_qubit_id_2, target_qubit_id
+    h = lambda q: GateCmd(H_GATE, q)
+    t_ = lambda q: _u1(q, pi / 4)
+    tdg = lambda q: _u1(q, -pi / 4)
+    return [
+        h(t), _cx(b, t), tdg(t), _cx(a, t), t_(t), _cx(b, t), tdg(t), _cx(a, t),
+        t_(b), t_(t), h(t), _cx(a, b), t_(a), tdg(b), _cx(a, b),
+    ]
+
+
+def get_rccx_commands(control_qubit_id_1: int, control_qubit_id_2: int, target_qubit_id: int) -> List[GateCmd]:
+    """ CCX up to a relative phase (the Margolus gate): 3 CX and 4 T/Tdg gates.
+    It is self-inverse, so a pair of them with commands commuting with the phase
+    in between is equal to a pair of exact CCX gates. """
+    a, b, t = control_qubit_id_1, control_qubit_id_2, target_qubit_id
+    h = lambda q: GateCmd(H_GATE, q)
+    t_ = lambda q: _u1(q, pi / 4)
+    tdg = lambda q: _u1(q, -pi / 4)
+    return [
+        h(t), t_(t), _cx(b, t), tdg(t), _cx(a, t), t_(t), _cx(b, t), tdg(t), h(t),
+    ]
+
+
+def _commutes_with_phase(command: ICommand, qubit_ids: Set[int]) -> bool:
+    """ Checks if `command` commutes with any diagonal gate acting on `qubit_ids`. """
+    if not isinstance(command, GateCmd):
+        return not command.get_qubit_ids() & qubit_ids
+    if command.get_target_qubit_id() not in qubit_ids:
+        return True
+    return is_diagonal_gate(command.gate, command._params)
+
+
+def get_relative_phase_pairs(commands: List[ICommand]) -> Set[int]:
+    """ Returns indices of the relative phase CCX commands paired with their mirrored twins,
+    such that all the commands in between commute with the relative phase. """
+    paired: Set[int] = set()
+    opened: Dict[Tuple[int, FrozenSet[int], FrozenSet[int]], int] = {}
+
+    for (index, command) in enumerate(commands):
+        key = None
+        if isinstance(command, GateCmd) and command.is_relative_phase():
+            key = (
+                command.get_target_qubit_id(),
+                frozenset(command.get_control_qubit_ids()),
+                frozenset(command.get_negative_control_qubit_ids())
+            )
+            if key in opened:
+                paired.update((opened.pop(key), index))
+                continue
+
+        for (other_key, _) in list(opened.items()):
+            if not _commutes_with_phase(command, {other_key[0]} | other_key[1]):
+                del opened[other_key]
+
+        if key is not None:
+            opened[key] = index
+
+    return paired
+
+
+class _LoweringVisitor(ICmdVisitor):
+    def __init__(self, target: Target) -> None:
+        self._target = target
+        self._commands: List[ICommand] = []
+        self._relative_phase_commands: Set[int] = set()
+
+    def run(self, commands: List[ICommand]) -> List[ICommand]:
+        self._commands = []
+        self._relative_phase_commands = {id(commands[index]) for index in get_relative_phase_pairs(commands)}
+        for command in commands:
+            command.accept(self)
+        return self._commands
+
+    def stream(self, commands: Iterable[ICommand]) -> Iterator[ICommand]:
+        self._commands = []
+        self._relative_phase_commands = set()
+        for command in commands:
+            command.accept(self)
+            yield from self._commands
+            self._commands = []
+
+    def on_program(self, commands: List[ICommand]) -> None:
+        pass
+
+    def _can_lower(self) -> bool:
+        return self._target.is_native(X_GATE, 1) and self._target.is_native(U3_GATE, 0)
+
+    def _get_decomposition(self, cmd: GateCmd) -> Optional[List[GateCmd]]:
+        if not self._can_lower():
+            return None
+
+        negative_control_qubit_ids = sorted(cmd.get_negative_control_qubit_ids())
+        if negative_control_qubit_ids:
+            # The negative controls are conjugated with X gates
+            decomposition = self._get_positive_decomposition(cmd)
+            if decomposition is None:
+                return None
+            negations = [GateCmd(X_GATE, qubit_id) for qubit_id in negative_control_qubit_ids]
+            return negations + decomposition + negations
+
+        return self._get_positive_decomposition(cmd)
+
+    def _get_positive_decomposition(self, cmd: GateCmd) -> Optional[List[GateCmd]]:
+        """ Decomposes `cmd` as if all its controls were positive. """
+        gate = cmd.gate
+        target_qubit_id = cmd.get_target_qubit_id()
+        control_qubit_ids = sorted(cmd.get_control_qubit_ids())
+
+        if not control_qubit_ids:
+            return [GateCmd(U3_GATE, target_qubit_id, params=to_u3_params(gate, cmd._params))]
+
+        if len(control_qubit_ids) == 1:
+            alpha, params = get_u3_phase_and_params(gate, cmd._params)
+            commands = get_cu3_commands(control_qubit_ids[0], target_qubit_id, params)
+            if alpha != 0:
+                commands.append(_u1(control_qubit_ids[0], alpha))
+            return commands
+
+        if len(control_qubit_ids) == 2 and gate == X_GATE:
+            if id(cmd) in self._relative_phase_commands:
+                return get_rccx_commands(control_qubit_ids[0], control_qubit_ids[1], target_qubit_id)
+            return get_ccx_commands(control_qubit_ids[0], control_qubit_ids[1], target_qubit_id)
+
+        return None
+
+    def _get_equivalent(self, cmd: GateCmd) -> Optional[List[GateCmd]]:
+        """ Rewrites `cmd` into a native phase or U3 gate with the same controls, if there is one. """
+        gate = cmd.gate
+        target_qubit_id = cmd.get_target_qubit_id()
+        control_qubit_ids = cmd.get_control_qubit_ids()
+        negative_control_qubit_ids = cmd.get_negative_control_qubit_ids()
+        num_controls = len(control_qubit_ids)
+
+        if gate in _P_PARAMS and self._target.is_native(P_GATE, num_controls):
+            return [GateCmd(
+                P_GATE,
+                target_qubit_id,
+                control_qubit_ids,
+                [_P_PARAMS[gate]],
+                cmd.is_relative_phase(),
+                negative_control_qubit_ids
+            )]
+
+        if gate == U3_GATE or not self._target.is_native(U3_GATE, num_controls):
+            return None
+        alpha, params = get_u3_phase_and_params(gate, cmd._params)
+        if alpha != 0 and num_controls > 1:
+            return None
+
+        commands = [GateCmd(
+            U3_GATE,
+            target_qubit_id,
+            control_qubit_ids,
+            params,
+            cmd.is_relative_phase(),
+            negative_control_qubit_ids
+        )]
+        if alpha != 0 and num_controls == 1:
+            # The phase of the controlled gate is a phase gate on its control,
+            # exp(i alpha) on |0> is U1(-alpha) up to the global phase for a negative control
+            control_qubit_id = next(iter(control_qubit_ids))
+            if control_qubit_id in negative_control_qubit_ids:
+                alpha = -alpha
+            commands.append(_u1(control_qubit_id, alpha))
+        return commands
+
+    def on_gate(self, cmd: GateCmd) -> None:
+        num_controls = len(cmd.get_control_qubit_ids())
+        native = self._target.is_native(cmd.gate, num_controls)
+
+        if native and (num_controls == 0 or (cmd.gate == X_GATE and num_controls == 1)):
+            # Gates the lowering decomposes into
+            self._commands.append(cmd)
+            return
+
+        if not native:
+            equivalent = self._get_equivalent(cmd)
+            if equivalent is not None:
+                for command in equivalent:
+                    command.accept(self)
+                return
+
+        decomposition = self._get_decomposition(cmd)
+
+        if decomposition is None:
+            if native:
+                self._commands.append(cmd)
+                return
+            raise ValueError(f'Cannot lower {cmd} into the target gate set.')
+
+        if native:
+            # Natively supported, but the decomposition may still be cheaper
+            lowered = _LoweringVisitor(self._target).run(decomposition)
+            if self._target.get_cost(lowered) < self._target.get_gate_cost(cmd.gate, num_controls):
+                self._commands.extend(lowered)
+            else:
+                self._commands.append(cmd)
+            return
+
+        for command in decomposition:
+            command.accept(self)
+
+    def on_broadcast(self, cmd: BroadcastCmd) -> None:
+        if self._target.is_native(cmd.gate, 0):
+            self._commands.append(cmd)
+            return
+
+        # A non-native gate equal to a single native one is still broadcast
+        equivalent = self._get_equivalent(cmd.expanded()[0])
+        if equivalent is not None and len(equivalent) == 1:
+            BroadcastCmd(equivalent[0].gate, cmd.get_ordered_qubit_ids(), equivalent[0]._params).accept(self)
+            return
+
+        for command in cmd.expanded():
+            command.accept(self)
+
+    def on_repeat(self, cmd: RepeatCmd) -> None:
+        self._commands.append(RepeatCmd(cmd.count, _LoweringVisitor(self._target).run(cmd.body)))
+
+    def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+        # The non-native opaque gates are expanded by the compiler
+        if not self._target.is_native(cmd.gate, 0):
+            raise ValueError(f'Cannot lower {cmd} into the target gate set.')
+        self._commands.append(cmd)
+
+    def on_measurement(self, m: MeasurementCmd) -> None:
+        self._commands.append(m)
+
+    def on_reset(self, reset: ResetCmd) -> None:
+        self._commands.append(reset)
+
+    def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+        lowered = _LoweringVisitor(self._target).run([cif.command])
+        self._commands.extend(ClassicalIfCmd(cif.get_bit_id(), command) for command in lowered)
+
+
+class _ControlStateExpander(ICmdVisitor):
+    """ Replaces the negative controls with positive ones conjugated with X gates.
+    A negated qubit stays negated as long as it is used as a negative control only,
+    so the X gates between such consecutive uses are never emitted. """
+
+    def run(self, commands: List[ICommand]) -> List[ICommand]:
+        return list(self.stream(commands))
+
+    def stream(self, commands: Iterable[ICommand]) -> Iterator[ICommand]:
+        self._commands: List[ICommand] = []
+        self._negated: Set[int] = set()
+        for command in commands:
+            command.accept(self)
+            yield from self._commands
+            self._commands = []
+        self._set_negated(set(), set(self._negated))
+        yield from self._commands
+
+    def _set_negated(self, negated: Set[int], qubit_ids: Set[int]) -> None:
+        """ Makes exactly the `negated` ones of `qubit_ids` negated. """
+        for qubit_id in sorted((negated ^ self._negated) & qubit_ids):
+            self._commands.append(GateCmd(X_GATE, qubit_id))
+            self._negated ^= {qubit_id}
+
+    def _expanded(self, cmd: GateCmd) -> GateCmd:
+        negated = cmd.get_negative_control_qubit_ids()
+        self._set_negated(set(negated), cmd.get_qubit_ids())
+        if not negated:
+            return cmd
+        return GateCmd(
+            cmd.gate,
+            cmd.get_target_qubit_id(),
+            cmd.get_control_qubit_ids(),
+            cmd._params,
+            cmd.is_relative_phase()
+        )
+
+    def on_program(self, commands: List[ICommand]) -> None:
+        pass
+
+    def on_gate(self, cmd: GateCmd) -> None:
+        self._commands.append(self._expanded(cmd))
+
+    def on_opaque_gate(self, cmd: OpaqueGateCmd) -> None:
+        self._set_negated(set(), cmd.get_qubit_ids())
+        self._commands.append(cmd)
+
+    def on_broadcast(self, cmd: BroadcastCmd) -> None:
+        self._set_negated(set(), cmd.get_qubit_ids())
+        self._commands.append(cmd)
+
+    def on_repeat(self, cmd: RepeatCmd) -> None:
+        # Every copy of the body starts and ends with no negated qubits
+        self._set_negated(set(), cmd.get_qubit_ids())
+        self._commands.append(RepeatCmd(cmd.count, _ControlStateExpander().run(cmd.body)))
+
+    def on_measurement(self, m: MeasurementCmd) -> None:
+        self._set_negated(set(), m.get_qubit_ids())
+        self._commands.append(m)
+
+    def on_reset(self, reset: ResetCmd) -> None:
+        # The reset sets the qubit to |0> regardless of the pending X gate
+        self._negated -= reset.get_qubit_ids()
+        self._commands.append(reset)
+
+    def on_classical_if(self, cif: ClassicalIfCmd) -> None:
+        # The X gates are applied unconditionally, so they cancel out if the gate is not applied
+        self._commands.append(ClassicalIfCmd(cif.get_bit_id(), self._expanded(cif.command)))
+
+
+def expand_negative_controls(commands: List[ICommand]) -> List[ICommand]:
+    """ Conjugates the negative controls with X gates, for the backends without native ones. """
+    return _ControlStateExpander().run(commands)
+
+
+def stream_negative_controls(commands: Iterable[ICommand]) -> Iterator[ICommand]:
+    """ Lazy variant of `expand_negative_controls`. """
+    return _ControlStateExpander().stream(commands)
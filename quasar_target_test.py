@@ -0,0 +1,237 @@
+#
+# Copyright (c) 2019- Beit, Beit.Tech, Beit.Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+from cmath import exp
+from math import cos, pi, sin
+from typing import List
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from builtin_gates import H_GATE, U3_GATE, X_GATE, Y_GATE, Z_GATE, RX_GATE, RZ_GATE, P_GATE, S_GATE, TDG_GATE
+from quasar import All, CCX, CRY, H, If, Program, Quasar, U3, X
+from quasar_cmd import GateCmd, ICommand
+from quasar_qasm import QASMFormatter
+from quasar_target import CX_U3_TARGET, DEFAULT_TARGET, Target, expand_negative_controls, get_u3_phase_and_params
+
+#
+##
+#
+
+def _u3(a: float, b: float, c: float) -> np.ndarray:
+    return np.array([
+        [cos(a / 2), -exp(c * 1j) * sin(a / 2)],
+        [exp(b * 1j) * sin(a / 2), exp((b + c) * 1j) * cos(a / 2)],
+    ])
+
+
+def _unitary(commands: List[ICommand], num_qubits: int) -> np.ndarray:
+    """ Little-endian unitary of a circuit consisting of (negatively) controlled U3-like gates. """
+    result = np.eye(2 ** num_qubits, dtype=complex)
+    for cmd in commands:
+        alpha, params = get_u3_phase_and_params(cmd.gate, cmd._params)
+        matrix = exp(alpha * 1j) * _u3(*params)
+        unitary = np.eye(2 ** num_qubits, dtype=complex)
+        target = cmd.get_target_qubit_id()
+        for index in range(2 ** num_qubits):
+            if index & (1 << target):
+                continue
+            negative_controls = cmd.get_negative_control_qubit_ids()
+            if any((index >> c) & 1 == (c in negative_controls) for c in cmd.get_control_qubit_ids()):
+                continue
+            pair = index | (1 << target)
+            unitary[np.ix_([index, pair], [index, pair])] = matrix
+        result = unitary @ result
+    return result
+
+
+class TargetTest(unittest.TestCase):
+
+    def _assert_native(self, commands: List[ICommand], target: Target) -> None:
+        for cmd in commands:
+            self.assertTrue(target.is_native(cmd.gate, len(cmd.get_control_qubit_ids())), cmd)
+
+    def test_default_target(self) -> None:
+        commands = [
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}),
+            GateCmd(U3_GATE, 1, control_qubit_ids={0}, params=[0.1, 0.2, 0.3]),
+            GateCmd(H_GATE, 0),
+        ]
+        self.assertListEqual(DEFAULT_TARGET.lower(commands), commands)
+
+    def test_lower_ccx(self) -> None:
+        ccx = [GateCmd(X_GATE, 2, control_qubit_ids={0, 1})]
+        actual = CX_U3_TARGET.lower(ccx)
+        self._assert_native(actual, CX_U3_TARGET)
+        self.assertEqual(len([cmd for cmd in actual if cmd.get_control_qubit_ids()]), 6)
+        assert_allclose(_unitary(actual, 3), _unitary(ccx, 3), atol=1e-9)
+
+    def test_lower_relative_phase_ccx(self) -> None:
+        ccx = GateCmd(X_GATE, 3, control_qubit_ids={0, 1}, relative_phase=True)
+        body = [GateCmd(U3_GATE, 2, control_qubit_ids={3}, params=[0.3, 1.1, -0.7])]
+        commands = [ccx] + body + [ccx]
+
+        actual = CX_U3_TARGET.lower(commands)
+        self._assert_native(actual, CX_U3_TARGET)
+        assert_allclose(_unitary(actual, 4), _unitary(commands, 4), atol=1e-9)
+        num_cx = sum(1 for cmd in actual if cmd.get_control_qubit_ids())
+        self.assertEqual(num_cx, 2 * 3 + 2)
+
+        # A gate changing the ancilla in between requires the exact CCX
+        flipped = [ccx, GateCmd(H_GATE, 3), ccx]
+        actual = CX_U3_TARGET.lower(flipped)
+        assert_allclose(_unitary(actual, 4), _unitary(flipped, 4), atol=1e-9)
+        num_cx = sum(1 for cmd in actual if cmd.get_control_qubit_ids())
+        self.assertEqual(num_cx, 2 * 6)
+
+    def test_lower_controlled(self) -> None:
+        for (gate, params) in [(X_GATE, []), (Y_GATE, []), (Z_GATE, []), (H_GATE, []), (U3_GATE, [0.3, 1.1, -0.7])]:
+            cmd = [GateCmd(gate, 0, control_qubit_ids={1}, params=params)]
+            actual = CX_U3_TARGET.lower(cmd)
+            self._assert_native(actual, CX_U3_TARGET)
+            assert_allclose(_unitary(actual, 2), _unitary(cmd, 2), atol=1e-9)
+
+    def test_lower_negative_controls(self) -> None:
+        ccx = GateCmd(X_GATE, 2, control_qubit_ids={0, 1}, negative_control_qubit_ids={1})
+        cu3 = GateCmd(U3_GATE, 0, control_qubit_ids={2}, params=[0.3, 1.1, -0.7], negative_control_qubit_ids={2})
+        for target in (DEFAULT_TARGET, CX_U3_TARGET):
+            actual = target.lower([ccx, cu3])
+            self._assert_native(actual, target)
+            assert_allclose(_unitary(actual, 3), _unitary([ccx, cu3], 3), atol=1e-9)
+
+    def test_lower_rotations(self) -> None:
+        commands = [
+            GateCmd(RZ_GATE, 0, control_qubit_ids={1}, params=[0.7]),
+            GateCmd(RZ_GATE, 1, control_qubit_ids={2}, params=[-1.3]),
+            GateCmd(RX_GATE, 2, control_qubit_ids={0}, params=[0.4], negative_control_qubit_ids={0}),
+            GateCmd(S_GATE, 0, control_qubit_ids={2}),
+            GateCmd(TDG_GATE, 1),
+        ]
+        cu3_target = Target({X_GATE: 1, U3_GATE: 1})
+        for target in (CX_U3_TARGET, cu3_target):
+            actual = target.lower(commands)
+            self._assert_native(actual, target)
+            assert_allclose(_unitary(actual, 3), _unitary(commands, 3), atol=1e-9)
+        # The controlled rotations become controlled U3 gates (and a phase on the control)
+        self.assertEqual(len(cu3_target.lower(commands)), 7)
+        # The controlled S is a controlled phase
+        self.assertListEqual(
+            DEFAULT_TARGET.lower(commands[3:4]),
+            [GateCmd(P_GATE, 0, control_qubit_ids={2}, params=[pi / 2])]
+        )
+
+    def test_expand_negative_controls(self) -> None:
+        commands: List[ICommand] = [
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}, negative_control_qubit_ids={0, 1}),
+            GateCmd(Z_GATE, 2, control_qubit_ids={0}, negative_control_qubit_ids={0}),
+            GateCmd(X_GATE, 2, control_qubit_ids={0, 1}, negative_control_qubit_ids={0}),
+            GateCmd(H_GATE, 0),
+        ]
+        actual = expand_negative_controls(commands)
+        self.assertFalse(any(cmd.get_negative_control_qubit_ids() for cmd in actual))
+        # The qubit 0 stays negated between the first three gates
+        self.assertEqual(sum(1 for cmd in actual if cmd.gate == X_GATE and not cmd.get_control_qubit_ids()), 4)
+        assert_allclose(_unitary(actual, 3), _unitary(commands, 3), atol=1e-9)
+
+    def test_costs(self) -> None:
+        expensive_cu3 = Target({X_GATE: 1, U3_GATE: 1}, costs={U3_GATE: [1, 100]})
+        cmd = GateCmd(U3_GATE, 0, control_qubit_ids={1}, params=[0.3, 1.1, -0.7])
+        self.assertEqual(len(expensive_cu3.lower([cmd])), 6)
+        self.assertEqual(expensive_cu3.get_cost([cmd]), 100)
+
+        cheap_cu3 = Target({X_GATE: 1, U3_GATE: 1})
+        self.assertListEqual(cheap_cu3.lower([cmd]), [cmd])
+
+    def test_cannot_lower(self) -> None:
+        with self.assertRaises(ValueError):
+            Target({U3_GATE: 0}).lower([GateCmd(X_GATE, 0, control_qubit_ids={1})])
+
+    def test_stream(self) -> None:
+        commands = [GateCmd(H_GATE, 0), GateCmd(Y_GATE, 1, control_qubit_ids={0}), GateCmd(X_GATE, 2, control_qubit_ids={0, 1})]
+        consumed = []
+
+        def generator():
+            for command in commands:
+                consumed.append(command)
+                yield command
+
+        actual = CX_U3_TARGET.stream(generator())
+        self.assertEqual(next(actual), CX_U3_TARGET.lower(commands[:1])[0])
+        self.assertEqual(len(consumed), 1)
+        self.assertListEqual([CX_U3_TARGET.lower(commands)[0]] + list(actual), CX_U3_TARGET.lower(commands))
+
+    def test_compile_streamed(self) -> None:
+        consumed = []
+
+        class CountingTarget(Target):
+            def stream(self, commands):
+                def counted():
+                    for command in commands:
+                        consumed.append(command)
+                        yield command
+                return super().stream(counted())
+
+        class RecordingFormatter(QASMFormatter):
+            first_gate_consumed = None
+
+            def gate(self, *args):
+                if self.first_gate_consumed is None:
+                    self.first_gate_consumed = len(consumed)
+                return super().gate(*args)
+
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        for index in range(100):
+            prgm += U3(qubits[index % 3], 0.01 * (index + 1), 0.2, 0.3)
+
+        formatter = RecordingFormatter()
+        actual = Quasar().compile(prgm, formatter, target=CountingTarget({X_GATE: 1, U3_GATE: 0}), optimize_window=4)
+        self.assertEqual(len(actual[6:]), 100)
+        # The first gate is emitted before the compiled commands are all lowered
+        self.assertLess(formatter.first_gate_consumed, 10)
+        self.assertEqual(len(consumed), 100)
+
+    def test_compile(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0, 0])
+        prgm += H(qubits[0])
+        prgm += If(All(qubits[:3])).Then(U3(qubits[3], 0.1, 0.2, 0.3) + X(qubits[3]))
+
+        actual = Quasar().compile(prgm, QASMFormatter(), target=CX_U3_TARGET)
+        body = actual[6:]
+        self.assertTrue(body)
+        self.assertTrue(all(line.startswith(('u3', 'cx ', 'x ')) for line in body), body)
+
+    def test_compile_cancels_before_lowering(self) -> None:
+        prgm = Program()
+        qubits = prgm.Qubits([0, 0, 0])
+        prgm += CCX(qubits[0], qubits[1], qubits[2]) + CCX(qubits[0], qubits[1], qubits[2])
+        prgm += CRY(qubits[0], qubits[1], 0.4) + CRY(qubits[0], qubits[1], -0.4)
+
+        actual = Quasar().compile(prgm, QASMFormatter(), target=CX_U3_TARGET)
+        self.assertListEqual(actual[6:], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -72,13 +72,13 @@ def Set(
     qs: List[Qubit],
     value: int
 ) -> Program:
-    if (value == 0) or (len(qs) == 0):
+    # The last qubit is the least significant one
+    flipped = [q for (index, q) in enumerate(qs) if (value >> (len(qs) - 1 - index)) & 1]
+
+    if not flipped:
         return Program()
 
-    if (value % 2 == 1):
-        return Program(X(qs[-1])) + Set(qs[0: -1], value//2)
-    else:
-        return Set(qs[0: -1], value//2)
+    return Program(X(flipped))
 
 
 def Inc(